@@ -1 +1 @@
-version = '2.0.16'
+version = '2.0.17'
@@ -0,0 +1,123 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import os
+import time
+import difflib
+import tarfile
+
+from docker.errors import NotFound
+
+from cloudify.exceptions import NonRecoverableError
+
+from .constants import ARCHIVE_MAX_FILE_SIZE, ARCHIVE_CHUNK_SIZE
+
+
+class ChunkReader(io.RawIOBase):
+    """File object reading through an iterator of byte chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self._chunk):
+            try:
+                self._chunk = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        count = min(len(buffer), len(self._chunk))
+        buffer[:count] = self._chunk[:count]
+        self._chunk = self._chunk[count:]
+        return count
+
+    def close(self):
+        if hasattr(self._chunks, 'close'):
+            self._chunks.close()
+        super(ChunkReader, self).close()
+
+
+def iter_tar_files(chunks, max_size=ARCHIVE_MAX_FILE_SIZE):
+    """
+    Yield the name, mode and content of the regular files of the tar
+    streamed by chunks, reading it once front to back, without a copy
+    of the archive on disk or in memory.
+    """
+    reader = ChunkReader(chunks)
+    try:
+        with tarfile.open(fileobj=reader, mode='r|') as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                if max_size is not None and member.size > max_size:
+                    raise NonRecoverableError(
+                        "{0} is {1} bytes, more than {2}".format(
+                            member.name, member.size, max_size))
+                yield member.name, member.mode, \
+                    archive.extractfile(member).read()
+    finally:
+        reader.close()
+
+
+def read_file(docker_client, container_id, path,
+              max_size=ARCHIVE_MAX_FILE_SIZE):
+    """Content of the file at path in the container, None if missing."""
+    try:
+        bits, stat = docker_client.api.get_archive(
+            container_id, path, chunk_size=ARCHIVE_CHUNK_SIZE)
+    except NotFound:
+        return None
+    if max_size is not None and stat.get('size', 0) > max_size:
+        bits.close()
+        raise NonRecoverableError(
+            "{0} is {1} bytes, more than {2}".format(
+                path, stat['size'], max_size))
+    files = iter_tar_files(bits, max_size)
+    try:
+        for _, _, content in files:
+            return content
+    finally:
+        files.close()
+    return None
+
+
+def write_file(docker_client, container_id, path, data, mode=0o644):
+    """Create or replace the file at path in the container with data."""
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode='w') as archive:
+        info = tarfile.TarInfo(name=os.path.basename(path))
+        info.size = len(data)
+        info.mode = mode
+        info.mtime = time.time()
+        archive.addfile(info, io.BytesIO(data))
+    return docker_client.api.put_archive(
+        container_id, os.path.dirname(path) or '/', stream.getvalue())
+
+
+def diff_file(docker_client, container_id, path, data,
+              max_size=ARCHIVE_MAX_FILE_SIZE):
+    """Unified diff from the file at path in the container to data."""
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    current = read_file(docker_client, container_id, path, max_size) or b''
+    return list(difflib.unified_diff(
+        current.decode('utf-8', 'replace').splitlines(True),
+        data.decode('utf-8', 'replace').splitlines(True),
+        fromfile='a{0}'.format(path), tofile='b{0}'.format(path)))
@@ -0,0 +1,163 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import gzip
+import shutil
+import hashlib
+
+from contextlib import contextmanager
+
+from cloudify.exceptions import NonRecoverableError
+from cloudify_common_sdk._compat import text_type
+
+from .constants import (ARTIFACTS_DIR,
+                        ARTIFACT_CHUNK_SIZE,
+                        ARTIFACT_TAIL_SIZE)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARTIFACT_SUFFIX = '_artifact'
+COMPRESSION_EXTENSIONS = {
+    'gzip': 'gz',
+    'zstd': 'zst',
+}
+
+
+def get_artifacts_dir(ctx):
+    return os.path.join(os.path.expanduser(ARTIFACTS_DIR),
+                        ctx.deployment.id,
+                        ctx.instance.id)
+
+
+def _open_compressed(path, mode, compression):
+    if compression == 'gzip':
+        return gzip.open(path, mode)
+    if compression == 'zstd':
+        if not zstandard:
+            raise NonRecoverableError(
+                "zstd compression requires the zstandard package")
+        if 'w' in mode:
+            return zstandard.ZstdCompressor().stream_writer(open(path, mode))
+        return zstandard.ZstdDecompressor().stream_reader(open(path, mode))
+    raise NonRecoverableError(
+        "Unsupported output compression {0}".format(compression))
+
+
+class OutputArtifact(object):
+    """
+    Compressed file that receives the full output of a run, keeping
+    track of its size and content hash on the way.
+    """
+
+    def __init__(self, path, compression='gzip'):
+        self.path = path
+        self.compression = compression
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._file = _open_compressed(path, 'wb', compression)
+
+    def write(self, data):
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        self._hash.update(data)
+        self.size += len(data)
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+    def summary(self):
+        return {
+            'path': self.path,
+            'size': self.size,
+            'sha256': self._hash.hexdigest(),
+            'compression': self.compression,
+        }
+
+
+@contextmanager
+def output_artifact(ctx, name, resource_config):
+    """
+    Yield an OutputArtifact for `name` when output_artifacts is enabled
+    in the resource config, otherwise None.
+    """
+    if not resource_config.get('output_artifacts', False):
+        yield None
+        return
+    compression = resource_config.get('output_compression') or 'gzip'
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise NonRecoverableError(
+            "Unsupported output compression {0}".format(compression))
+    artifacts_dir = get_artifacts_dir(ctx)
+    if not os.path.isdir(artifacts_dir):
+        os.makedirs(artifacts_dir)
+    artifact = OutputArtifact(
+        os.path.join(artifacts_dir, '{0}.{1}'.format(
+            name, COMPRESSION_EXTENSIONS[compression])),
+        compression)
+    try:
+        yield artifact
+    finally:
+        artifact.close()
+
+
+def store_output(ctx, name, output, artifact=None):
+    """
+    Save output in runtime properties, only the tail of it if the full
+    text output was spilled to an artifact.
+    """
+    if not artifact:
+        ctx.instance.runtime_properties[name] = output
+        ctx.instance.runtime_properties.pop(name + ARTIFACT_SUFFIX, None)
+        return
+    if isinstance(output, text_type):
+        output = output[-ARTIFACT_TAIL_SIZE:]
+    ctx.instance.runtime_properties[name] = output
+    ctx.instance.runtime_properties[name + ARTIFACT_SUFFIX] = \
+        artifact.summary()
+
+
+def read_output_artifact(path, compression='gzip',
+                         chunk_size=ARTIFACT_CHUNK_SIZE):
+    """Lazily read back an artifact, yields chunks of decompressed bytes."""
+    with _open_compressed(path, 'rb', compression) as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def read_output(ctx, name):
+    """Return the full output saved under `name` for the current instance."""
+    info = ctx.instance.runtime_properties.get(name + ARTIFACT_SUFFIX)
+    if not info or not os.path.isfile(info.get('path', '')):
+        return ctx.instance.runtime_properties.get(name, '')
+    return b''.join(
+        read_output_artifact(info['path'], info['compression'])).decode(
+            'utf-8', 'replace')
+
+
+def delete_output(ctx, name):
+    ctx.instance.runtime_properties.pop(name, None)
+    info = ctx.instance.runtime_properties.pop(name + ARTIFACT_SUFFIX, None)
+    if info and os.path.isfile(info.get('path', '')):
+        os.remove(info['path'])
+        artifacts_dir = os.path.dirname(info['path'])
+        if not os.listdir(artifacts_dir):
+            shutil.rmtree(artifacts_dir)
@@ -0,0 +1,242 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+
+from docker.utils.build import tar, exclude_paths
+
+from cloudify.exceptions import NonRecoverableError
+
+from .constants import (BUILD_CONTEXT_CACHE_DIR,
+                        BUILD_CONTEXT_CACHE_SIZE,
+                        ARTIFACT_CHUNK_SIZE)
+
+STEP_RE = re.compile(r'^Step (\d+)/(\d+) : (.*)$')
+BUILT_RE = re.compile(r'^Successfully built ([0-9a-f]+)$')
+MAX_INSTRUCTION_LENGTH = 120
+INLINE_DOCKERFILE = '.dockerfile.cloudify'
+BUILD_HASH_LABEL = 'co.cloudify.docker.build-hash'
+# build options that change the resulting image
+BUILD_HASH_OPTIONS = ('buildargs', 'target', 'squash')
+
+
+class BuildFailed(NonRecoverableError):
+    pass
+
+
+class BuildProgress(object):
+    """
+    Parses docker build events as they arrive, logging each step with its
+    timing and keeping only a compact per step summary.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.steps = []
+        self.image_id = None
+        self.error = None
+        self._current = None
+        self.status = 'built'
+        self._started = time.time()
+
+    def _finish_step(self):
+        step = self._current
+        if not step:
+            return
+        step['duration'] = round(time.time() - step.pop('_started'), 3)
+        self.logger.info("Step {0}/{1} done in {2}s (cache {3})".format(
+            step['step'], step['total'], step['duration'], step['cache']))
+        self._current = None
+
+    def _handle_line(self, line):
+        match = STEP_RE.match(line)
+        if match:
+            self._finish_step()
+            instruction = match.group(3)
+            self._current = {
+                'step': int(match.group(1)),
+                'total': int(match.group(2)),
+                'instruction': instruction[:MAX_INSTRUCTION_LENGTH],
+                'cache': 'miss',
+                '_started': time.time(),
+            }
+            self.steps.append(self._current)
+            self.logger.info(line)
+            return
+        if self._current and line.strip() == '---> Using cache':
+            self._current['cache'] = 'hit'
+        match = BUILT_RE.match(line)
+        if match and not self.image_id:
+            self.image_id = match.group(1)
+        self.logger.debug(line)
+
+    def feed(self, event):
+        if 'errorDetail' in event or 'error' in event:
+            self._finish_step()
+            detail = event.get('errorDetail') or {}
+            self.error = detail.get('message') or event.get('error')
+            self.status = 'failed'
+            step = self.steps[-1] if self.steps else {}
+            raise BuildFailed(
+                "Build failed at step {0}: {1}".format(
+                    step.get('step', '-'), self.error))
+        for line in event.get('stream', '').splitlines():
+            if line.strip():
+                self._handle_line(line)
+        if 'aux' in event and event['aux'].get('ID'):
+            self.image_id = event['aux']['ID']
+        if 'status' in event:
+            self.logger.debug("{0} {1}".format(event.get('id', ''),
+                                               event['status']))
+
+    def close(self):
+        self._finish_step()
+
+    def summary(self):
+        return {
+            'status': self.status,
+            'image_id': self.image_id,
+            'duration': round(time.time() - self._started, 3),
+            'steps': [dict((k, v) for k, v in step.items()
+                           if not k.startswith('_'))
+                      for step in self.steps],
+            'error': self.error,
+        }
+
+
+def skipped_build_summary(image_id):
+    return {
+        'status': 'build_skipped',
+        'image_id': image_id,
+        'duration': 0,
+        'steps': [],
+        'error': None,
+    }
+
+
+def build_hash(dockerfile_content=None, context_hash=None,
+               build_options=None):
+    """Hash of everything that goes into a build, used to label images."""
+    content = json.dumps({
+        'dockerfile': dockerfile_content,
+        'context': context_hash,
+        'options': build_options or {},
+    }, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def build_failed(build_result):
+    """Check a build_result runtime property, old or new style."""
+    if isinstance(build_result, dict):
+        return bool(build_result.get('error'))
+    return 'errorDetail' in build_result
+
+
+def read_dockerignore(root):
+    dockerignore = os.path.join(root, '.dockerignore')
+    if not os.path.isfile(dockerignore):
+        return []
+    with open(dockerignore, 'r') as f:
+        return [line.strip() for line in f.read().splitlines()
+                if line.strip() and not line.strip().startswith('#')]
+
+
+class BuildContext(object):
+    """
+    Directory used as docker build context, sent to the daemon as a gzipped
+    tar that is cached on disk by the hash of its content.
+    """
+
+    def __init__(self, root, dockerfile_content=None,
+                 cache_dir=BUILD_CONTEXT_CACHE_DIR):
+        self.root = os.path.abspath(root)
+        self.dockerfile_content = dockerfile_content
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.exclude = read_dockerignore(self.root)
+        self._hash = None
+
+    @property
+    def dockerfile(self):
+        # a Dockerfile given as content is added to the tar under its own
+        # name, otherwise the one inside the context is used
+        if self.dockerfile_content is not None:
+            return INLINE_DOCKERFILE
+        return 'Dockerfile'
+
+    def files(self):
+        return sorted(exclude_paths(self.root, list(self.exclude),
+                                    dockerfile=self.dockerfile))
+
+    @property
+    def hash(self):
+        if self._hash:
+            return self._hash
+        sha = hashlib.sha256()
+        for name in self.files():
+            path = os.path.join(self.root, name)
+            sha.update(name.encode('utf-8') + b'\0')
+            if os.path.islink(path):
+                sha.update(os.readlink(path).encode('utf-8'))
+            elif os.path.isfile(path):
+                sha.update(str(os.stat(path).st_mode & 0o777).encode())
+                with open(path, 'rb') as f:
+                    for chunk in iter(
+                            lambda: f.read(ARTIFACT_CHUNK_SIZE), b''):
+                        sha.update(chunk)
+            sha.update(b'\0')
+        if self.dockerfile_content is not None:
+            sha.update(b'\0dockerfile\0')
+            sha.update(self.dockerfile_content.encode('utf-8'))
+        self._hash = sha.hexdigest()
+        return self._hash
+
+    def _prune_cache(self):
+        cached = [os.path.join(self.cache_dir, name)
+                  for name in os.listdir(self.cache_dir)
+                  if name.endswith('.tar.gz')]
+        cached.sort(key=os.path.getmtime, reverse=True)
+        for path in cached[BUILD_CONTEXT_CACHE_SIZE:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def tarball(self):
+        """Return the path of the context tar, creating it if needed."""
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = os.path.join(self.cache_dir, '{0}.tar.gz'.format(self.hash))
+        if os.path.isfile(path):
+            # mark it as recently used
+            os.utime(path, None)
+            return path
+        dockerfile = None
+        if self.dockerfile_content is not None:
+            dockerfile = (INLINE_DOCKERFILE, self.dockerfile_content)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                tar(self.root, exclude=list(self.exclude),
+                    dockerfile=dockerfile, fileobj=f, gzip=True)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self._prune_cache()
+        return path
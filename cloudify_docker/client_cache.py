@@ -0,0 +1,195 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import atexit
+import threading
+
+import docker
+
+from cloudify.exceptions import NonRecoverableError
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .events import close_exit_watcher
+from .constants import (MAX_CACHED_CLIENTS,
+                        CLIENT_IDLE_TIMEOUT,
+                        CLIENT_MAX_POOL_SIZE,
+                        CLIENT_HEALTH_CHECK_INTERVAL)
+
+
+class _CachedClient(object):
+
+    def __init__(self, client, idle_timeout=CLIENT_IDLE_TIMEOUT):
+        self.client = client
+        self.idle_timeout = idle_timeout
+        self.borrowed = 0
+        self.last_used = time.time()
+        # out of the cache, the last borrower closes it
+        self.evicted = False
+
+
+class DockerClientCache(object):
+    """
+    Process wide cache of docker clients keyed by the connection settings
+    and pool size, so all the operations that talk to the same daemon share
+    one client (and its HTTP connection pool) instead of creating a new one
+    per call. A client is closed once idle for the idle_timeout of its last
+    borrower.
+    """
+
+    def __init__(self,
+                 max_clients=MAX_CACHED_CLIENTS,
+                 health_check_interval=CLIENT_HEALTH_CHECK_INTERVAL):
+        self.max_clients = max_clients
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()
+
+    @staticmethod
+    def _close_client(client):
+        # its events stream and thread would outlive it otherwise
+        close_exit_watcher(client)
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, cached):
+        # skip the ping if the client was used recently
+        if time.time() - cached.last_used < self.health_check_interval:
+            return True
+        try:
+            cached.client.ping()
+            return True
+        except Exception:
+            return False
+
+    def _evict(self):
+        # called with the lock held, returns the clients to close
+        now = time.time()
+        evicted = []
+        for key, cached in list(self._clients.items()):
+            if cached.borrowed:
+                continue
+            if now - cached.last_used > cached.idle_timeout or \
+                    len(self._clients) - len(evicted) > self.max_clients:
+                evicted.append(self._clients.pop(key))
+        return evicted
+
+    def _acquire(self, key, idle_timeout):
+        with self._lock:
+            evicted = self._evict()
+            cached = self._clients.get(key)
+            if cached:
+                self._clients.move_to_end(key)
+                cached.borrowed += 1
+                cached.idle_timeout = idle_timeout
+        for stale in evicted:
+            self._close_client(stale.client)
+
+        if cached and not self._is_healthy(cached):
+            if self._release(cached, evict=True):
+                self._close_client(cached.client)
+            cached = None
+
+        if not cached:
+            base_url, tls, max_pool_size = key
+            client = docker.DockerClient(base_url=base_url,
+                                         tls=tls,
+                                         max_pool_size=max_pool_size)
+            with self._lock:
+                cached = self._clients.get(key)
+                if cached:
+                    # another thread created one meanwhile, use it
+                    cached.borrowed += 1
+                    cached.idle_timeout = idle_timeout
+                    duplicate = client
+                else:
+                    cached = _CachedClient(client, idle_timeout)
+                    cached.borrowed = 1
+                    self._clients[key] = cached
+                    duplicate = None
+            if duplicate:
+                self._close_client(duplicate)
+        return cached
+
+    def _release(self, cached, evict=False):
+        # returns whether the caller should close the client
+        with self._lock:
+            cached.borrowed -= 1
+            cached.last_used = time.time()
+            if evict and not cached.evicted:
+                cached.evicted = True
+                for key, other in list(self._clients.items()):
+                    if other is cached:
+                        self._clients.pop(key)
+            return cached.evicted and not cached.borrowed
+
+    @contextmanager
+    def borrow(self, base_url, tls=False,
+               max_pool_size=CLIENT_MAX_POOL_SIZE,
+               idle_timeout=CLIENT_IDLE_TIMEOUT):
+        cached = self._acquire((base_url, tls, max_pool_size), idle_timeout)
+        try:
+            yield cached.client
+        finally:
+            if self._release(cached):
+                self._close_client(cached.client)
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for cached in clients:
+            self._close_client(cached.client)
+
+    def __len__(self):
+        return len(self._clients)
+
+
+DOCKER_CLIENTS = DockerClientCache()
+
+
+def get_base_url(client_config):
+    if client_config.get('docker_host', '') \
+            and client_config.get('docker_rest_port', ''):
+        return "tcp://{0}:{1}".format(
+            client_config['docker_host'],
+            client_config['docker_rest_port'])
+    elif client_config.get('docker_sock_file', ''):
+        return "unix:/{0}".format(client_config['docker_sock_file'])
+    # if we are here that means we don't have a valid docker config
+    raise NonRecoverableError('Invalid docker client config')
+
+
+@contextmanager
+def docker_client_from_config(client_config, base_url=None):
+    base_url = base_url or get_base_url(client_config)
+    max_pool_size = client_config.get('max_pool_size') or CLIENT_MAX_POOL_SIZE
+    idle_timeout = client_config.get('client_idle_timeout') \
+        or CLIENT_IDLE_TIMEOUT
+    with DOCKER_CLIENTS.borrow(base_url,
+                               tls=False,
+                               max_pool_size=int(max_pool_size),
+                               idle_timeout=int(idle_timeout)) as client:
+        yield client
+
+
+def close_docker_clients():
+    DOCKER_CLIENTS.close()
+
+
+atexit.register(close_docker_clients)
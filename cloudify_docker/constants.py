@@ -10,3 +10,54 @@ WORKSPACE = 'workspace'
 LIST_TYPES = ['skip-tags', 'tags']
 BP_INCLUDES_PATH = '/opt/manager/resources/blueprints/' \
                    '{tenant}/{blueprint}/{relative_path}'
+MAX_CACHED_CLIENTS = 16
+CLIENT_MAX_POOL_SIZE = 10
+CLIENT_IDLE_TIMEOUT = 300
+CLIENT_HEALTH_CHECK_INTERVAL = 30
+LOG_HEAD_SIZE = 64 * 1024
+LOG_TAIL_SIZE = 256 * 1024
+LOG_BATCH_LINES = 200
+LOG_BATCH_INTERVAL = 2
+LOG_MAX_LINE = 8192
+ARTIFACTS_DIR = '~/.cloudify-docker/artifacts'
+ARTIFACT_TAIL_SIZE = 4096
+ARTIFACT_CHUNK_SIZE = 64 * 1024
+CONTAINER_EXIT_TIMEOUT = 10
+BUILD_CONTEXT_CACHE_DIR = '~/.cloudify-docker/build-contexts'
+BUILD_CONTEXT_CACHE_SIZE = 20
+PULL_CONCURRENCY = 3
+PULL_PROGRESS_INTERVAL = 5
+LOCKS_DIR = '~/.cloudify-docker/locks'
+SINGLE_FLIGHT_TIMEOUT = 3600
+DISTRIBUTION_CONCURRENCY = 4
+DISTRIBUTION_CHUNK_SIZE = 1024 * 1024
+TEE_QUEUE_SIZE = 8
+INVENTORY_MAX_EVENT_GAP = 3600
+# the daemon keeps a bounded backlog of events, older ones may be lost
+INVENTORY_MAX_EVENTS = 256
+STATS_WINDOW = 30
+STATS_MAX_CONTAINERS = 64
+REPLICA_CONCURRENCY = 4
+POOLS_DIR = '~/.cloudify-docker/pools'
+POOL_SIZE = 2
+POOL_IDLE_TTL = 600
+POOL_MAX_REUSE = 20
+POOL_IDLE_COMMAND = ['sleep', 'infinity']
+STREAM_BUFFER_SIZE = 64 * 1024
+LOG_POLL_INTERVAL = 1
+LOG_DRAIN_TIMEOUT = 30
+STOP_COMMAND_TIMEOUT = 20
+READINESS_TIMEOUT = 120
+READINESS_INITIAL_DELAY = 0.25
+READINESS_MAX_DELAY = 5
+READINESS_CONNECT_TIMEOUT = 2
+TEARDOWN_GRACE_PERIOD = 10
+TEARDOWN_CONCURRENCY = 16
+TEARDOWN_POLL_INTERVAL = 0.5
+ARCHIVE_MAX_FILE_SIZE = 16 * 1024 * 1024
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+SSH_MAX_PER_HOST = 4
+SSH_IDLE_TIMEOUT = 300
+SSH_KEEPALIVE_INTERVAL = 30
+REMOTE_OUTPUT_TAIL_LINES = 20
+REMOTE_RECV_SIZE = 32 * 1024
@@ -0,0 +1,199 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import docker
+
+RUNNING_STATES = ('running', 'paused', 'restarting')
+
+
+def unique_size(image):
+    """Bytes freed by removing image, the layers it shares are kept."""
+    shared = image.get('SharedSize', -1)
+    if shared is None or shared < 0:
+        return image.get('Size', 0)
+    return image.get('Size', 0) - shared
+
+
+def is_dangling(image):
+    return not [tag for tag in image.get('RepoTags') or []
+                if tag != '<none>:<none>']
+
+
+def is_pinned(image, pin_labels):
+    labels = image.get('Labels') or {}
+    for pin in pin_labels or []:
+        key, _, value = pin.partition('=')
+        if key in labels and (not value or labels[key] == value):
+            return True
+    return False
+
+
+def disk_usage_summary(df):
+    """Compact form of docker system df, sizes in bytes."""
+    images = df.get('Images') or []
+    containers = df.get('Containers') or []
+    volumes = df.get('Volumes') or []
+    build_cache = df.get('BuildCache') or []
+    active_images = set(container.get('ImageID') for container in containers)
+    stopped = [container for container in containers
+               if container.get('State') not in RUNNING_STATES]
+    volumes_usage = [volume.get('UsageData') or {} for volume in volumes]
+    return {
+        'images': {
+            'count': len(images),
+            'active': len([image for image in images
+                           if image['Id'] in active_images]),
+            'size': df.get('LayersSize', 0),
+            'reclaimable': sum(unique_size(image) for image in images
+                               if image['Id'] not in active_images),
+        },
+        'containers': {
+            'count': len(containers),
+            'active': len(containers) - len(stopped),
+            'size': sum(container.get('SizeRw', 0)
+                        for container in containers),
+            'reclaimable': sum(container.get('SizeRw', 0)
+                               for container in stopped),
+        },
+        'volumes': {
+            'count': len(volumes),
+            'active': len([usage for usage in volumes_usage
+                           if usage.get('RefCount', 0) > 0]),
+            'size': sum(max(usage.get('Size', 0), 0)
+                        for usage in volumes_usage),
+            'reclaimable': sum(max(usage.get('Size', 0), 0)
+                               for usage in volumes_usage
+                               if usage.get('RefCount', 0) == 0),
+        },
+        'build_cache': {
+            'count': len(build_cache),
+            'active': len([cache for cache in build_cache
+                           if cache.get('InUse')]),
+            'size': sum(cache.get('Size', 0) for cache in build_cache),
+            'reclaimable': sum(cache.get('Size', 0) for cache in build_cache
+                               if not cache.get('InUse') and
+                               not cache.get('Shared')),
+        },
+    }
+
+
+def image_last_used(image, containers):
+    """Creation of the newest container of image, or of the image itself."""
+    used = [container.get('Created', 0) for container in containers
+            if container.get('ImageID') == image['Id']]
+    return max(used + [image.get('Created', 0)])
+
+
+def plan_gc(df, budget=None, pin_labels=None, prune_containers=False,
+            prune_dangling=True):
+    """
+    Choose the images to remove: the dangling ones, then the least
+    recently used ones until the image layers fit in budget bytes.
+    Images used by a container that stays, pinned by label, or parent of
+    another image are kept. Returns the images and the expected size.
+    """
+    images = df.get('Images') or []
+    # the stopped containers still tell when their image was last used
+    containers = df.get('Containers') or []
+    staying = containers
+    if prune_containers:
+        staying = [container for container in containers
+                   if container.get('State') in RUNNING_STATES]
+    in_use = set(container.get('ImageID') for container in staying)
+    parents = set(image.get('ParentId') for image in images)
+    candidates = [image for image in images
+                  if image['Id'] not in in_use and
+                  image['Id'] not in parents and
+                  not is_pinned(image, pin_labels)]
+    candidates.sort(key=lambda image: image_last_used(image, containers))
+    size = df.get('LayersSize', 0)
+    evict = []
+    if prune_dangling:
+        for image in candidates:
+            if is_dangling(image):
+                evict.append(image)
+                size -= unique_size(image)
+    if budget is not None:
+        for image in candidates:
+            if size <= budget:
+                break
+            if image not in evict:
+                evict.append(image)
+                size -= unique_size(image)
+    plan = [{
+        'id': image['Id'],
+        'tags': [tag for tag in image.get('RepoTags') or []
+                 if tag != '<none>:<none>'],
+        'size': unique_size(image),
+        'last_used': image_last_used(image, containers),
+    } for image in evict]
+    return plan, size
+
+
+def collect_garbage(docker_client, logger, budget=None, pin_labels=None,
+                    prune_containers=False, prune_dangling=True,
+                    prune_build_cache=True, dry_run=False):
+    """
+    Prune stopped containers and build cache and remove images as planned
+    by plan_gc, or only report what would be done when dry_run is set.
+    """
+    df = docker_client.api.df()
+    before = disk_usage_summary(df)
+    plan, expected_size = plan_gc(df, budget, pin_labels,
+                                  prune_containers, prune_dangling)
+    report = {
+        'dry_run': dry_run,
+        'budget': budget,
+        'before': before,
+        'expected_images_size': expected_size,
+        'images': plan,
+        'reclaimed': 0,
+        'errors': [],
+    }
+    if prune_containers:
+        report['containers'] = before['containers']['count'] - \
+            before['containers']['active']
+    if dry_run:
+        report['reclaimed'] = sum(image['size'] for image in plan)
+        if prune_containers:
+            report['reclaimed'] += before['containers']['reclaimable']
+        if prune_build_cache:
+            report['reclaimed'] += before['build_cache']['reclaimable']
+        logger.info("Would reclaim {0} bytes removing {1} images".format(
+            report['reclaimed'], len(plan)))
+        return report
+
+    if prune_containers:
+        result = docker_client.api.prune_containers()
+        report['containers'] = len(result.get('ContainersDeleted') or [])
+        report['reclaimed'] += result.get('SpaceReclaimed') or 0
+    for image in plan:
+        try:
+            # force as the image may have several tags, the images used by
+            # containers are never in the plan
+            docker_client.api.remove_image(image['id'], force=True)
+            image['removed'] = True
+            report['reclaimed'] += image['size']
+            logger.info("Removed image {0} {1}".format(
+                image['id'], image['tags']))
+        except docker.errors.APIError as e:
+            image['removed'] = False
+            report['errors'].append(str(e))
+            logger.error("Failed to remove image {0}: {1}".format(
+                image['id'], e))
+    if prune_build_cache:
+        result = docker_client.api.prune_builds()
+        report['reclaimed'] += result.get('SpaceReclaimed') or 0
+    logger.info("Reclaimed {0} bytes".format(report['reclaimed']))
+    return report
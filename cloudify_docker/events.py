@@ -0,0 +1,219 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import atexit
+import threading
+
+from docker.errors import NotFound
+
+from .constants import CONTAINER_EXIT_TIMEOUT
+
+EXIT_EVENTS = ['die', 'stop']
+EXITED_STATES = ('exited', 'dead')
+
+
+class ExitWaiter(object):
+
+    def __init__(self, container_id):
+        self.container_id = container_id
+        self.exit_code = None
+        self.exited_at = None
+        self.watcher = None
+        self._event = threading.Event()
+
+    def set(self, exit_code=None):
+        if exit_code is not None and self.exit_code is None:
+            self.exit_code = exit_code
+            self.exited_at = time.time()
+        self._event.set()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+        return self.exit_code
+
+
+class ContainerExitWatcher(object):
+    """
+    One docker events subscription per daemon, filtered on container
+    die/stop, that wakes up everyone waiting on those containers.
+    """
+
+    def __init__(self, docker_client, on_stop=None):
+        self.docker_client = docker_client
+        self._on_stop = on_stop
+        self._lock = threading.Lock()
+        self._waiters = {}
+        self._alive = True
+        # the request is sent here, so no exit is missed after this point
+        self._stream = docker_client.events(
+            decode=True,
+            filters={'type': 'container', 'event': EXIT_EVENTS})
+        self._thread = threading.Thread(target=self._run,
+                                        name='docker-exit-watcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def alive(self):
+        return self._alive
+
+    def _run(self):
+        try:
+            for event in self._stream:
+                self._dispatch(event)
+        except Exception:
+            pass
+        finally:
+            self._alive = False
+            if self._on_stop:
+                self._on_stop(self)
+            # wake everyone, they would fall back to inspect
+            with self._lock:
+                waiters = [w for ws in self._waiters.values() for w in ws]
+                self._waiters.clear()
+            for waiter in waiters:
+                waiter.set()
+
+    def _dispatch(self, event):
+        container_id = event.get('id') or \
+            event.get('Actor', {}).get('ID', '')
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        exit_code = attributes.get('exitCode')
+        if exit_code is not None:
+            exit_code = int(exit_code)
+        with self._lock:
+            waiters = self._waiters.pop(container_id, [])
+        for waiter in waiters:
+            waiter.set(exit_code)
+
+    def watch(self, container_id):
+        waiter = ExitWaiter(container_id)
+        waiter.watcher = self
+        if not self._alive:
+            waiter.set()
+            return waiter
+        with self._lock:
+            self._waiters.setdefault(container_id, []).append(waiter)
+        return waiter
+
+    def unwatch(self, waiter):
+        with self._lock:
+            waiters = self._waiters.get(waiter.container_id, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self._waiters.pop(waiter.container_id, None)
+
+    def close(self):
+        try:
+            self._stream.close()
+        except Exception:
+            pass
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def _forget_watcher(watcher):
+    with _watchers_lock:
+        for key, value in list(_watchers.items()):
+            if value is watcher:
+                _watchers.pop(key)
+
+
+def get_exit_watcher(docker_client):
+    """Return the shared exit watcher of the docker_client daemon."""
+    key = id(docker_client)
+    with _watchers_lock:
+        watcher = _watchers.get(key)
+        if watcher and watcher.alive and \
+                watcher.docker_client is docker_client:
+            return watcher
+    if watcher:
+        # dead, or left by a closed client whose id was reused
+        watcher.close()
+    watcher = ContainerExitWatcher(docker_client, on_stop=_forget_watcher)
+    with _watchers_lock:
+        _watchers[key] = watcher
+    return watcher
+
+
+def close_exit_watcher(docker_client):
+    """Close the exit watcher of docker_client, before closing it."""
+    with _watchers_lock:
+        watcher = _watchers.get(id(docker_client))
+        if not watcher or watcher.docker_client is not docker_client:
+            return
+        _watchers.pop(id(docker_client))
+    watcher.close()
+
+
+def close_exit_watchers():
+    with _watchers_lock:
+        watchers = list(_watchers.values())
+        _watchers.clear()
+    for watcher in watchers:
+        watcher.close()
+
+
+atexit.register(close_exit_watchers)
+
+
+def watch_container_exit(docker_client, container_id, check_exited=False):
+    """
+    Start watching container_id for exit, this should be called before the
+    action that would end the container so its event is not missed,
+    otherwise pass check_exited to inspect it once after subscribing.
+    """
+    try:
+        waiter = get_exit_watcher(docker_client).watch(container_id)
+    except Exception:
+        # no events support, wait_for_exit will inspect the container
+        waiter = ExitWaiter(container_id)
+        waiter.set()
+        return waiter
+    if check_exited and not waiter.is_set():
+        exit_code = container_exit_code(docker_client, container_id)
+        if exit_code is not None:
+            waiter.set(exit_code)
+    return waiter
+
+
+def container_exit_code(docker_client, container_id):
+    """Single inspect of the container, returns its exit code if exited."""
+    try:
+        container = docker_client.containers.get(container_id)
+    except NotFound:
+        return None
+    if container.status in EXITED_STATES:
+        return container.attrs['State']['ExitCode']
+    return None
+
+
+def wait_for_exit(docker_client, waiter, timeout=CONTAINER_EXIT_TIMEOUT):
+    """
+    Block until the watched container exits and return its exit code,
+    falling back to one inspect when the event did not bring it.
+    """
+    exit_code = waiter.wait(timeout)
+    if exit_code is None:
+        exit_code = container_exit_code(docker_client, waiter.container_id)
+    if not waiter.is_set() and waiter.watcher:
+        waiter.watcher.unwatch(waiter)
+    return exit_code
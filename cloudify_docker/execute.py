@@ -0,0 +1,98 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from docker.errors import NotFound
+
+from .streams import demux_socket
+
+SIBLING_LABEL = 'co.cloudify.docker.sibling-of'
+
+
+def as_command(command):
+    """A list runs as is, a string through the shell, pipes and all."""
+    if isinstance(command, (list, tuple)):
+        return list(command)
+    return ['sh', '-c', command]
+
+
+def exec_command(docker_client, container_id, command, on_stdout,
+                 on_stderr, timeout=None, **options):
+    """
+    Run command in the running container, returns its exit code, None if
+    it is still running after timeout seconds.
+    """
+    exec_id = docker_client.api.exec_create(container_id,
+                                            as_command(command),
+                                            stdout=True, stderr=True,
+                                            **options)['Id']
+    sock = docker_client.api.exec_start(exec_id, socket=True)
+    if not demux_socket(sock, on_stdout, on_stderr, timeout=timeout):
+        return None
+    return docker_client.api.exec_inspect(exec_id)['ExitCode']
+
+
+def run_in_sibling(docker_client, container_id, command, on_stdout,
+                   on_stderr, timeout=None):
+    """
+    Run command in a short lived container of the same image, volumes,
+    network and environment as container_id, for when it is not running.
+    Returns the exit code, None if it was killed after timeout seconds.
+    """
+    info = docker_client.api.inspect_container(container_id)
+    config = info.get('Config') or {}
+    host_config = docker_client.api.create_host_config(
+        volumes_from=[container_id],
+        network_mode=(info.get('HostConfig') or {}).get('NetworkMode'))
+    sibling = docker_client.api.create_container(
+        info['Image'],
+        entrypoint=as_command(command),
+        environment=config.get('Env'),
+        working_dir=config.get('WorkingDir') or None,
+        user=config.get('User') or None,
+        labels={SIBLING_LABEL: container_id},
+        host_config=host_config)['Id']
+    try:
+        docker_client.api.start(sibling)
+        # logs replays what was written before attaching
+        sock = docker_client.api.attach_socket(
+            sibling, params={'stdout': 1, 'stderr': 1, 'stream': 1,
+                             'logs': 1})
+        if not demux_socket(sock, on_stdout, on_stderr, timeout=timeout):
+            # removing it below kills it
+            return None
+        return docker_client.api.wait(sibling)['StatusCode']
+    finally:
+        try:
+            docker_client.api.remove_container(sibling, force=True)
+        except NotFound:
+            pass
+
+
+def run_command(docker_client, container_id, command, on_stdout, on_stderr,
+                logger, timeout=None):
+    """
+    Run command with exec if the container is running, in a sibling
+    container sharing its volumes otherwise. Returns the exit code, None
+    if it didn't end within timeout seconds.
+    """
+    state = docker_client.api.inspect_container(container_id)['State']
+    if state.get('Running') and not state.get('Paused'):
+        logger.debug("Running {0} in container {1}".format(
+            command, container_id))
+        return exec_command(docker_client, container_id, command,
+                            on_stdout, on_stderr, timeout=timeout)
+    logger.debug("Container {0} is not running, running {1} in a sibling "
+                 "container".format(container_id, command))
+    return run_in_sibling(docker_client, container_id, command, on_stdout,
+                          on_stderr, timeout=timeout)
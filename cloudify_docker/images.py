@@ -0,0 +1,429 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import zlib
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+
+from docker.errors import ImageNotFound
+from docker.utils import parse_repository_tag
+
+from cloudify.exceptions import NonRecoverableError
+
+from .locks import single_flight
+from .client_cache import docker_client_from_config
+from .constants import (PULL_CONCURRENCY,
+                        TEE_QUEUE_SIZE,
+                        PULL_PROGRESS_INTERVAL,
+                        DISTRIBUTION_CHUNK_SIZE,
+                        DISTRIBUTION_CONCURRENCY)
+
+LAYER_DONE_STATES = ('Pull complete', 'Already exists')
+LAYER_STATES = LAYER_DONE_STATES + ('Pulling fs layer',
+                                    'Waiting',
+                                    'Downloading',
+                                    'Verifying Checksum',
+                                    'Download complete',
+                                    'Extracting')
+
+
+def parse_image_name(name):
+    """Split an image name into repository and tag, registry port aware."""
+    repository, tag = parse_repository_tag(name)
+    return repository, tag or 'latest'
+
+
+class PullProgress(object):
+    """Follows the events of a pull, logging per layer progress."""
+
+    def __init__(self, logger, name, interval=PULL_PROGRESS_INTERVAL):
+        self.logger = logger
+        self.name = name
+        self.interval = interval
+        self.layers = {}
+        self.digest = None
+        self._last_log = time.time()
+
+    def feed(self, event):
+        if 'error' in event:
+            raise NonRecoverableError("Pull of {0} failed: {1}".format(
+                self.name, event['error']))
+        status = event.get('status', '')
+        layer = event.get('id')
+        if status.startswith('Digest: '):
+            self.digest = status[len('Digest: '):]
+        if not layer or status not in LAYER_STATES:
+            return
+        progress = self.layers.setdefault(
+            layer, {'status': '', 'current': 0, 'total': 0})
+        detail = event.get('progressDetail') or {}
+        if status == 'Downloading' and detail.get('total'):
+            progress['current'] = detail.get('current', 0)
+            progress['total'] = detail['total']
+        if status != progress['status'] and status in LAYER_DONE_STATES:
+            self.logger.debug("{0} layer {1}: {2}".format(
+                self.name, layer, status))
+        progress['status'] = status
+        if time.time() - self._last_log >= self.interval:
+            self.log_progress()
+
+    def log_progress(self):
+        self._last_log = time.time()
+        done = len([layer for layer in self.layers.values()
+                    if layer['status'] in LAYER_DONE_STATES])
+        current = sum(layer['current'] for layer in self.layers.values())
+        total = sum(layer['total'] for layer in self.layers.values())
+        self.logger.info(
+            "Pulling {0}: {1}/{2} layers done, {3:.1f}/{4:.1f} MB".format(
+                self.name, done, len(self.layers),
+                current / 1048576.0, total / 1048576.0))
+
+    def summary(self):
+        return {
+            'status': 'pulled',
+            'digest': self.digest,
+            'layers': len(self.layers),
+            'existing_layers': len(
+                [layer for layer in self.layers.values()
+                 if layer['status'] == 'Already exists']),
+        }
+
+
+def get_local_digests(docker_client, name):
+    """Return the repo digests of the local image, None if it is missing."""
+    try:
+        image = docker_client.images.get(name)
+    except ImageNotFound:
+        return None
+    return [digest.split('@', 1)[-1]
+            for digest in image.attrs.get('RepoDigests') or []]
+
+
+def get_registry_digest(docker_client, name):
+    """Manifest digest of name in its registry, None if unreachable."""
+    try:
+        return docker_client.images.get_registry_data(name).id
+    except docker.errors.APIError:
+        return None
+
+
+def pull_image(docker_client, name, logger, all_tags=False, limit=None):
+    """
+    Pull name unless the local image already has the registry digest, or
+    another caller pulled it for the same daemon while we waited.
+    Returns a dict describing what was done.
+    """
+    with single_flight(docker_client.api.base_url,
+                       'pull:{0}:{1}'.format(name, all_tags)) as flight:
+        if flight.result:
+            logger.info("Image {0} was just pulled by another "
+                        "operation".format(name))
+            result = dict(flight.result)
+            result['status'] = 'reused'
+            return result
+        if limit:
+            with limit:
+                result = _pull_image(docker_client, name, logger, all_tags)
+        else:
+            result = _pull_image(docker_client, name, logger, all_tags)
+        flight.publish(result)
+        return result
+
+
+def _pull_image(docker_client, name, logger, all_tags=False):
+    repository, tag = parse_image_name(name)
+    local_digests = None
+    if not all_tags:
+        local_digests = get_local_digests(docker_client, name)
+        if local_digests is not None:
+            registry_digest = get_registry_digest(docker_client, name)
+            if registry_digest is None:
+                logger.info("Can't reach the registry of {0}, using the "
+                            "local image".format(name))
+                return {'status': 'up_to_date', 'digest': None,
+                        'present': True}
+            if registry_digest in local_digests:
+                logger.info("Image {0} is up to date ({1})".format(
+                    name, registry_digest))
+                return {'status': 'up_to_date', 'digest': registry_digest,
+                        'present': True}
+            logger.info("Image {0} is stale, pulling {1}".format(
+                name, registry_digest))
+    progress = PullProgress(logger, name)
+    events = docker_client.api.pull(repository,
+                                    tag=None if all_tags else tag,
+                                    all_tags=all_tags,
+                                    stream=True,
+                                    decode=True)
+    for event in events:
+        progress.feed(event)
+    progress.log_progress()
+    result = progress.summary()
+    result['present'] = local_digests is not None
+    return result
+
+
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+
+def get_host_limit(docker_client, concurrency=PULL_CONCURRENCY):
+    """
+    Semaphore shared by all the pulls going to the same daemon with the
+    same concurrency.
+    """
+    key = (docker_client.api.base_url, concurrency)
+    with _host_limits_lock:
+        if key not in _host_limits:
+            _host_limits[key] = threading.BoundedSemaphore(concurrency)
+        return _host_limits[key]
+
+
+def pull_images(docker_client, names, logger, all_tags=False,
+                concurrency=PULL_CONCURRENCY):
+    """
+    Pull several images at once, at most concurrency at a time for the
+    daemon. Returns a dict of image name to pull result.
+    """
+    limit = get_host_limit(docker_client, concurrency)
+
+    def _pull(name):
+        return pull_image(docker_client, name, logger, all_tags, limit)
+
+    results = {}
+    errors = {}
+    workers = max(1, min(concurrency, len(names)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((name, executor.submit(_pull, name))
+                       for name in names)
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                errors[name] = str(e)
+    if errors:
+        raise NonRecoverableError("Failed to pull images: {0}".format(
+            errors))
+    return results
+
+
+_END = object()
+
+
+class StreamTee(object):
+    """
+    Reads a stream once and hands every chunk to several consumers through
+    bounded queues, so the slowest consumer sets the pace and nothing is
+    buffered on disk. A consumer that gives up stops receiving chunks.
+    """
+
+    def __init__(self, source, consumers, maxsize=TEE_QUEUE_SIZE):
+        self.source = source
+        self._queues = [queue.Queue(maxsize) for _ in range(consumers)]
+        self._done = [False] * consumers
+
+    def _put(self, index, item):
+        while not self._done[index]:
+            try:
+                self._queues[index].put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def run(self):
+        end = _END
+        try:
+            for chunk in self.source:
+                if all(self._done):
+                    break
+                for index in range(len(self._queues)):
+                    self._put(index, chunk)
+        except Exception as e:
+            end = e
+        finally:
+            for index in range(len(self._queues)):
+                self._put(index, end)
+
+    def abandon(self, index):
+        """Stop feeding consumer index, it won't read any more."""
+        self._done[index] = True
+
+    def consumer(self, index):
+        try:
+            while True:
+                item = self._queues[index].get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.abandon(index)
+
+
+def gzip_stream(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class ApiTarget(object):
+    """Docker host reached through its REST API."""
+
+    def __init__(self, client_config):
+        self.client_config = client_config
+        if client_config.get('docker_host'):
+            self.name = '{0}:{1}'.format(
+                client_config['docker_host'],
+                client_config.get('docker_rest_port', ''))
+        else:
+            self.name = client_config.get('docker_sock_file')
+
+    def image_id(self, name):
+        with docker_client_from_config(self.client_config) as client:
+            try:
+                return client.images.get(name).id
+            except ImageNotFound:
+                return None
+
+    def load(self, chunks):
+        with docker_client_from_config(self.client_config) as client:
+            for event in client.api.load_image(chunks) or []:
+                if 'error' in event:
+                    raise NonRecoverableError(event['error'])
+
+
+class SshTarget(object):
+    """
+    Docker host reached over SSH, connect is a context manager factory
+    returning a fabric connection, images are piped to `docker load`.
+    """
+
+    def __init__(self, name, connect, use_sudo=True):
+        self.name = name
+        self.connect = connect
+        self.sudo = 'sudo ' if use_sudo else ''
+
+    def image_id(self, name):
+        with self.connect() as conn:
+            result = conn.run(
+                "{0}docker image inspect --format '{{{{.Id}}}}' {1}".format(
+                    self.sudo, name), hide=True, warn=True)
+        if result.ok:
+            return result.stdout.strip()
+        return None
+
+    def load(self, chunks):
+        with self.connect() as conn:
+            conn.open()
+            channel = conn.client.get_transport().open_session()
+            try:
+                channel.exec_command('{0}docker load'.format(self.sudo))
+                for chunk in chunks:
+                    channel.sendall(chunk)
+                channel.shutdown_write()
+                output = channel.makefile('rb').read()
+                error = channel.makefile_stderr('rb').read()
+                status = channel.recv_exit_status()
+            finally:
+                channel.close()
+        if status != 0:
+            raise NonRecoverableError("docker load failed: {0} {1}".format(
+                output.decode('utf-8', 'replace'),
+                error.decode('utf-8', 'replace')))
+
+
+def _load(tee, index, target):
+    try:
+        target.load(tee.consumer(index))
+    finally:
+        # release the tee even if the target failed before reading, the
+        # consumer of a target that never read can't do it when closed
+        tee.abandon(index)
+
+
+def target_keys(targets):
+    """Names of the targets, with the index of the ones sharing a name."""
+    names = [target.name for target in targets]
+    return ['{0}#{1}'.format(target_name, index)
+            if names.count(target_name) > 1 else target_name
+            for index, target_name in enumerate(names)]
+
+
+def distribute_image(docker_client, name, targets, logger, compress=False,
+                     concurrency=DISTRIBUTION_CONCURRENCY):
+    """
+    Stream `docker save` of name from docker_client into `docker load` on
+    every target that doesn't have it yet, concurrency targets per save
+    stream. Returns a dict of target key (see target_keys) to result.
+    """
+    image_id = docker_client.images.get(name).id
+    results = {}
+    pending = []
+    for key, target in zip(target_keys(targets), targets):
+        try:
+            target_image_id = target.image_id(name)
+        except Exception:
+            # let the load report why the target is unusable
+            target_image_id = None
+        if target_image_id == image_id:
+            logger.info("{0} already has {1}".format(key, name))
+            results[key] = {'status': 'skipped'}
+        else:
+            pending.append((key, target))
+
+    for start in range(0, len(pending), concurrency):
+        batch = pending[start:start + concurrency]
+        started = time.time()
+        logger.info("Sending {0} to {1}".format(
+            name, ', '.join(key for key, _ in batch)))
+        source = docker_client.api.get_image(
+            name, chunk_size=DISTRIBUTION_CHUNK_SIZE)
+        if compress:
+            source = gzip_stream(source)
+        tee = StreamTee(source, len(batch))
+        with ThreadPoolExecutor(max_workers=len(batch)) as executor:
+            futures = [executor.submit(_load, tee, index, target)
+                       for index, (_, target) in enumerate(batch)]
+            tee.run()
+            for (key, _), future in zip(batch, futures):
+                try:
+                    future.result()
+                    results[key] = {
+                        'status': 'loaded',
+                        'duration': round(time.time() - started, 3)}
+                except Exception as e:
+                    logger.error("Failed to load {0} on {1}: {2}".format(
+                        name, key, e))
+                    results[key] = {'status': 'failed', 'error': str(e)}
+    return results
+
+
+def distribute_images(docker_client, names, targets, logger, compress=False,
+                      concurrency=DISTRIBUTION_CONCURRENCY):
+    """
+    Distribute every image of names to the targets, returns a dict of
+    image name to the per target results of distribute_image.
+    """
+    return dict((name, distribute_image(docker_client, name, targets, logger,
+                                        compress, concurrency))
+                for name in names)
@@ -0,0 +1,311 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+import calendar
+
+from collections import OrderedDict
+
+from docker.errors import NotFound
+
+from .constants import INVENTORY_MAX_EVENTS, INVENTORY_MAX_EVENT_GAP
+
+IMAGES = 'images'
+CONTAINERS = 'containers'
+EVENT_TYPES = {IMAGES: 'image', CONTAINERS: 'container'}
+# the events that change what the compact summaries hold
+IMAGE_ACTIONS = ('delete', 'import', 'load', 'pull', 'tag', 'untag')
+CONTAINER_ACTIONS = ('create', 'destroy', 'start', 'stop', 'die', 'kill',
+                     'pause', 'unpause', 'rename', 'restart', 'oom',
+                     'update')
+# image filters that can be checked on an inspected image
+INCREMENTAL_IMAGE_FILTERS = ('dangling', 'label')
+
+
+def image_summary(image):
+    """Compact form of an image as returned by the images API."""
+    tags = [tag for tag in image.get('RepoTags') or []
+            if tag != '<none>:<none>']
+    return {
+        'id': image['Id'],
+        'tags': tags,
+        'size': image.get('Size', 0),
+        'created': image.get('Created', 0),
+    }
+
+
+def parse_created(created):
+    # inspect gives an RFC 3339 string, the list API a timestamp
+    if isinstance(created, (int, float)):
+        return int(created)
+    return calendar.timegm(time.strptime(created[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+def inspected_image_summary(image):
+    """Compact form of an image as returned by inspect."""
+    return image_summary({
+        'Id': image['Id'],
+        'RepoTags': image.get('RepoTags'),
+        'Size': image.get('Size', 0),
+        'Created': parse_created(image.get('Created', 0)),
+    })
+
+
+def container_summary(container):
+    """Compact form of a container as returned by the containers API."""
+    names = container.get('Names') or []
+    return {
+        'id': container['Id'],
+        'name': names[0].lstrip('/') if names else '',
+        'image': container.get('Image', ''),
+        'state': container.get('State', ''),
+        'status': container.get('Status', ''),
+        'created': container.get('Created', 0),
+    }
+
+
+class Inventory(object):
+    """
+    Compact images or containers of a docker host keyed by id, with lookup
+    by tag or name, stored as is in runtime properties. total is the
+    number of matches before pagination, None when it is not known.
+    """
+
+    def __init__(self, kind, items=None, total=None, last_event=None):
+        self.kind = kind
+        self.items = dict(items or {})
+        self.total = total
+        self.last_event = last_event
+
+    def _names(self, item):
+        if self.kind == IMAGES:
+            return item['tags']
+        return [item['name']]
+
+    def get(self, ref):
+        """Find an item by full or short id, tag or container name."""
+        if not ref:
+            return None
+        if ref in self.items:
+            return self.items[ref]
+        for item_id, item in self.items.items():
+            short_id = item_id.split(':', 1)[-1]
+            if ref in self._names(item) or short_id.startswith(ref):
+                return item
+        return None
+
+    def put(self, item):
+        if self.kind == IMAGES:
+            # a tag belongs to one image, take it from the previous one
+            for other in self.items.values():
+                if other['id'] != item['id']:
+                    other['tags'] = [tag for tag in other['tags']
+                                     if tag not in item['tags']]
+        self.items[item['id']] = item
+
+    def drop(self, ref):
+        item = self.get(ref)
+        if item:
+            self.items.pop(item['id'], None)
+
+    def __contains__(self, ref):
+        return self.get(ref) is not None
+
+    def __len__(self):
+        return len(self.items)
+
+    def to_dict(self):
+        return {'items': self.items,
+                'total': self.total,
+                'last_event': self.last_event}
+
+    @classmethod
+    def from_dict(cls, kind, value):
+        value = value or {}
+        return cls(kind, value.get('items'), value.get('total'),
+                   value.get('last_event'))
+
+
+def paginate(items, limit=0, offset=0):
+    """Newest first slice of items, limit 0 meaning all of them."""
+    items = sorted(items, key=lambda item: item['created'], reverse=True)
+    if limit:
+        return items[offset:offset + limit]
+    return items[offset:]
+
+
+def list_inventory(docker_client, kind, show_all=True, filters=None,
+                   limit=0, offset=0):
+    """
+    List images or containers with the filters applied by the daemon,
+    using the low level API so no per object inspect is done.
+    """
+    filters = dict(filters or {})
+    total_known = True
+    if kind == IMAGES:
+        items = [image_summary(image) for image in
+                 docker_client.api.images(all=show_all, filters=filters)]
+    else:
+        kwargs = {'all': show_all, 'filters': filters}
+        if limit and not offset:
+            # let the daemon cut the list, it returns the newest ones
+            kwargs['limit'] = limit
+            total_known = False
+        items = [container_summary(container) for container in
+                 docker_client.api.containers(**kwargs)]
+    page = paginate(items, limit, offset)
+    return Inventory(kind, dict((item['id'], item) for item in page),
+                     total=len(items) if total_known else None)
+
+
+def read_events(docker_client, since, until, event_type=None):
+    """Events of the daemon between since and until, both timestamps."""
+    filters = {'type': event_type} if event_type else None
+    events = docker_client.events(since=since, until=until, decode=True,
+                                  filters=filters)
+    try:
+        return list(events)
+    finally:
+        if hasattr(events, 'close'):
+            events.close()
+
+
+def _filter_values(value):
+    if isinstance(value, (list, tuple)):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+def image_matches(image, filters):
+    """Check the filters supported incrementally on an inspected image."""
+    if 'dangling' in filters:
+        dangling = _filter_values(filters['dangling'])[0].lower() in (
+            'true', '1')
+        if dangling == bool(image.get('RepoTags')):
+            return False
+    labels = (image.get('Config') or {}).get('Labels') or {}
+    for label in _filter_values(filters.get('label', [])):
+        key, _, value = label.partition('=')
+        if key not in labels or (value and labels[key] != value):
+            return False
+    return True
+
+
+def supports_incremental(kind, filters=None, limit=0, offset=0):
+    if limit or offset:
+        # the page content depends on everything else listed
+        return False
+    if kind == IMAGES:
+        return all(key in INCREMENTAL_IMAGE_FILTERS
+                   for key in filters or {})
+    return True
+
+
+def _changes(events, actions):
+    # last action per object, in the order they last changed
+    changes = OrderedDict()
+    for event in events:
+        action = event.get('Action') or event.get('status', '')
+        ref = event.get('Actor', {}).get('ID') or event.get('id')
+        if ref and action in actions:
+            changes.pop(ref, None)
+            changes[ref] = action
+    return changes
+
+
+def apply_events(docker_client, inventory, events, show_all=True,
+                 filters=None):
+    """Update inventory with what changed in events, returns the count."""
+    filters = dict(filters or {})
+    if inventory.kind == IMAGES:
+        changes = _changes(events, IMAGE_ACTIONS)
+        for ref, action in changes.items():
+            if action == 'delete':
+                inventory.drop(ref)
+                continue
+            try:
+                image = docker_client.api.inspect_image(ref)
+            except NotFound:
+                inventory.drop(ref)
+                continue
+            if image_matches(image, filters):
+                inventory.put(inspected_image_summary(image))
+            else:
+                inventory.drop(image['Id'])
+    else:
+        changes = _changes(events, CONTAINER_ACTIONS)
+        refresh = [ref for ref, action in changes.items()
+                   if action != 'destroy']
+        found = {}
+        if refresh:
+            filters['id'] = refresh
+            found = dict(
+                (container['Id'], container_summary(container))
+                for container in docker_client.api.containers(
+                    all=show_all, filters=filters))
+        for ref in changes:
+            if ref in found:
+                inventory.put(found[ref])
+            else:
+                # destroyed, or no longer matching the filters
+                inventory.drop(ref)
+    inventory.total = len(inventory)
+    return len(changes)
+
+
+def refresh_inventory(docker_client, inventory, kind, show_all=True,
+                      filters=None, limit=0, offset=0,
+                      max_gap=INVENTORY_MAX_EVENT_GAP, logger=None):
+    """
+    Bring inventory up to date with the events since its last refresh,
+    listing everything again when there is no usable previous inventory,
+    the gap is larger than max_gap or the daemon may have dropped events.
+    """
+    now = int(time.time())
+    reason = None
+    if inventory is None or inventory.last_event is None:
+        reason = 'no previous inventory'
+    elif now - inventory.last_event > max_gap:
+        reason = 'last refresh was {0}s ago'.format(
+            now - inventory.last_event)
+    elif not supports_incremental(kind, filters, limit, offset):
+        reason = 'filters or pagination need a full listing'
+    else:
+        events = read_events(docker_client, inventory.last_event, now,
+                             EVENT_TYPES[kind])
+        if len(events) >= INVENTORY_MAX_EVENTS:
+            reason = '{0} events since last refresh'.format(len(events))
+        else:
+            changed = apply_events(docker_client, inventory, events,
+                                   show_all, filters)
+            inventory.last_event = now
+            if logger:
+                logger.info("Applied {0} changes to {1} inventory".format(
+                    changed, kind))
+            return inventory
+    if logger:
+        logger.info("Full {0} listing: {1}".format(kind, reason))
+    inventory = list_inventory(docker_client, kind, show_all, filters,
+                               limit, offset)
+    # events from the start of the listing are applied on next refresh
+    inventory.last_event = now
+    return inventory
+
+
+def host_changed(docker_client, since, max_gap=INVENTORY_MAX_EVENT_GAP):
+    """Check if anything happened on the daemon since the timestamp."""
+    now = int(time.time())
+    if since is None or now - since > max_gap:
+        return True
+    return bool(read_events(docker_client, since, now))
@@ -0,0 +1,159 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import json
+import time
+import fcntl
+import hashlib
+import threading
+
+from contextlib import contextmanager
+
+from cloudify.exceptions import NonRecoverableError
+
+from .constants import LOCKS_DIR, SINGLE_FLIGHT_TIMEOUT
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+class Flight(object):
+    """
+    Holder of a single flight lock. result is what another caller
+    published while we were waiting for the lock, None if it is up to
+    us to do the work and publish its result.
+    """
+
+    def __init__(self, result_path, started):
+        self.result_path = result_path
+        self.started = started
+        self.result = None
+        self.waited = False
+
+    def load(self):
+        try:
+            with open(self.result_path, 'r') as f:
+                published = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if published.get('finished', 0) >= self.started:
+            self.result = published.get('result')
+
+    def publish(self, result):
+        tmp_path = '{0}.{1}.tmp'.format(self.result_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'finished': time.time(), 'result': result}, f)
+        os.rename(tmp_path, self.result_path)
+
+
+def _get_thread_lock(name):
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(name, threading.Lock())
+
+
+_last_sweep = [0]
+
+
+def _remove_stale_results(locks_dir, max_age):
+    """
+    Remove the results nobody can wait for anymore, a waiter only takes
+    a result finished after it started waiting, for at most max_age.
+    """
+    now = time.time()
+    if now - _last_sweep[0] < max_age / 10.0:
+        return
+    _last_sweep[0] = now
+    for name in os.listdir(locks_dir):
+        if not name.endswith(('.json', '.tmp')):
+            continue
+        path = os.path.join(locks_dir, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+def _lock_file(lock_path, key, base_url, started, timeout, flight):
+    """Open and flock lock_path, the one still on disk once locked."""
+    while True:
+        f = open(lock_path, 'a')
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError):
+                flight.waited = True
+                if time.time() - started > timeout:
+                    f.close()
+                    raise NonRecoverableError(
+                        "Timed out waiting for {0} on {1}".format(
+                            key, base_url))
+                time.sleep(0.5)
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(lock_path)):
+                return f
+        except OSError:
+            pass
+        # the holder before us removed it, lock the new one
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+
+@contextmanager
+def single_flight(base_url, key, timeout=SINGLE_FLIGHT_TIMEOUT):
+    """
+    Serialize the work on key for the docker daemon at base_url, across
+    threads and agent processes, so only one caller builds or pulls the
+    same thing at a time and the others can reuse its result. The lock
+    file goes away with its last holder and results once too old to be
+    waited for.
+    """
+    name = hashlib.sha1('{0}|{1}'.format(base_url, key).encode(
+        'utf-8')).hexdigest()
+    locks_dir = os.path.expanduser(LOCKS_DIR)
+    if not os.path.isdir(locks_dir):
+        try:
+            os.makedirs(locks_dir)
+        except OSError:
+            # created by someone else meanwhile
+            pass
+    started = time.time()
+    flight = Flight(os.path.join(locks_dir, name + '.json'), started)
+    thread_lock = _get_thread_lock(name)
+    if not thread_lock.acquire(False):
+        flight.waited = True
+        if not thread_lock.acquire(True, timeout):
+            raise NonRecoverableError(
+                "Timed out waiting for {0} on {1}".format(key, base_url))
+    try:
+        lock_path = os.path.join(locks_dir, name + '.lock')
+        f = _lock_file(lock_path, key, base_url, started, timeout, flight)
+        try:
+            if flight.waited:
+                flight.load()
+            yield flight
+        finally:
+            # while still locked, the next holder checks it's on disk
+            try:
+                os.unlink(lock_path)
+            except OSError:
+                pass
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+            _remove_stale_results(locks_dir,
+                                  max(timeout, SINGLE_FLIGHT_TIMEOUT))
+    finally:
+        thread_lock.release()
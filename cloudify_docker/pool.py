@@ -0,0 +1,260 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import json
+import time
+import shlex
+import hashlib
+
+from contextlib import contextmanager
+
+from docker.errors import NotFound
+
+from .locks import single_flight
+from .constants import (POOLS_DIR,
+                        POOL_SIZE,
+                        POOL_IDLE_TTL,
+                        POOL_MAX_REUSE,
+                        POOL_IDLE_COMMAND)
+
+POOL_LABEL = 'co.cloudify.docker.pool'
+# given to every job run in the container instead of to the container
+EXEC_OPTIONS = {'environment': 'environment',
+                'working_dir': 'workdir',
+                'user': 'user',
+                'privileged': 'privileged'}
+# not part of what makes pooled containers interchangeable
+JOB_OPTIONS = ('command', 'entrypoint', 'name', 'detach', 'auto_remove',
+               'remove', 'labels') + tuple(EXEC_OPTIONS)
+LIVE_STATES = ('running', 'paused')
+
+
+def pool_key(image_tag, container_args):
+    """Key of the containers that can run any job of these settings."""
+    settings = dict((key, value) for key, value in container_args.items()
+                    if key not in JOB_OPTIONS)
+    content = json.dumps({'image': image_tag, 'settings': settings},
+                         sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def job_command(docker_client, image_tag, container_args):
+    """Command line a one shot container would run, as a list."""
+    def as_list(value):
+        if not value:
+            return []
+        if isinstance(value, (list, tuple)):
+            return list(value)
+        return shlex.split(value)
+
+    entrypoint = as_list(container_args.get('entrypoint'))
+    command = as_list(container_args.get('command'))
+    image_config = docker_client.api.inspect_image(image_tag).get(
+        'Config') or {}
+    # like docker, a given entrypoint drops the image command too
+    if 'entrypoint' not in container_args:
+        entrypoint = as_list(image_config.get('Entrypoint'))
+        if 'command' not in container_args:
+            command = as_list(image_config.get('Cmd'))
+    return entrypoint + command
+
+
+def exec_options(container_args):
+    return dict((EXEC_OPTIONS[key], container_args[key])
+                for key in EXEC_OPTIONS if container_args.get(key))
+
+
+class WarmPool(object):
+    """
+    Pre-created containers of one image and settings on a docker host,
+    kept paused between jobs that run in them with docker exec. The pool
+    bookkeeping lives next to the other locks so all the agent processes
+    share it, docker stays the source of truth of what exists.
+    """
+
+    def __init__(self, docker_client, image_tag, container_args, logger,
+                 size=POOL_SIZE, idle_ttl=POOL_IDLE_TTL,
+                 max_reuse=POOL_MAX_REUSE, pause_idle=True,
+                 idle_command=POOL_IDLE_COMMAND):
+        self.docker_client = docker_client
+        self.image_tag = image_tag
+        self.container_args = container_args
+        self.logger = logger
+        self.size = size
+        self.idle_ttl = idle_ttl
+        self.max_reuse = max_reuse
+        self.pause_idle = pause_idle
+        self.idle_command = idle_command
+        self.key = pool_key(image_tag, container_args)
+        self.base_url = docker_client.api.base_url
+        state_name = hashlib.sha1('{0}|{1}'.format(
+            self.base_url, self.key).encode('utf-8')).hexdigest()
+        self.state_path = os.path.join(os.path.expanduser(POOLS_DIR),
+                                       state_name + '.json')
+
+    def _load(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, state):
+        pools_dir = os.path.dirname(self.state_path)
+        if not os.path.isdir(pools_dir):
+            os.makedirs(pools_dir)
+        tmp_path = '{0}.{1}.tmp'.format(self.state_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, self.state_path)
+
+    @contextmanager
+    def _state(self):
+        with single_flight(self.base_url, 'pool:{0}'.format(self.key)):
+            state = self._load()
+            yield state
+            self._save(state)
+
+    def _remove(self, container_id):
+        try:
+            self.docker_client.api.remove_container(container_id,
+                                                    force=True)
+        except NotFound:
+            pass
+
+    def _sync(self, state):
+        # called with the state locked, drops what docker doesn't run
+        # anymore and the containers idle for too long
+        live = dict(
+            (container['Id'], container['State']) for container in
+            self.docker_client.api.containers(
+                all=True,
+                filters={'label': '{0}={1}'.format(POOL_LABEL, self.key)}))
+        now = time.time()
+        for container_id in list(state):
+            if live.get(container_id) not in LIVE_STATES:
+                state.pop(container_id)
+        for container_id, container_state in live.items():
+            if container_state not in LIVE_STATES:
+                self._remove(container_id)
+                continue
+            entry = state.get(container_id)
+            if entry is None:
+                # the bookkeeping was lost, a paused one is surely idle
+                if container_state == 'paused':
+                    state[container_id] = {'uses': 0, 'in_use': False,
+                                           'idle_since': now}
+                continue
+            if not entry['in_use'] and \
+                    now - entry['idle_since'] > self.idle_ttl:
+                self.logger.debug("Removing idle pooled container "
+                                  "{0}".format(container_id))
+                self._remove(container_id)
+                state.pop(container_id)
+
+    def _create(self):
+        args = dict((key, value) for key, value in
+                    self.container_args.items() if key not in JOB_OPTIONS)
+        labels = self.container_args.get('labels') or {}
+        if isinstance(labels, (list, tuple)):
+            labels = dict((label, '') for label in labels)
+        labels = dict(labels)
+        labels[POOL_LABEL] = self.key
+        container = self.docker_client.containers.create(
+            image=self.image_tag,
+            entrypoint=self.idle_command,
+            labels=labels,
+            detach=True,
+            **args)
+        container.start()
+        return container.id
+
+    def _idle(self, state):
+        return [container_id for container_id, entry in state.items()
+                if not entry['in_use']]
+
+    def acquire(self):
+        """Claim an idle container, or create one, returns its id."""
+        with self._state() as state:
+            self._sync(state)
+            idle = sorted(self._idle(state),
+                          key=lambda cid: state[cid]['idle_since'])
+            container_id = idle[-1] if idle else None
+            if container_id:
+                # the most recently used one, the others can expire
+                state[container_id]['in_use'] = True
+        if container_id:
+            try:
+                self.docker_client.api.unpause(container_id)
+            except Exception:
+                # it was not paused
+                pass
+            self.logger.debug("Using pooled container {0}".format(
+                container_id))
+            return container_id
+        container_id = self._create()
+        with self._state() as state:
+            state[container_id] = {'uses': 0, 'in_use': True,
+                                   'idle_since': time.time()}
+        self.logger.debug("Created pooled container {0}".format(
+            container_id))
+        return container_id
+
+    def release(self, container_id, healthy=True):
+        """Give the container back, it is removed if it can't be reused."""
+        with self._state() as state:
+            entry = state.setdefault(container_id, {'uses': 0})
+            entry['uses'] += 1
+            entry['in_use'] = False
+            entry['idle_since'] = time.time()
+            keep = healthy and entry['uses'] < self.max_reuse and \
+                len(self._idle(state)) <= self.size
+            if keep and self.pause_idle:
+                try:
+                    self.docker_client.api.pause(container_id)
+                except Exception:
+                    keep = False
+            if not keep:
+                state.pop(container_id)
+        if not keep:
+            self._remove(container_id)
+
+    def fill(self):
+        """Pre-create idle containers until there are size of them."""
+        with self._state() as state:
+            self._sync(state)
+            missing = self.size - len(self._idle(state))
+        created = []
+        for _ in range(max(0, missing)):
+            container_id = self._create()
+            if self.pause_idle:
+                self.docker_client.api.pause(container_id)
+            created.append(container_id)
+        if created:
+            with self._state() as state:
+                for container_id in created:
+                    state[container_id] = {'uses': 0, 'in_use': False,
+                                           'idle_since': time.time()}
+        return len(created)
+
+    @contextmanager
+    def lease(self):
+        container_id = self.acquire()
+        healthy = False
+        try:
+            yield container_id
+            healthy = True
+        finally:
+            self.release(container_id, healthy)
@@ -0,0 +1,260 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import re
+import math
+import time
+import codecs
+import random
+import socket
+
+from docker.errors import APIError
+
+from cloudify.exceptions import NonRecoverableError
+
+from .events import watch_container_exit, container_exit_code
+from .streams import StreamDemuxer
+from .constants import (READINESS_TIMEOUT,
+                        READINESS_INITIAL_DELAY,
+                        READINESS_MAX_DELAY,
+                        READINESS_CONNECT_TIMEOUT)
+
+HEALTH_EVENT = 'health_status'
+
+
+def backoff_delays(initial=READINESS_INITIAL_DELAY,
+                   maximum=READINESS_MAX_DELAY):
+    """Exponential backoff with full jitter, so waiters don't align."""
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(maximum, initial * 2 ** attempt))
+        attempt += 1
+
+
+def docker_host(docker_client):
+    """Address of the docker host as seen from here."""
+    base_url = docker_client.api.base_url
+    if base_url.startswith('http+docker://'):
+        # unix socket or named pipe, the daemon is local
+        return '127.0.0.1'
+    return re.sub(r'^\w+://', '', base_url).split('/')[0].rsplit(':', 1)[0]
+
+
+def port_addresses(docker_client, info, port):
+    """
+    Where port of the container can be reached: its published bindings,
+    then the container addresses, which only work on the docker host.
+    """
+    if '/' not in str(port):
+        port = '{0}/tcp'.format(port)
+    network = info.get('NetworkSettings') or {}
+    addresses = []
+    for binding in (network.get('Ports') or {}).get(port) or []:
+        host_ip = binding.get('HostIp')
+        if not host_ip or host_ip in ('0.0.0.0', '::'):
+            host_ip = docker_host(docker_client)
+        addresses.append((host_ip, int(binding['HostPort'])))
+    container_port = int(port.split('/')[0])
+    ips = [network.get('IPAddress')] + [
+        settings.get('IPAddress') for settings in
+        (network.get('Networks') or {}).values()]
+    for ip in ips:
+        if ip and (ip, container_port) not in addresses:
+            addresses.append((ip, container_port))
+    return addresses
+
+
+def health_status(info):
+    """HEALTHCHECK status of the container, None if it has none."""
+    health = (info.get('State') or {}).get('Health')
+    return health.get('Status') if health else None
+
+
+class ReadinessGate(object):
+    """
+    Waits for a started container to be ready: healthy if it has a
+    HEALTHCHECK, a TCP port accepting connections and a line of its
+    output matching a pattern, whichever are asked for, all within one
+    deadline. Events and the output stream are followed where possible,
+    polling with backoff otherwise.
+    """
+
+    def __init__(self, docker_client, container_id, logger, health=None,
+                 port=None, log_pattern=None, timeout=READINESS_TIMEOUT,
+                 initial_delay=READINESS_INITIAL_DELAY,
+                 max_delay=READINESS_MAX_DELAY):
+        self.docker_client = docker_client
+        self.container_id = container_id
+        self.logger = logger
+        # None waits for the healthcheck only if there is one
+        self.health = health
+        self.port = port
+        self.log_pattern = re.compile(log_pattern) if log_pattern else None
+        self.timeout = timeout
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.deadline = None
+        self._exit_waiter = None
+
+    def _remaining(self):
+        return self.deadline - time.time()
+
+    def _timed_out(self, what):
+        return NonRecoverableError(
+            "Container {0} was not ready after {1}s, waiting for "
+            "{2}".format(self.container_id, self.timeout, what))
+
+    def _exited(self, exit_code):
+        return NonRecoverableError(
+            "Container {0} exited with {1} before it was ready".format(
+                self.container_id, exit_code))
+
+    def _check_running(self):
+        if not self._exit_waiter.is_set():
+            return
+        exit_code = container_exit_code(self.docker_client,
+                                        self.container_id)
+        if exit_code is not None:
+            raise self._exited(exit_code)
+
+    def _sleep(self, delay):
+        delay = min(delay, max(0, self._remaining()))
+        if self._exit_waiter.is_set():
+            # no exit events, _check_running inspects instead
+            time.sleep(delay)
+        else:
+            self._exit_waiter.wait(delay)
+        self._check_running()
+
+    def _poll(self, check, what):
+        delays = backoff_delays(self.initial_delay, self.max_delay)
+        while not check():
+            if self._remaining() <= 0:
+                raise self._timed_out(what)
+            self._sleep(next(delays))
+
+    def _inspect(self):
+        return self.docker_client.api.inspect_container(self.container_id)
+
+    def _wait_healthy(self, since):
+        info = self._inspect()
+        status = health_status(info)
+        if status is None:
+            if self.health:
+                raise NonRecoverableError(
+                    "Container {0} has no HEALTHCHECK to wait for".format(
+                        self.container_id))
+            return
+        if status == 'healthy':
+            return
+        self.logger.debug("Waiting for container {0} to be healthy".format(
+            self.container_id))
+        try:
+            # the daemon ends the stream at until, events since the start
+            # are replayed so a change after the inspect is not missed
+            events = self.docker_client.api.events(
+                since=int(since),
+                until=int(math.ceil(self.deadline)),
+                decode=True,
+                filters={'container': self.container_id,
+                         'event': [HEALTH_EVENT, 'die']})
+        except APIError:
+            events = None
+        if events is not None:
+            try:
+                for event in events:
+                    action = event.get('Action') or event.get('status', '')
+                    if action == 'die':
+                        raise self._exited(event.get('Actor', {}).get(
+                            'Attributes', {}).get('exitCode'))
+                    elif action == '{0}: healthy'.format(HEALTH_EVENT):
+                        return
+            finally:
+                events.close()
+            if health_status(self._inspect()) == 'healthy':
+                return
+            if self._remaining() <= 0:
+                raise self._timed_out('healthy status')
+        self._poll(lambda: health_status(self._inspect()) == 'healthy',
+                   'healthy status')
+
+    def _wait_log(self):
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        state = {'partial': '', 'matched': False}
+
+        def match(chunk):
+            if state['matched']:
+                return
+            lines = (state['partial'] + decoder.decode(chunk)).split('\n')
+            state['partial'] = lines[-1]
+            for line in lines:
+                if self.log_pattern.search(line):
+                    state['matched'] = True
+                    demuxer.stop()
+                    return
+
+        sock = self.docker_client.api.attach_socket(
+            self.container_id, params={'stdout': 1, 'stderr': 1,
+                                       'stream': 1, 'logs': 1})
+        tty = (self._inspect().get('Config') or {}).get('Tty', False)
+        demuxer = StreamDemuxer(sock, match, tty=tty)
+        try:
+            demuxer.run(max(0, self._remaining()))
+        finally:
+            demuxer.close()
+        if state['matched']:
+            return
+        self._check_running()
+        raise self._timed_out('output matching {0}'.format(
+            self.log_pattern.pattern))
+
+    def _connect(self):
+        addresses = port_addresses(self.docker_client, self._inspect(),
+                                   self.port)
+        for address in addresses:
+            try:
+                connection = socket.create_connection(
+                    address, timeout=min(READINESS_CONNECT_TIMEOUT,
+                                         max(0.1, self._remaining())))
+                connection.close()
+                self.logger.debug("Container {0} accepts connections on "
+                                  "{1}:{2}".format(self.container_id,
+                                                   *address))
+                return True
+            except OSError:
+                continue
+        return False
+
+    def wait(self, started=None):
+        """
+        Block until the container is ready, returns the seconds it took
+        since started, raises if it exits or the deadline passes first.
+        """
+        started = started or time.time()
+        self.deadline = started + self.timeout
+        self._exit_waiter = watch_container_exit(
+            self.docker_client, self.container_id, check_exited=True)
+        try:
+            self._check_running()
+            if self.health is not False:
+                self._wait_healthy(started)
+            if self.log_pattern:
+                self._wait_log()
+            if self.port:
+                self._poll(self._connect, 'port {0}'.format(self.port))
+        finally:
+            waiter = self._exit_waiter
+            if not waiter.is_set() and waiter.watcher:
+                waiter.watcher.unwatch(waiter)
+        return time.time() - started
@@ -0,0 +1,249 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import re
+import time
+import base64
+import uuid
+import shlex
+import codecs
+
+from collections import deque
+
+from cloudify.exceptions import NonRecoverableError
+
+from .constants import REMOTE_OUTPUT_TAIL_LINES, REMOTE_RECV_SIZE
+
+
+class RemoteScript(object):
+    """
+    Shell steps run as one generated script over a single ssh channel,
+    instead of a round trip and a sudo per command. Every step prints
+    markers with its exit code around its output, so a failure is put on
+    the step that caused it while the output streams back.
+    """
+
+    def __init__(self, logger, use_sudo=True, stop_on_error=True):
+        self.logger = logger
+        self.use_sudo = use_sudo
+        # otherwise the next steps run and failures are only logged
+        self.stop_on_error = stop_on_error
+        self.steps = []
+        self.unattributed = deque(maxlen=REMOTE_OUTPUT_TAIL_LINES)
+        # so the output of a step can't fake a marker
+        self.marker = '__step_{0}'.format(uuid.uuid4().hex)
+
+    def step(self, name, command):
+        self.steps.append((name, command))
+        return self
+
+    def parallel(self, name, commands):
+        """A step running commands in the background at once."""
+        lines = ['pids=""']
+        for command in commands:
+            lines.append('( {0} ) & pids="$pids $!"'.format(command))
+        lines.append('rc=0')
+        lines.append('for pid in $pids; do wait $pid || rc=$?; done')
+        lines.append('[ $rc -eq 0 ]')
+        return self.step(name, '\n'.join(lines))
+
+    def render(self):
+        lines = ['exec 2>&1']
+        for index, (name, command) in enumerate(self.steps):
+            lines.append("echo '{0} start {1}'".format(self.marker, index))
+            # the script itself comes on stdin, a step mustn't read it
+            lines.append('(\n{0}\n) < /dev/null'.format(command))
+            lines.append('rc=$?')
+            lines.append('echo "{0} end {1} $rc"'.format(self.marker, index))
+            if self.stop_on_error:
+                lines.append('[ $rc -eq 0 ] || exit $rc')
+        return '\n'.join(lines) + '\n'
+
+    @property
+    def command(self):
+        return 'sudo -n sh -s' if self.use_sudo else 'sh -s'
+
+    def _start(self, results, index):
+        name = self.steps[index][0]
+        self.logger.info("Step {0}/{1}: {2}".format(
+            index + 1, len(self.steps), name))
+        results[index] = {'name': name,
+                          'exit_code': None,
+                          'started': time.time(),
+                          'output': deque(maxlen=REMOTE_OUTPUT_TAIL_LINES)}
+        return results[index]
+
+    def _end(self, result, exit_code):
+        result['exit_code'] = exit_code
+        result['duration'] = round(time.time() - result.pop('started'), 3)
+        log = self.logger.info if not exit_code else self.logger.error
+        log("Step {0} exit_code {1} after {2}s".format(
+            result['name'], exit_code, result['duration']))
+
+    def _line(self, results, current, line):
+        if line.startswith(self.marker):
+            fields = line.split()
+            if fields[1] == 'start':
+                return self._start(results, int(fields[2]))
+            if current is not None:
+                self._end(current, int(fields[3]))
+            return None
+        if line:
+            self.logger.debug(line)
+        if current is not None:
+            current['output'].append(line)
+        elif line:
+            self.unattributed.append(line)
+        return current
+
+    def run(self, open_channel):
+        """
+        Run the steps on a channel from open_channel, paramiko's
+        Transport.open_session or anything with the same interface.
+        Returns the result of each step ran, raises on a failed one
+        unless stop_on_error is unset, and always when the script ended
+        before its last step.
+        """
+        results = [None] * len(self.steps)
+        current = None
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        partial = ''
+        channel = open_channel()
+        try:
+            channel.set_combine_stderr(True)
+            channel.exec_command(self.command)
+            channel.sendall(self.render().encode('utf-8'))
+            channel.shutdown_write()
+            while True:
+                data = channel.recv(REMOTE_RECV_SIZE)
+                text = partial + decoder.decode(data, not data)
+                lines = text.split('\n')
+                partial = lines.pop() if data else ''
+                for line in lines:
+                    current = self._line(results, current,
+                                         line.rstrip('\r'))
+                if not data:
+                    break
+            exit_status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        results = [result for result in results if result]
+        for result in results:
+            result['output'] = '\n'.join(result['output'])
+            if 'started' in result:
+                # the script ended in the middle of the step
+                self._end(result, exit_status or None)
+        failed = [result for result in results if result['exit_code']]
+        if failed:
+            message = "Remote script failed with {0} at step {1}:\n{2}".format(
+                exit_status, failed[0]['name'], failed[0]['output'])
+            if self.stop_on_error:
+                raise NonRecoverableError(message)
+            self.logger.error(message)
+        elif len(results) < len(self.steps) or exit_status or \
+                any(result['exit_code'] is None for result in results):
+            # even with a 0 exit status, the steps after didn't run
+            raise NonRecoverableError(
+                "Remote script ended with {0} after {1} of {2} steps:\n"
+                "{3}".format(exit_status, len(results), len(self.steps),
+                             '\n'.join(self.unattributed)))
+        return results
+
+
+PROBE_SCRIPT = """user={user}
+echo "docker_version $(docker --version 2> /dev/null)"
+if systemctl is-active --quiet docker 2> /dev/null || \\
+        pgrep -x dockerd > /dev/null 2>&1; then
+    echo "daemon active"
+else
+    echo "daemon inactive"
+fi
+echo "groups $(id -nG "$user" 2> /dev/null)"
+if [ -r /etc/os-release ]; then
+    sed 's/^/os_release /' /etc/os-release
+fi
+exit 0
+"""
+
+DOCKER_VERSION = re.compile(r'Docker version ([^\s,]+)')
+
+
+def probe_script(user):
+    """Read only and safe to repeat, every check of the host at once."""
+    return PROBE_SCRIPT.format(user=shlex.quote(user))
+
+
+def inline_script(script, command='sh -s'):
+    """
+    One line piping script to command, for the runners that quote or
+    escape what they run. Only base64 characters go through them.
+    """
+    encoded = base64.b64encode(script.encode('utf-8')).decode('ascii')
+    return 'echo {0} | base64 -d | {1}'.format(encoded, command)
+
+
+def run_script(open_channel, command, script):
+    """Pipe script to command on one channel, returns all its output."""
+    output = []
+    channel = open_channel()
+    try:
+        channel.set_combine_stderr(True)
+        channel.exec_command(command)
+        channel.sendall(script.encode('utf-8'))
+        channel.shutdown_write()
+        while True:
+            data = channel.recv(REMOTE_RECV_SIZE)
+            if not data:
+                break
+            output.append(data)
+        channel.recv_exit_status()
+    finally:
+        channel.close()
+    return b''.join(output).decode('utf-8', 'replace')
+
+
+def parse_probe(output):
+    probe = {'docker_version': '',
+             'daemon': 'inactive',
+             'groups': [],
+             'os_release': {}}
+    for line in output.splitlines():
+        key, _, value = line.strip().partition(' ')
+        if key == 'docker_version':
+            version = DOCKER_VERSION.search(value)
+            probe['docker_version'] = version.group(1) if version else ''
+        elif key == 'daemon':
+            probe['daemon'] = value
+        elif key == 'groups':
+            probe['groups'] = value.split()
+        elif key == 'os_release' and '=' in value:
+            name, _, field = value.partition('=')
+            probe['os_release'][name] = field.strip('"\'')
+    return probe
+
+
+def install_reason(probe, user, docker_version=''):
+    """Why docker has to be installed on the probed host, None if not."""
+    installed = probe.get('docker_version')
+    if not installed:
+        return "docker is not installed"
+    if docker_version and installed != docker_version and \
+            not installed.startswith('{0}.'.format(docker_version)):
+        return "docker {0} is installed instead of {1}".format(
+            installed, docker_version)
+    if probe.get('daemon') != 'active':
+        return "the docker daemon is not running"
+    if 'docker' not in probe.get('groups', []):
+        return "{0} is not in the docker group".format(user)
+    return None
@@ -0,0 +1,133 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from docker.errors import NotFound
+
+from cloudify.exceptions import NonRecoverableError
+
+from .events import watch_container_exit, wait_for_exit
+from .constants import REPLICA_CONCURRENCY
+
+
+def replica_name(name, index):
+    if not name:
+        return None
+    return '{0}-{1}'.format(name, index)
+
+
+class ReplicaSet(object):
+    """
+    Creates and starts the replicas of a container concurrently, keeping
+    track of every container created so they can be rolled back.
+    """
+
+    def __init__(self, docker_client, image_tag, container_args, logger):
+        self.docker_client = docker_client
+        self.image_tag = image_tag
+        self.container_args = container_args
+        self.logger = logger
+        self.created = []
+        self._lock = threading.Lock()
+
+    def _start(self, index):
+        args = dict(self.container_args)
+        if args.get('name'):
+            args['name'] = replica_name(args['name'], index)
+        container = self.docker_client.containers.create(
+            image=self.image_tag, **args)
+        replica = {
+            'id': container.id,
+            'name': container.name,
+            'state': 'created',
+            'exit_code': None,
+        }
+        with self._lock:
+            self.created.append(replica)
+        exit_waiter = None
+        if not args.get('detach', False):
+            exit_waiter = watch_container_exit(self.docker_client,
+                                               container.id)
+        container.start()
+        if not exit_waiter:
+            container.reload()
+            replica['state'] = container.status
+            self.logger.info("Replica {0} is {1}".format(
+                replica['name'], replica['state']))
+        return replica, container, exit_waiter
+
+    def _wait(self, replica, container, exit_waiter):
+        exit_code = wait_for_exit(self.docker_client, exit_waiter,
+                                  timeout=None)
+        if exit_code is None:
+            # no exit event, ask the daemon to wait for it
+            exit_code = container.wait()['StatusCode']
+        replica['exit_code'] = exit_code
+        replica['state'] = 'exited'
+        self.logger.info("Replica {0} exited with {1}".format(
+            replica['name'], exit_code))
+
+    def rollback(self):
+        for replica in self.created:
+            try:
+                self.docker_client.api.remove_container(replica['id'],
+                                                        force=True)
+                self.logger.info("Removed replica {0}".format(
+                    replica['name']))
+            except NotFound:
+                pass
+            except Exception as e:
+                self.logger.error("Failed to remove replica {0}: {1}".format(
+                    replica['name'], e))
+
+    def run(self, replicas, concurrency=REPLICA_CONCURRENCY):
+        """
+        Create and start replicas containers, at most concurrency at a
+        time, then wait for the ones not detached to exit. If any of them
+        fails the ones created are removed.
+        """
+        errors = []
+        started = []
+        with ThreadPoolExecutor(
+                max_workers=max(1, min(concurrency, replicas))) as executor:
+            futures = [executor.submit(self._start, index)
+                       for index in range(replicas)]
+            for index, future in enumerate(futures):
+                try:
+                    started.append(future.result())
+                except Exception as e:
+                    errors.append("replica {0}: {1}".format(index, e))
+        if not errors:
+            # all of them run by now, the exits come in any order
+            for index, (replica, container, exit_waiter) in \
+                    enumerate(started):
+                if not exit_waiter:
+                    continue
+                try:
+                    self._wait(replica, container, exit_waiter)
+                except Exception as e:
+                    errors.append("replica {0}: {1}".format(index, e))
+        if errors:
+            for _, _, exit_waiter in started:
+                if exit_waiter and exit_waiter.watcher:
+                    exit_waiter.watcher.unwatch(exit_waiter)
+            self.logger.error("Failed to create {0} of {1} replicas, "
+                              "rolling back".format(len(errors), replicas))
+            self.rollback()
+            raise NonRecoverableError(
+                "Failed to create replicas: {0}".format(', '.join(errors)))
+        return [replica for replica, _, _ in started]
@@ -0,0 +1,244 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import os
+import time
+import stat
+import atexit
+import hashlib
+import posixpath
+import threading
+
+from contextlib import contextmanager
+
+import paramiko
+
+from cloudify.exceptions import NonRecoverableError
+
+from .constants import (SSH_MAX_PER_HOST,
+                        SSH_IDLE_TIMEOUT,
+                        SSH_KEEPALIVE_INTERVAL)
+
+try:
+    from fabric import Connection, Config
+
+    class PooledConnection(Connection):
+        """A connection the pool closes, leaving a with block keeps it."""
+
+        def __exit__(self, *exc_info):
+            pass
+
+except ImportError:
+    PooledConnection = Config = None
+
+KEY_TYPES = [getattr(paramiko, name) for name in
+             ('Ed25519Key', 'ECDSAKey', 'RSAKey', 'DSSKey')
+             if hasattr(paramiko, name)]
+
+
+def load_private_key(content):
+    """Parse the content of a private key, it never touches the disk."""
+    for key_type in KEY_TYPES:
+        try:
+            return key_type.from_private_key(io.StringIO(content))
+        except (paramiko.SSHException, ValueError):
+            continue
+    raise NonRecoverableError("Unsupported or invalid private key")
+
+
+def key_fingerprint(key):
+    return hashlib.sha256(key.asbytes()).hexdigest()
+
+
+class _Idle(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.idle_since = time.time()
+
+
+class SshConnectionPool(object):
+    """
+    Process wide pool of ssh connections keyed by host, user and key
+    fingerprint, so the operations that go to the same docker host reuse
+    an open session instead of a new handshake each. At most
+    max_per_host connections to a host are borrowed at a time.
+    """
+
+    def __init__(self, max_per_host=SSH_MAX_PER_HOST,
+                 idle_timeout=SSH_IDLE_TIMEOUT,
+                 keepalive=SSH_KEEPALIVE_INTERVAL):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._keys = {}
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _evict(self):
+        # called with the lock held, returns the connections to close
+        now = time.time()
+        evicted = []
+        for key, idle in list(self._idle.items()):
+            keep = [entry for entry in idle
+                    if now - entry.idle_since <= self.idle_timeout]
+            evicted.extend(entry.connection for entry in idle
+                           if entry not in keep)
+            if keep:
+                self._idle[key] = keep
+            else:
+                self._idle.pop(key)
+        return evicted
+
+    def _connect_kwargs(self, private_key):
+        try:
+            is_file_path = os.path.exists(private_key)
+        except (TypeError, ValueError):
+            is_file_path = False
+        if is_file_path:
+            # rsync can use it too
+            return 'file:{0}'.format(os.path.abspath(private_key)), \
+                {'key_filename': private_key}
+        digest = hashlib.sha256(private_key.encode('utf-8')).hexdigest()
+        with self._lock:
+            pkey = self._keys.get(digest)
+        if pkey is None:
+            pkey = load_private_key(private_key)
+            with self._lock:
+                self._keys[digest] = pkey
+        return key_fingerprint(pkey), {'pkey': pkey}
+
+    def _slot(self, host):
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(
+                    self.max_per_host)
+            return self._slots[host]
+
+    def _checkout(self, key):
+        with self._lock:
+            evicted = self._evict()
+            idle = self._idle.get(key) or []
+            entry = idle.pop() if idle else None
+        for connection in evicted:
+            self._close(connection)
+        if entry and not entry.connection.is_connected:
+            self._close(entry.connection)
+            entry = None
+        return entry.connection if entry else None
+
+    def _open(self, host, user, connect_kwargs):
+        connection = PooledConnection(
+            host=host, user=user, connect_kwargs=connect_kwargs,
+            config=Config(overrides={'run': {'warn': True}}))
+        connection.open()
+        if self.keepalive:
+            connection.transport.set_keepalive(self.keepalive)
+        return connection
+
+    @contextmanager
+    def borrow(self, host, user, private_key):
+        if PooledConnection is None:
+            raise NonRecoverableError("ssh connections require fabric 2")
+        fingerprint, connect_kwargs = self._connect_kwargs(private_key)
+        key = (host, user, fingerprint)
+        slot = self._slot(host)
+        slot.acquire()
+        try:
+            connection = self._checkout(key) or \
+                self._open(host, user, connect_kwargs)
+            healthy = False
+            try:
+                yield connection
+                healthy = True
+            finally:
+                if healthy and connection.is_connected:
+                    with self._lock:
+                        self._idle.setdefault(key, []).append(
+                            _Idle(connection))
+                else:
+                    self._close(connection)
+        finally:
+            slot.release()
+
+    def close(self):
+        with self._lock:
+            idle = [entry for entries in self._idle.values()
+                    for entry in entries]
+            self._idle.clear()
+            self._keys.clear()
+        for entry in idle:
+            self._close(entry.connection)
+
+    def __len__(self):
+        return sum(len(idle) for idle in self._idle.values())
+
+
+SSH_CONNECTIONS = SshConnectionPool()
+
+
+def close_ssh_connections():
+    SSH_CONNECTIONS.close()
+
+
+atexit.register(close_ssh_connections)
+
+
+def _is_remote_dir(sftp, path):
+    try:
+        return stat.S_ISDIR(sftp.stat(path).st_mode)
+    except IOError:
+        return False
+
+
+def _put_file(sftp, source, target):
+    sftp.put(source, target)
+    info = os.stat(source)
+    sftp.chmod(target, stat.S_IMODE(info.st_mode))
+    sftp.utime(target, (info.st_atime, info.st_mtime))
+
+
+def sftp_put(connection, source, target, exclude=('.git',)):
+    """
+    Upload source like rsync -r would, a directory goes in target and a
+    file in it or over it, for the connections with in memory keys rsync
+    can't use.
+    """
+    sftp = connection.sftp()
+    if not os.path.isdir(source):
+        if _is_remote_dir(sftp, target):
+            target = posixpath.join(target, os.path.basename(source))
+        _put_file(sftp, source, target)
+        return
+    root = posixpath.join(target, os.path.basename(source.rstrip('/')))
+    for dirpath, dirnames, filenames in os.walk(source):
+        dirnames[:] = [name for name in dirnames if name not in exclude]
+        relative = os.path.relpath(dirpath, source)
+        remote_dir = root if relative == '.' else posixpath.join(
+            root, *relative.split(os.sep))
+        if not _is_remote_dir(sftp, remote_dir):
+            sftp.mkdir(remote_dir)
+        for name in filenames:
+            if name not in exclude:
+                _put_file(sftp, os.path.join(dirpath, name),
+                          posixpath.join(remote_dir, name))
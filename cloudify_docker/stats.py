@@ -0,0 +1,294 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import re
+import time
+import calendar
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cloudify.exceptions import NonRecoverableError
+
+from .constants import STATS_WINDOW, STATS_MAX_CONTAINERS
+
+TIMESTAMP_RE = re.compile(
+    r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(\.\d+)?')
+METRICS = ('cpu_percent', 'memory_usage', 'memory_percent',
+           'network_rx_rate', 'network_tx_rate',
+           'block_read_rate', 'block_write_rate')
+
+
+class P2Quantile(object):
+    """
+    Streaming estimate of the p quantile with the P-square algorithm,
+    five markers instead of the raw samples.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.heights = []
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, p / 2.0, p, (1 + p) / 2.0, 1]
+
+    def _parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / float(n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / float(
+                n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / float(
+                n[i] - n[i - 1]))
+
+    def _linear(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d * (q[i + d] - q[i]) / float(n[i + d] - n[i])
+
+    def add(self, x):
+        q, n = self.heights, self.positions
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or \
+                    (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = self._linear(i, d)
+                q[i] = height
+                n[i] += d
+
+    @property
+    def value(self):
+        if not self.heights:
+            return None
+        if len(self.heights) < 5:
+            index = int(round(self.p * (len(self.heights) - 1)))
+            return self.heights[index]
+        return self.heights[2]
+
+
+class OnlineStats(object):
+    """min, avg, p95 and max of a metric, updated one sample at a time."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.p95 = P2Quantile(0.95)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.p95.add(value)
+
+    def summary(self):
+        if not self.count:
+            return None
+        return {
+            'min': round(self.min, 3),
+            'avg': round(self.total / self.count, 3),
+            'p95': round(self.p95.value, 3),
+            'max': round(self.max, 3),
+        }
+
+
+def parse_timestamp(value):
+    """Seconds since epoch of a docker RFC 3339 timestamp, None if unset."""
+    match = TIMESTAMP_RE.match(value or '')
+    if not match or match.group(1).startswith('0001'):
+        return None
+    seconds = calendar.timegm(time.strptime(match.group(1),
+                                            '%Y-%m-%dT%H:%M:%S'))
+    return seconds + float(match.group(2) or 0)
+
+
+def cpu_percent(sample):
+    cpu = sample.get('cpu_stats') or {}
+    precpu = sample.get('precpu_stats') or {}
+    if not precpu.get('system_cpu_usage'):
+        # the first sample has nothing to compare to
+        return None
+    cpu_delta = cpu.get('cpu_usage', {}).get('total_usage', 0) - \
+        precpu.get('cpu_usage', {}).get('total_usage', 0)
+    system_delta = cpu.get('system_cpu_usage', 0) - \
+        precpu['system_cpu_usage']
+    if cpu_delta < 0 or system_delta <= 0:
+        return None
+    online_cpus = cpu.get('online_cpus') or \
+        len(cpu.get('cpu_usage', {}).get('percpu_usage') or []) or 1
+    return cpu_delta / float(system_delta) * online_cpus * 100
+
+
+def memory_usage(sample):
+    memory = sample.get('memory_stats') or {}
+    if 'usage' not in memory:
+        return None, None
+    stats = memory.get('stats') or {}
+    # same as docker stats, page cache is not counted
+    cache = stats.get('inactive_file',
+                      stats.get('total_inactive_file',
+                                stats.get('cache', 0)))
+    usage = memory['usage'] - cache
+    limit = memory.get('limit')
+    return usage, usage * 100.0 / limit if limit else None
+
+
+def network_bytes(sample):
+    rx = tx = 0
+    for interface in (sample.get('networks') or {}).values():
+        rx += interface.get('rx_bytes', 0)
+        tx += interface.get('tx_bytes', 0)
+    return rx, tx
+
+
+def block_bytes(sample):
+    read = write = 0
+    blkio = sample.get('blkio_stats') or {}
+    for entry in blkio.get('io_service_bytes_recursive') or []:
+        op = entry.get('op', '').lower()
+        if op == 'read':
+            read += entry.get('value', 0)
+        elif op == 'write':
+            write += entry.get('value', 0)
+    return read, write
+
+
+class UsageSampler(object):
+    """Aggregates the stats stream of one container as it arrives."""
+
+    def __init__(self):
+        self.metrics = dict((name, OnlineStats()) for name in METRICS)
+        self.samples = 0
+        self._previous = None
+
+    def _rates(self, sample, read_at):
+        counters = network_bytes(sample) + block_bytes(sample)
+        previous, self._previous = self._previous, (read_at, counters)
+        if not previous or read_at is None or previous[0] is None:
+            return
+        elapsed = read_at - previous[0]
+        if elapsed <= 0:
+            return
+        names = ('network_rx_rate', 'network_tx_rate',
+                 'block_read_rate', 'block_write_rate')
+        for name, current, last in zip(names, counters, previous[1]):
+            if current >= last:
+                self.metrics[name].add((current - last) / elapsed)
+
+    def feed(self, sample):
+        self.samples += 1
+        cpu = cpu_percent(sample)
+        if cpu is not None:
+            self.metrics['cpu_percent'].add(cpu)
+        usage, percent = memory_usage(sample)
+        if usage is not None:
+            self.metrics['memory_usage'].add(usage)
+        if percent is not None:
+            self.metrics['memory_percent'].add(percent)
+        self._rates(sample, parse_timestamp(sample.get('read')))
+
+    def summary(self):
+        summary = dict((name, stats.summary())
+                       for name, stats in self.metrics.items())
+        summary['samples'] = self.samples
+        return summary
+
+
+def sample_container(docker_client, container_id, window=STATS_WINDOW,
+                     deadline=None):
+    """
+    Follow the stats stream of container_id for window seconds, or until
+    deadline when several containers share the same window.
+    """
+    sampler = UsageSampler()
+    deadline = deadline or time.time() + window
+    stream = docker_client.api.stats(container_id, stream=True,
+                                     decode=True)
+    try:
+        for sample in stream:
+            sampler.feed(sample)
+            if time.time() >= deadline:
+                break
+    finally:
+        if hasattr(stream, 'close'):
+            stream.close()
+    return sampler.summary()
+
+
+def host_summary(usage, info=None):
+    """Sum the container averages, to compare with the host capacity."""
+    info = info or {}
+    summary = {
+        'cpus': info.get('NCPU'),
+        'memory': info.get('MemTotal'),
+        'cpu_percent': 0,
+        'memory_usage': 0,
+    }
+    for container in usage.values():
+        for name in ('cpu_percent', 'memory_usage'):
+            if container.get(name):
+                summary[name] += container[name]['avg']
+    summary['cpu_percent'] = round(summary['cpu_percent'], 3)
+    return summary
+
+
+def sample_containers(docker_client, containers, window=STATS_WINDOW,
+                      logger=None):
+    """
+    Sample all the containers at once, one stream each over the same
+    window so they can be compared, the client should have a connection
+    pool as large. Returns a dict of container name to usage summary, or
+    error if it could not be read.
+    """
+    if len(containers) > STATS_MAX_CONTAINERS:
+        raise NonRecoverableError(
+            "Can't sample {0} containers at once, at most {1}".format(
+                len(containers), STATS_MAX_CONTAINERS))
+    if not containers:
+        return {}
+    deadline = time.time() + window
+    usage = {}
+    with ThreadPoolExecutor(max_workers=len(containers)) as executor:
+        futures = dict(
+            (name, executor.submit(sample_container, docker_client,
+                                   container_id, window, deadline))
+            for name, container_id in containers.items())
+        for name, future in futures.items():
+            try:
+                usage[name] = future.result()
+            except Exception as e:
+                if logger:
+                    logger.error("Failed to sample {0}: {1}".format(name, e))
+                usage[name] = {'error': str(e)}
+    return usage
@@ -0,0 +1,304 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import ssl
+import time
+import codecs
+import socket
+import struct
+import selectors
+
+from .constants import (LOG_HEAD_SIZE,
+                        LOG_TAIL_SIZE,
+                        LOG_MAX_LINE,
+                        LOG_BATCH_LINES,
+                        LOG_BATCH_INTERVAL,
+                        STREAM_BUFFER_SIZE)
+
+STDIN, STDOUT, STDERR = 0, 1, 2
+# stream type, 3 bytes of padding and the big endian payload size
+FRAME_HEADER = struct.Struct('>BxxxL')
+
+
+class OutputBuffer(object):
+    """
+    Keeps the first head_size bytes and the last tail_size bytes written
+    to it, the tail lives in a preallocated ring so memory stays constant
+    no matter how much output goes through.
+    """
+
+    def __init__(self, head_size=LOG_HEAD_SIZE, tail_size=LOG_TAIL_SIZE):
+        self.head_size = head_size
+        self.tail_size = tail_size
+        self._head = bytearray(head_size)
+        self._head_len = 0
+        self._tail = bytearray(tail_size)
+        self._tail_pos = 0
+        self._tail_len = 0
+        self.total = 0
+
+    def write(self, data):
+        data = memoryview(data)
+        self.total += len(data)
+        if self._head_len < self.head_size:
+            count = min(len(data), self.head_size - self._head_len)
+            self._head[self._head_len:self._head_len + count] = data[:count]
+            self._head_len += count
+            data = data[count:]
+        if not self.tail_size or not len(data):
+            return
+        if len(data) >= self.tail_size:
+            self._tail[:] = data[len(data) - self.tail_size:]
+            self._tail_pos = 0
+            self._tail_len = self.tail_size
+            return
+        first = min(len(data), self.tail_size - self._tail_pos)
+        self._tail[self._tail_pos:self._tail_pos + first] = data[:first]
+        rest = len(data) - first
+        if rest:
+            self._tail[:rest] = data[first:]
+        self._tail_pos = (self._tail_pos + len(data)) % self.tail_size
+        self._tail_len = min(self.tail_size, self._tail_len + len(data))
+
+    @property
+    def skipped(self):
+        return self.total - self._head_len - self._tail_len
+
+    def tail(self):
+        if self._tail_len < self.tail_size:
+            return bytes(self._tail[:self._tail_len])
+        return bytes(self._tail[self._tail_pos:] +
+                     self._tail[:self._tail_pos])
+
+    def getvalue(self):
+        value = bytes(self._head[:self._head_len])
+        if self.skipped:
+            value += '\n... [{0} bytes skipped] ...\n'.format(
+                self.skipped).encode('utf-8')
+        return value + self.tail()
+
+
+class LineBatcher(object):
+    """
+    Decodes output incrementally into lines and hands them to the logger
+    in batches, at most one call every interval seconds and max_lines
+    lines per call, the rest is only counted.
+    """
+
+    def __init__(self, log, interval=LOG_BATCH_INTERVAL,
+                 max_lines=LOG_BATCH_LINES, prefix=''):
+        self.log = log
+        self.interval = interval
+        self.max_lines = max_lines
+        self.prefix = prefix
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        self._partial = ''
+        self._lines = []
+        self._dropped = 0
+        self._last_flush = time.time()
+
+    def feed(self, data):
+        text = self._partial + self._decoder.decode(data)
+        lines = text.split('\n')
+        self._partial = lines.pop()
+        if len(self._partial) > LOG_MAX_LINE:
+            # don't let a line without new lines grow forever
+            lines.append(self._partial)
+            self._partial = ''
+        for line in lines:
+            if len(self._lines) < self.max_lines:
+                self._lines.append(line.rstrip('\r'))
+            else:
+                self._dropped += 1
+        self.tick()
+
+    def tick(self):
+        """Flush if the interval passed, called when no output comes too."""
+        if time.time() - self._last_flush >= self.interval:
+            self.flush()
+
+    def flush(self, final=False):
+        if final:
+            self._partial += self._decoder.decode(b'', True)
+            if self._partial:
+                if len(self._lines) < self.max_lines:
+                    self._lines.append(self._partial)
+                else:
+                    self._dropped += 1
+                self._partial = ''
+        self._last_flush = time.time()
+        if not (self._lines or self._dropped):
+            return
+        message = '\n'.join(self._lines)
+        if self._dropped:
+            message += '\n... [{0} lines not shown]'.format(self._dropped)
+        self.log('{0}{1}'.format(self.prefix, message))
+        self._lines = []
+        self._dropped = 0
+
+
+class LogFollower(object):
+    """
+    Consumes a docker log stream keeping a bounded copy of the output
+    while forwarding its lines to the logger, and the full output to the
+    optional sink.
+    """
+
+    def __init__(self, log, head_size=LOG_HEAD_SIZE,
+                 tail_size=LOG_TAIL_SIZE, prefix='', sink=None):
+        self.buffer = OutputBuffer(head_size, tail_size)
+        self.batcher = LineBatcher(log, prefix=prefix)
+        self.sink = sink
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        self.buffer.write(chunk)
+        if self.sink:
+            self.sink.write(chunk)
+        self.batcher.feed(chunk)
+
+    def tick(self):
+        self.batcher.tick()
+
+    def close(self):
+        self.batcher.flush(final=True)
+
+    def getvalue(self):
+        return self.buffer.getvalue().decode('utf-8', 'replace')
+
+
+def raw_socket(sock):
+    """The socket under what docker-py returns for hijacked connections."""
+    return getattr(sock, '_sock', sock)
+
+
+class StreamDemuxer(object):
+    """
+    Splits a hijacked docker attach or exec stream in stdout and stderr.
+    The socket is read with recv_into a preallocated buffer and the
+    frame payloads are handed to the callbacks as memoryview slices of
+    it, only valid until the callback returns. A tty stream has no
+    frames, all of it is stdout.
+    """
+
+    def __init__(self, sock, on_stdout, on_stderr=None, tty=False,
+                 buffer_size=STREAM_BUFFER_SIZE):
+        self.sock = raw_socket(sock)
+        self.tty = tty
+        self.eof = False
+        self.stopped = False
+        self._targets = {STDIN: on_stdout,
+                         STDOUT: on_stdout,
+                         STDERR: on_stderr or on_stdout}
+        self._buffer = bytearray(max(buffer_size, FRAME_HEADER.size))
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._target = on_stdout
+        self._remaining = 0
+
+    def _recv(self):
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buffer):
+            # payloads are consumed as they come, only a partial header
+            # can be left over, move it to the front
+            pending = self._end - self._start
+            self._buffer[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+        try:
+            if hasattr(self.sock, 'recv_into'):
+                count = self.sock.recv_into(self._view[self._end:])
+            else:
+                data = self.sock.recv(len(self._buffer) - self._end)
+                count = len(data)
+                self._buffer[self._end:self._end + count] = data
+        except (socket.timeout, BlockingIOError,
+                ssl.SSLWantReadError):
+            return
+        if not count:
+            self.eof = True
+        self._end += count
+
+    def _parse(self):
+        while self._start < self._end:
+            if self.tty:
+                self._targets[STDOUT](self._view[self._start:self._end])
+                self._start = self._end
+                return
+            if not self._remaining:
+                if self._end - self._start < FRAME_HEADER.size:
+                    return
+                stream, self._remaining = FRAME_HEADER.unpack_from(
+                    self._buffer, self._start)
+                self._start += FRAME_HEADER.size
+                self._target = self._targets.get(stream,
+                                                 self._targets[STDERR])
+                continue
+            count = min(self._remaining, self._end - self._start)
+            self._target(self._view[self._start:self._start + count])
+            self._start += count
+            self._remaining -= count
+
+    def _ready(self, selector, deadline):
+        if getattr(self.sock, 'pending', None) and self.sock.pending():
+            # decrypted data already read from the socket
+            return True
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                return False
+        return bool(selector.select(timeout))
+
+    def run(self, timeout=None):
+        """
+        Demux until the stream ends, returns True, or until timeout
+        seconds passed, returns False and can be called again.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        selector = selectors.DefaultSelector()
+        try:
+            selector.register(self.sock, selectors.EVENT_READ)
+            while not (self.eof or self.stopped):
+                if not self._ready(selector, deadline):
+                    return False
+                self._recv()
+                self._parse()
+        finally:
+            selector.close()
+        return True
+
+    def stop(self):
+        """Called from a callback, run returns after the current read."""
+        self.stopped = True
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def demux_socket(sock, on_stdout, on_stderr=None, tty=False, timeout=None):
+    """Demux sock until it ends or timeout, then close it."""
+    demuxer = StreamDemuxer(sock, on_stdout, on_stderr, tty)
+    try:
+        return demuxer.run(timeout)
+    finally:
+        demuxer.close()
@@ -23,7 +23,6 @@ import struct
 import socket
 import shutil
 import getpass
-import tarfile
 import tempfile
 import traceback
 import subprocess
@@ -51,19 +50,78 @@ try:
         from fabric.api import settings, sudo, put, run
         FABRIC_VER = 1
     else:
-        from fabric import Connection, Config
+        import fabric.connection
         FABRIC_VER = 2
 except (ImportError, BaseException):
     FABRIC_VER = 'unclear'
 
+from .streams import LogFollower, StreamDemuxer
+from .locks import single_flight
+from .images import (ApiTarget,
+                     SshTarget,
+                     pull_images,
+                     distribute_images)
+from .build import (BUILD_HASH_LABEL,
+                    BUILD_HASH_OPTIONS,
+                    BuildContext,
+                    BuildProgress,
+                    build_hash,
+                    build_failed,
+                    skipped_build_summary)
+from .disk import collect_garbage, disk_usage_summary
+from .replicas import ReplicaSet
+from .teardown import Teardown, select_containers
+from .pool import WarmPool, exec_options, job_command
+from .execute import exec_command, run_command
+from .readiness import ReadinessGate
+from .archive import read_file, write_file, diff_file
+from .ssh import SSH_CONNECTIONS, sftp_put
+from .remote import (RemoteScript,
+                     run_script,
+                     inline_script,
+                     parse_probe,
+                     probe_script,
+                     install_reason)
+from .stats import host_summary, sample_containers
+from .inventory import (IMAGES,
+                        CONTAINERS,
+                        Inventory,
+                        host_changed,
+                        container_summary,
+                        list_inventory,
+                        refresh_inventory)
+from .events import watch_container_exit, wait_for_exit
+from .artifacts import store_output, delete_output, output_artifact
+from .client_cache import docker_client_from_config
 from .constants import (HOSTS,
                         PLAYBOOK_PATH,
                         REDHAT_OS_VERS,
                         DEBIAN_OS_VERS,
                         HOSTS_FILE_NAME,
                         CONTAINER_VOLUME,
+                        LOG_HEAD_SIZE,
+                        LOG_TAIL_SIZE,
                         ANSIBLE_PRIVATE_KEY,
-                        LOCAL_HOST_ADDRESSES)
+                        PULL_CONCURRENCY,
+                        DISTRIBUTION_CONCURRENCY,
+                        INVENTORY_MAX_EVENT_GAP,
+                        STATS_WINDOW,
+                        CLIENT_MAX_POOL_SIZE,
+                        REPLICA_CONCURRENCY,
+                        POOL_SIZE,
+                        POOL_IDLE_TTL,
+                        POOL_MAX_REUSE,
+                        POOL_IDLE_COMMAND,
+                        CONTAINER_EXIT_TIMEOUT,
+                        LOCAL_HOST_ADDRESSES,
+                        LOG_POLL_INTERVAL,
+                        LOG_DRAIN_TIMEOUT,
+                        STOP_COMMAND_TIMEOUT,
+                        READINESS_TIMEOUT,
+                        READINESS_INITIAL_DELAY,
+                        READINESS_MAX_DELAY,
+                        TEARDOWN_CONCURRENCY,
+                        TEARDOWN_GRACE_PERIOD)
 
 
 def call_sudo(command, fab_ctx=None):
@@ -93,6 +151,9 @@ def call_put(destination,
     ctx.logger.debug('Copying: {0} {1}'.format(destination,
                                                destination_parent))
     if FABRIC_VER == 2:
+        if not fab_ctx.connect_kwargs.get('key_filename'):
+            # the key only lives in memory, rsync can't use it
+            return sftp_put(fab_ctx, destination, destination_parent)
         return patchwork.transfers.rsync(
             fab_ctx, destination, destination_parent, exclude='.git',
             strict_host_keys=False)
@@ -150,6 +211,13 @@ def get_fabric_settings(ctx, server_ip, server_user, server_private_key):
     if FABRIC_VER == 2:
         ctx.logger.info(
             "Fabric version : {0}".format(fabric.__version__))
+        ctx.logger.debug("ssh connection to {0}@{1}".format(server_user,
+                                                            server_ip))
+        # pooled, the key is kept in memory
+        with SSH_CONNECTIONS.borrow(server_ip, server_user,
+                                    server_private_key) as connection:
+            yield connection
+        return
     elif FABRIC_VER == 1:
         ctx.logger.info(
             "Fabric version : {0}".format(fabric.version.get_version()))
@@ -169,26 +237,13 @@ def get_fabric_settings(ctx, server_ip, server_user, server_private_key):
                                                             server_ip))
         ctx.logger.debug("server_private_key {0} there? {1}".format(
             server_private_key, os.path.isfile(server_private_key)))
-        if FABRIC_VER == 2:
-            yield Connection(
-                host=server_ip,
-                connect_kwargs={
-                    "key_filename": server_private_key
-                },
-                user=server_user,
-                config=Config(
-                    overrides={
-                        "run": {
-                            "warn": True
-                        }}))
-        elif FABRIC_VER == 1:
-            yield settings(
-                connection_attempts=5,
-                disable_known_hosts=True,
-                warn_only=True,
-                host_string=server_ip,
-                key_filename=server_private_key,
-                user=server_user)
+        yield settings(
+            connection_attempts=5,
+            disable_known_hosts=True,
+            warn_only=True,
+            host_string=server_ip,
+            key_filename=server_private_key,
+            user=server_user)
     finally:
         ctx.logger.info("Terminating ssh connection to {0}".format(server_ip))
         if not is_file_path:
@@ -235,52 +290,75 @@ def with_docker(func):
     def f(*args, **kwargs):
         ctx = kwargs['ctx']
         client_config = ctx.node.properties.get('client_config', {})
-        base_url = None
-        if client_config.get('docker_host', '') \
-                and client_config.get('docker_rest_port', ''):
-            base_url = "tcp://{0}:{1}".format(
-                client_config['docker_host'],
-                client_config['docker_rest_port'])
-        elif client_config.get('docker_sock_file', ''):
-            base_url = "unix:/{0}".format(client_config['docker_sock_file'])
-        else:
-            # if we are here that means we don't have a valid docker config
-            raise NonRecoverableError('Invalid docker client config')
-        kwargs['docker_client'] = docker.DockerClient(base_url=base_url,
-                                                      tls=False)
-        return func(*args, **kwargs)
+        with docker_client_from_config(client_config) as docker_client:
+            kwargs['docker_client'] = docker_client
+            return func(*args, **kwargs)
     return f
 
 
-@handle_docker_exception
-def follow_container_logs(ctx, docker_client, container, **kwargs):
-
-    @handle_docker_exception
-    def check_container_exited(docker_client, container):
-        result = docker_client.containers.get(container.id)
-        if result.status == 'exited':
-            ctx.logger.info('Container exit_code {0}'.format(
-                result.attrs['State']['ExitCode']))
-            return True
-        return False
+def get_log_follower(ctx, sink=None, prefix=''):
+    resource_config = ctx.node.properties.get('resource_config', {})
+    return LogFollower(
+        ctx.logger.info,
+        head_size=resource_config.get('log_head_size', LOG_HEAD_SIZE),
+        tail_size=resource_config.get('log_tail_size', LOG_TAIL_SIZE),
+        prefix=prefix,
+        sink=sink)
+
+
+def log_skipped_output(ctx, follower):
+    if follower.buffer.skipped:
+        ctx.logger.info("container output was {0} bytes, {1} bytes were "
+                        "not kept".format(follower.buffer.total,
+                                          follower.buffer.skipped))
 
-    run_output = ""
-    container_logs = container.logs(stream=True)
+
+@handle_docker_exception
+def follow_container_logs(ctx, docker_client, container, sink=None,
+                          exit_waiter=None, **kwargs):
+    # exit_waiter should be created before starting the container,
+    # otherwise we subscribe now and check the container state once
+    if not exit_waiter:
+        exit_waiter = watch_container_exit(docker_client, container.id,
+                                           check_exited=True)
+    follower = get_log_follower(ctx, sink)
+    # attach with logs replays the output so far, over a raw socket
+    sock = docker_client.api.attach_socket(
+        container.id, params={'stdout': 1, 'stderr': 1, 'stream': 1,
+                              'logs': 1})
+    tty = (container.attrs.get('Config') or {}).get('Tty', False)
+    demuxer = StreamDemuxer(sock, follower.feed, tty=tty)
     ctx.logger.debug("Following container {0} logs".format(container))
-    ctx.logger.debug("Attach returned {0}".format(container_logs))
-    while True:
-        try:
-            chunk = next(container_logs)
-            if chunk:
-                chunk = chunk.decode('utf-8', 'replace').strip()
-                run_output += "{0}\n".format(chunk)
-                # ctx.logger.debug("{0}".format(chunk))
-            elif check_container_exited(docker_client, container):
+    try:
+        while not demuxer.run(LOG_POLL_INTERVAL):
+            # log what a container that went quiet wrote last
+            follower.tick()
+            if exit_waiter.is_set():
+                # the stream ends right after the exit, what is still
+                # buffered or replayed is usually the last error lines
+                if not demuxer.run(LOG_DRAIN_TIMEOUT):
+                    ctx.logger.debug("Container {0} output did not end "
+                                     "after it exited".format(container))
                 break
-        except StopIteration:
-            break
-    container_logs.close()
-    return run_output
+    finally:
+        demuxer.close()
+    follower.close()
+    exit_code = wait_for_exit(docker_client, exit_waiter)
+    ctx.logger.info('Container exit_code {0}'.format(exit_code))
+    ctx.instance.runtime_properties['exit_code'] = exit_code
+    log_skipped_output(ctx, follower)
+    return follower.getvalue()
+
+
+def stop_and_wait(ctx, docker_client, container_obj):
+    # stopping an exited container sends no event, inspect it once
+    exit_waiter = watch_container_exit(docker_client, container_obj.id,
+                                       check_exited=True)
+    container_obj.stop()
+    exit_code = wait_for_exit(docker_client, exit_waiter)
+    ctx.logger.info('Container {0} exit_code {1}'.format(container_obj.id,
+                                                         exit_code))
+    return exit_code
 
 
 def move_files(source, destination, permissions=None):
@@ -561,24 +639,96 @@ def remove_container_files(ctx, **kwargs):
                 call_sudo("rm -rf {0}".format(destination), fab_ctx=s)
 
 
+def list_resource_inventory(ctx, docker_client, kind, runtime_property):
+    resource_config = ctx.node.properties.get('resource_config', {})
+    list_kwargs = {
+        'show_all': resource_config.get('all', True),
+        'filters': resource_config.get('filters'),
+        'limit': int(resource_config.get('limit') or 0),
+        'offset': int(resource_config.get('offset') or 0),
+    }
+    if resource_config.get('incremental'):
+        previous = ctx.instance.runtime_properties.get(runtime_property)
+        if isinstance(previous, dict) and 'items' in previous:
+            previous = Inventory.from_dict(kind, previous)
+        else:
+            previous = None
+        max_gap = resource_config.get('max_event_gap') or \
+            INVENTORY_MAX_EVENT_GAP
+        inventory = refresh_inventory(docker_client, previous, kind,
+                                      max_gap=int(max_gap),
+                                      logger=ctx.logger,
+                                      **list_kwargs)
+    else:
+        inventory = list_inventory(docker_client, kind, **list_kwargs)
+    ctx.logger.info("Found {0} {1} (total {2})".format(
+        len(inventory), kind, inventory.total))
+    ctx.instance.runtime_properties[runtime_property] = inventory.to_dict()
+    return inventory
+
+
 @operation
 @handle_docker_exception
 @with_docker
 def list_images(ctx, docker_client, **kwargs):
-    ctx.instance.runtime_properties['images'] = \
-        docker_client.images.list(all=True)
+    list_resource_inventory(ctx, docker_client, IMAGES, 'images')
 
 
 @operation
 def install_docker(ctx, **kwargs):
     resource_config = ctx.node.properties.get('resource_config', {})
     offline_installation = resource_config.get('offline_installation')
+    if not resource_config.get('force_install'):
+        docker_ip, docker_user, docker_key, _ = \
+            get_docker_machine_from_ctx(ctx)
+        # probed every time, heal runs on hosts that just broke, the last
+        # probe is only kept for reference
+        probe = probe_docker_host(ctx, docker_ip, docker_user, docker_key)
+        ctx.instance.runtime_properties['docker_host_probe'] = probe
+        reason = install_reason(probe, docker_user,
+                                resource_config.get('docker_version'))
+        if not reason:
+            ctx.logger.info(
+                "Docker {0} is already installed and running on {1}, "
+                "skipping the installation".format(
+                    probe['docker_version'], docker_ip))
+            return
+        ctx.logger.info("Installing docker on {0}: {1}".format(
+            docker_ip, reason))
     if not offline_installation:
         _install_docker(ctx=ctx, **kwargs)
     else:
         _install_docker_offline(ctx=ctx, **kwargs)
 
 
+def probe_docker_host(ctx, docker_ip, docker_user, docker_key):
+    script = probe_script(docker_user)
+    with get_fabric_settings(ctx, docker_ip, docker_user, docker_key) as s:
+        with s:
+            if FABRIC_VER == 2:
+                output = run_script(s.create_session, 'sh -s', script)
+            else:
+                # fabric 1 escapes the $ and " of the script
+                output = call_command(inline_script(script), fab_ctx=s)
+    probe = parse_probe(str(output))
+    probe['probed_at'] = time.time()
+    ctx.logger.debug("Docker host {0}: {1}".format(docker_ip, probe))
+    return probe
+
+
+def run_remote_script(ctx, script, docker_ip, docker_user, docker_key):
+    with get_fabric_settings(ctx, docker_ip, docker_user, docker_key) as s:
+        with s:
+            if FABRIC_VER == 2:
+                return script.run(s.create_session)
+            # no channel to give with fabric 1, one command at a time
+            for _, _command in script.steps:
+                if script.use_sudo:
+                    call_sudo(_command, fab_ctx=s)
+                else:
+                    call_command(_command, fab_ctx=s)
+
+
 @handle_docker_exception
 def _install_docker(ctx, **kwargs):
     # fetch the data needed for installation
@@ -590,23 +740,17 @@ def _install_docker(ctx, **kwargs):
 
     if not (install_url and post_install_url):
         raise NonRecoverableError("Please validate your install config")
-    installation_commands = [
+    script = RemoteScript(ctx.logger, use_sudo=install_with_sudo)
+    script.parallel('download installers', [
         'curl -fsSL {0} -o /tmp/install.sh'.format(install_url),
-        'chmod 0755 /tmp/install.sh',
-        'sh /tmp/install.sh',
-        'curl -fsSL {0} -o /tmp/postinstall.sh'.format(post_install_url),
-        'chmod 0755 /tmp/postinstall.sh',
-        'sh /tmp/postinstall.sh',
-        'usermod -aG docker {0}'.format(docker_user)
-    ]
-
-    with get_fabric_settings(ctx, docker_ip, docker_user, docker_key) as s:
-        with s:
-            for _command in installation_commands:
-                if install_with_sudo:
-                    call_sudo(_command, fab_ctx=s)
-                else:
-                    call_command(_command, fab_ctx=s)
+        'curl -fsSL {0} -o /tmp/postinstall.sh'.format(post_install_url)])
+    script.step('install docker',
+                'chmod 0755 /tmp/install.sh && sh /tmp/install.sh')
+    script.step('post install',
+                'chmod 0755 /tmp/postinstall.sh && sh /tmp/postinstall.sh')
+    script.step('add {0} to the docker group'.format(docker_user),
+                'usermod -aG docker {0}'.format(docker_user))
+    run_remote_script(ctx, script, docker_ip, docker_user, docker_key)
 
 
 @handle_docker_exception
@@ -625,26 +769,23 @@ def _install_docker_offline(ctx, **kwargs):
         else '{0}/'.format(installation_dir)
     if not (package_tar_path and post_install_path):
         raise NonRecoverableError("Please validate your install config")
-    installation_commands = [
-        'tar -xf {0} -C {1}'.format(package_tar_path, installation_dir),
-        'dpkg -i {0}*.deb'.format(installation_dir),
-        'chmod 0755 {0}'.format(post_install_path),
-        'sh {}'.format(post_install_path),
-        'usermod -aG docker {0}'.format(docker_user)
-    ]
-
-    with get_fabric_settings(ctx, docker_ip, docker_user, docker_key) as s:
-        with s:
-            for _command in installation_commands:
-                if install_with_sudo:
-                    call_sudo(_command, fab_ctx=s)
-                else:
-                    call_command(_command, fab_ctx=s)
+    script = RemoteScript(ctx.logger, use_sudo=install_with_sudo)
+    script.step('extract packages', 'tar -xf {0} -C {1}'.format(
+        package_tar_path, installation_dir))
+    script.step('install packages', 'dpkg -i {0}*.deb'.format(
+        installation_dir))
+    script.step('post install', 'chmod 0755 {0} && sh {0}'.format(
+        post_install_path))
+    script.step('add {0} to the docker group'.format(docker_user),
+                'usermod -aG docker {0}'.format(docker_user))
+    run_remote_script(ctx, script, docker_ip, docker_user, docker_key)
 
 
 @operation
 def uninstall_docker(ctx, **kwargs):
     resource_config = ctx.node.properties.get('resource_config', {})
+    # the host changes, the cached probe is stale
+    ctx.instance.runtime_properties.pop('docker_host_probe', None)
     offline_installation = resource_config.get('offline_installation')
     if not offline_installation:
         _uninstall_docker(ctx=ctx, **kwargs)
@@ -663,19 +804,16 @@ def _uninstall_docker_offline(ctx, **kwargs):
     installation_dir = resource_config.get('installation_dir')
     installation_dir = installation_dir if installation_dir.endswith('/') \
         else '{0}/'.format(installation_dir)
-    installation_commands = [
-        'dpkg --remove docker-buildx-plugin docker-ce docker-ce-rootless-'
-        'extras docker-ce-cli docker-compose-plugin  containerd.io',
-        'rm -rf {0}'.format(installation_dir)
-    ]
-
-    with get_fabric_settings(ctx, docker_ip, docker_user, docker_key) as s:
-        with s:
-            for _command in installation_commands:
-                if install_with_sudo:
-                    call_sudo(_command, fab_ctx=s)
-                else:
-                    call_command(_command, fab_ctx=s)
+    # like before, a failed step doesn't stop the uninstall
+    script = RemoteScript(ctx.logger, use_sudo=install_with_sudo,
+                          stop_on_error=False)
+    script.step('remove packages',
+                'dpkg --remove docker-buildx-plugin docker-ce docker-ce-'
+                'rootless-extras docker-ce-cli docker-compose-plugin '
+                'containerd.io')
+    script.step('remove installation dir', 'rm -rf {0}'.format(
+        installation_dir))
+    run_remote_script(ctx, script, docker_ip, docker_user, docker_key)
 
 
 def _uninstall_docker(ctx, **kwargs):
@@ -683,64 +821,242 @@ def _uninstall_docker(ctx, **kwargs):
     docker_ip, docker_user, docker_key, _ = get_docker_machine_from_ctx(ctx)
     resource_config = ctx.node.properties.get('resource_config', {})
     install_with_sudo = resource_config.get('install_with_sudo', True)
-    if install_with_sudo:
-        command_obj = call_sudo
+    # the OS is detected on the host, in the same script
+    remove_docker = '\n'.join([
+        'if [ -r /etc/os-release ]; then . /etc/os-release; fi',
+        'case "$ID" in',
+        "  {0}) yum remove -y 'docker*' ;;".format('|'.join(REDHAT_OS_VERS)),
+        "  {0}) apt-get remove -y 'docker*' ;;".format(
+            '|'.join(DEBIAN_OS_VERS)),
+        '  *)',
+        '    echo "OS not detected. Check the commands..."',
+        '    if command -v yum > /dev/null 2>&1; then',
+        "      yum remove -y 'docker*'",
+        '    elif command -v apt-get > /dev/null 2>&1; then',
+        "      apt-get remove -y 'docker*'",
+        '    fi ;;',
+        'esac'])
+    script = RemoteScript(ctx.logger, use_sudo=install_with_sudo,
+                          stop_on_error=False)
+    script.step('remove docker packages', remove_docker)
+    run_remote_script(ctx, script, docker_ip, docker_user, docker_key)
+
+
+@operation
+@handle_docker_exception
+@with_docker
+def list_host_details(ctx, docker_client, **kwargs):
+    resource_config = ctx.node.properties.get('resource_config', {})
+    runtime_properties = ctx.instance.runtime_properties
+    started = int(time.time())
+    if resource_config.get('incremental') and \
+            runtime_properties.get('host_details'):
+        max_gap = resource_config.get('max_event_gap') or \
+            INVENTORY_MAX_EVENT_GAP
+        if not host_changed(docker_client,
+                            runtime_properties.get('host_details_last_event'),
+                            int(max_gap)):
+            ctx.logger.info("Nothing changed on the docker host")
+            runtime_properties['host_details_last_event'] = started
+            return
+    runtime_properties['host_details'] = docker_client.info()
+    runtime_properties['host_details_last_event'] = started
+
+
+@operation
+@handle_docker_exception
+@with_docker
+def disk_usage(ctx, docker_client, **kwargs):
+    ctx.instance.runtime_properties['disk_usage'] = \
+        disk_usage_summary(docker_client.api.df())
+
+
+@operation
+@handle_docker_exception
+@with_docker
+def collect_image_garbage(ctx, docker_client, **kwargs):
+    resource_config = ctx.node.properties.get('resource_config', {})
+    budget = resource_config.get('disk_budget')
+    if budget:
+        budget = docker.utils.parse_bytes(budget)
     else:
-        command_obj = call_command
+        budget = None
+    report = collect_garbage(
+        docker_client, ctx.logger,
+        budget=budget,
+        pin_labels=resource_config.get('pin_labels'),
+        prune_containers=resource_config.get('prune_containers', False),
+        prune_dangling=resource_config.get('prune_dangling', True),
+        prune_build_cache=resource_config.get('prune_build_cache', True),
+        dry_run=resource_config.get('dry_run', False))
+    ctx.instance.runtime_properties['garbage_collection'] = report
+    if not report['dry_run']:
+        ctx.instance.runtime_properties['disk_usage'] = \
+            disk_usage_summary(docker_client.api.df())
 
-    with get_fabric_settings(ctx, docker_ip, docker_user, docker_key) as s:
-        with s:
-            os_type = command_obj("echo $(python -c "
-                                  "'import platform; "
-                                  "print(platform.linux_distribution("
-                                  "full_distribution_name=False)[0])')",
-                                  fab_ctx=s)
-            if not PY2:
-                os_type = os_type.stdout
-            os_type = os_type.splitlines()
-            value = ""
-            # sometimes ubuntu print the message when using sudo
-            for line in os_type:
-                if "unable to resolve host" in line:
-                    continue
-                else:
-                    value += line
-            os_type = value.strip()
-            yum_command = False
-            apt_command = False
-            if not os_type:
-                ctx.logger.info('OS not detected. Check the commands...')
-                command_yum = str(command_obj('yum', fab_ctx=s))
-                command_apt = str(command_obj('apt-get', fab_ctx=s))
-                yum_command = False \
-                    if 'command not found' in command_yum else True
-                apt_command = False \
-                    if 'command not found' in command_apt else True
-                ctx.logger.info('System: YUM: {0}. APT-GET: {1}'.format(
-                    yum_command, apt_command))
-
-            ctx.logger.info("os_type {0}".format(os_type))
-            result = ""
-            if os_type.lower() in REDHAT_OS_VERS or yum_command:
-                result = command_obj("yum remove -y docker*", fab_ctx=s)
-            elif os_type.lower() in DEBIAN_OS_VERS or apt_command:
-                result = command_obj("apt-get remove -y docker*", fab_ctx=s)
-            ctx.logger.info("uninstall result {0}".format(result))
+
+@operation
+@handle_docker_exception
+@with_docker
+def teardown_containers(ctx, docker_client, **kwargs):
+    resource_config = ctx.node.properties.get('resource_config', {})
+    containers = select_containers(docker_client,
+                                   labels=resource_config.get('labels'),
+                                   containers=resource_config.get(
+                                       'containers'))
+    if not containers:
+        ctx.logger.info("no containers to tear down")
+        return
+    ctx.logger.info("Tearing down {0} containers".format(len(containers)))
+    teardown = Teardown(
+        docker_client, ctx.logger,
+        grace_period=float(resource_config.get('grace_period',
+                                               TEARDOWN_GRACE_PERIOD)),
+        concurrency=int(resource_config.get('concurrency') or
+                        TEARDOWN_CONCURRENCY),
+        remove=resource_config.get('remove', True),
+        remove_volumes=resource_config.get('remove_volumes', True))
+    report = teardown.run(containers)
+    ctx.instance.runtime_properties['teardown'] = report
+    if report['failed']:
+        raise NonRecoverableError(
+            "Failed to tear down {0} containers".format(report['failed']))
 
 
 @operation
 @handle_docker_exception
 @with_docker
-def list_host_details(ctx, docker_client, **kwargs):
-    ctx.instance.runtime_properties['host_details'] = docker_client.info()
+def sample_resource_usage(ctx, docker_client, **kwargs):
+    resource_config = ctx.node.properties.get('resource_config', {})
+    names = resource_config.get('containers') or []
+    if names:
+        containers = dict((name, name) for name in names)
+    else:
+        containers = dict(
+            (container_summary(container)['name'], container['Id'])
+            for container in docker_client.api.containers(
+                filters=resource_config.get('filters') or {}))
+    if not containers:
+        ctx.logger.info("No containers to sample")
+        return
+    window = int(resource_config.get('window') or STATS_WINDOW)
+    ctx.logger.info("Sampling {0} containers for {1}s".format(
+        len(containers), window))
+    # one connection per stats stream
+    client_config = dict(ctx.node.properties.get('client_config', {}))
+    client_config['max_pool_size'] = max(
+        int(client_config.get('max_pool_size') or CLIENT_MAX_POOL_SIZE),
+        len(containers))
+    with docker_client_from_config(client_config) as stats_client:
+        usage = sample_containers(stats_client, containers, window,
+                                  ctx.logger)
+    ctx.instance.runtime_properties['resource_usage'] = {
+        'window': window,
+        'containers': usage,
+        'host': host_summary(usage, docker_client.info()),
+    }
 
 
 @operation
 @handle_docker_exception
 @with_docker
 def list_containers(ctx, docker_client, **kwargs):
-    ctx.instance.runtime_properties['contianers'] = \
-        docker_client.containers.list(all=True, trunc=True)
+    list_resource_inventory(ctx, docker_client, CONTAINERS, 'contianers')
+
+
+def get_image_content(ctx, image_content, tag):
+    # check what content we got, URL , path or string
+    split = image_content.split('://')
+    schema = split[0]
+    if schema in ['http', 'https']:
+        downloaded_image_content = get_shared_resource(image_content)
+        with open(downloaded_image_content, "r") as f:
+            image_content = f.read()
+    elif os.path.isfile(image_content):
+        if os.path.isabs(image_content):
+            with open(image_content, "r") as f:
+                image_content = f.read()
+        else:
+            downloaded_image_content = ctx.download_resource(image_content)
+            with open(downloaded_image_content, "r") as f:
+                image_content = f.read()
+    else:
+        ctx.logger.info("Building image with tag {0}".format(tag))
+        # replace the new line str with new line char
+        image_content = image_content.replace("\\n", '\n')
+    return image_content
+
+
+def get_build_options(resource_config):
+    # the extra arguments of the build call, only the ones that were set
+    build_options = {
+        'rm': resource_config.get('rm', True),
+        'forcerm': resource_config.get('forcerm', False),
+    }
+    for key in ('cache_from', 'buildargs', 'target', 'squash',
+                'network_mode'):
+        if resource_config.get(key):
+            build_options[key] = resource_config[key]
+    return build_options
+
+
+def pull_cache_from(ctx, docker_client, cache_from):
+    # layers can only be reused from images the daemon has, so pull the
+    # missing ones, this is best effort and a failure only costs cache
+    for image in cache_from or []:
+        try:
+            docker_client.images.get(image)
+            continue
+        except ImageNotFound:
+            pass
+        ctx.logger.info("Pulling {0} to seed the build cache".format(image))
+        try:
+            docker_client.images.pull(image)
+        except docker.errors.APIError as ae:
+            ctx.logger.warning("Unable to pull cache image {0}: {1}".format(
+                image, str(ae)))
+
+
+def get_image_built_from(docker_client, tag, content_hash):
+    # return the image with this tag if it was built from the same content
+    try:
+        image = docker_client.images.get(tag)
+    except ImageNotFound:
+        return None
+    labels = image.labels or {}
+    if labels.get(BUILD_HASH_LABEL) == content_hash:
+        return image
+    return None
+
+
+def get_build_context_dir(ctx, build_context):
+    # returns the local directory with the build context, and a temporary
+    # directory to remove after the build if we had to fetch/extract it
+    source_tmp_path = get_shared_resource(build_context)
+    if source_tmp_path != build_context:
+        return source_tmp_path, source_tmp_path
+    if os.path.isdir(build_context):
+        return build_context, None
+    delete_tmp = False
+    if not os.path.isabs(source_tmp_path):
+        # bundled with the blueprint
+        source_tmp_path = ctx.download_resource(source_tmp_path)
+        delete_tmp = True
+    if os.path.isfile(source_tmp_path):
+        file_type = source_tmp_path.rsplit('.', 1)[-1]
+        if file_type == 'zip':
+            extracted = unzip_archive(source_tmp_path, False)
+        elif file_type in TAR_FILE_EXTENSTIONS:
+            extracted = untar_archive(source_tmp_path, False)
+        else:
+            extracted = None
+        if delete_tmp:
+            shutil.rmtree(os.path.dirname(source_tmp_path))
+        if extracted:
+            return extracted, extracted
+    raise NonRecoverableError(
+        "build_context {0} should be a directory, an archive "
+        "or a URL".format(build_context))
 
 
 @operation
@@ -748,58 +1064,108 @@ def list_containers(ctx, docker_client, **kwargs):
 @with_docker
 def build_image(ctx, docker_client, **kwargs):
     resource_config = ctx.node.properties.get('resource_config', {})
-    image_content, tag = get_from_resource_config(resource_config,
-                                                  'image_content',
-                                                  'tag')
+    image_content, tag, build_context = get_from_resource_config(
+        resource_config, 'image_content', 'tag', 'build_context')
     pull_image = resource_config.get('pull_image', False)
+    if image_content and os.path.isdir(image_content):
+        # a directory is a build context with its own Dockerfile
+        build_context, image_content = image_content, None
 
-    if image_content:
-        # check what content we got, URL , path or string
-        split = image_content.split('://')
-        schema = split[0]
-        if schema in ['http', 'https']:
-            downloaded_image_content = get_shared_resource(image_content)
-            with open(downloaded_image_content, "r") as f:
-                image_content = f.read()
-        elif os.path.isfile(image_content):
-            if os.path.isabs(image_content):
-                with open(image_content, "r") as f:
-                    image_content = f.read()
+    if image_content or build_context:
+        if image_content:
+            image_content = get_image_content(ctx, image_content, tag)
+            ctx.logger.debug(
+                "Image Dockerfile:\n{0}".format(image_content))
+        build_kwargs = {'tag': tag, 'decode': True}
+        context = cleanup_dir = None
+        if build_context:
+            context_dir, cleanup_dir = get_build_context_dir(ctx,
+                                                             build_context)
+            context = BuildContext(context_dir, image_content)
+            ctx.logger.info("Building image with tag {0} from context {1} "
+                            "({2})".format(tag, build_context, context.hash))
+            ctx.instance.runtime_properties['build_context_hash'] = \
+                context.hash
+        build_options = get_build_options(resource_config)
+        content_hash = build_hash(
+            image_content, context.hash if context else None,
+            dict((key, build_options[key]) for key in BUILD_HASH_OPTIONS
+                 if key in build_options))
+        ctx.instance.runtime_properties['build_hash'] = content_hash
+        # only one build of this tag at a time on the docker host, the
+        # others wait and then find the image already built
+        with single_flight(docker_client.api.base_url,
+                           'build:{0}'.format(tag)) as flight:
+            existing_image = get_image_built_from(docker_client, tag,
+                                                  content_hash)
+            if existing_image and (flight.waited or
+                                   not resource_config.get('force_rebuild')):
+                ctx.logger.info("Image {0} was already built from the same "
+                                "content, skipping build".format(tag))
+                if cleanup_dir and os.path.exists(cleanup_dir):
+                    shutil.rmtree(cleanup_dir)
+                ctx.instance.runtime_properties['build_status'] = \
+                    'build_skipped'
+                store_output(ctx, 'build_result',
+                             skipped_build_summary(existing_image.id))
+                ctx.instance.runtime_properties['image'] = repr(existing_image)
+                return
+            build_kwargs.update(build_options)
+            build_kwargs['labels'] = {BUILD_HASH_LABEL: content_hash}
+            pull_cache_from(ctx, docker_client,
+                            build_options.get('cache_from'))
+            if context:
+                # the tar is streamed from the disk cache, not kept in memory
+                img_data = open(context.tarball(), 'rb')
+                build_kwargs.update(custom_context=True,
+                                    encoding='gzip',
+                                    dockerfile=context.dockerfile)
             else:
-                downloaded_image_content = ctx.download_resource(image_content)
-                with open(downloaded_image_content, "r") as f:
-                    image_content = f.read()
-        else:
-            ctx.logger.info("Building image with tag {0}".format(tag))
-            # replace the new line str with new line char
-            image_content = image_content.replace("\\n", '\n')
-        ctx.logger.debug("Image Dockerfile:\n{0}".format(image_content))
-        build_output = ""
-        img_data = io.BytesIO(image_content.encode('ascii'))
-        # the result of build will have a tuple (image_id, build_result)
-        for chunk in docker_client.images.build(fileobj=img_data, tag=tag)[1]:
-            build_output += "{0}\n".format(chunk)
-        ctx.instance.runtime_properties['build_result'] = build_output
-        ctx.logger.info("Build Output {0}".format(build_output))
-        if 'errorDetail' in build_output:
-            raise NonRecoverableError("Build Failed check build-result")
+                img_data = io.BytesIO(image_content.encode('ascii'))
+            progress = BuildProgress(ctx.logger)
+            try:
+                with output_artifact(ctx, 'build_result',
+                                     resource_config) as artifact:
+                    # consume the build events as they arrive, so a failing
+                    # step aborts the build right away
+                    build_events = docker_client.api.build(fileobj=img_data,
+                                                           **build_kwargs)
+                    try:
+                        for event in build_events:
+                            if artifact:
+                                artifact.write(
+                                    "{0}\n".format(json.dumps(event)))
+                            progress.feed(event)
+                    finally:
+                        if hasattr(build_events, 'close'):
+                            build_events.close()
+                        progress.close()
+                        store_output(ctx, 'build_result', progress.summary(),
+                                     artifact)
+            finally:
+                img_data.close()
+                if cleanup_dir and os.path.exists(cleanup_dir):
+                    shutil.rmtree(cleanup_dir)
+            ctx.logger.info("Build finished in {0}s with {1} steps".format(
+                progress.summary()['duration'], len(progress.steps)))
+            ctx.instance.runtime_properties['build_status'] = progress.status
         ctx.instance.runtime_properties['image'] =  \
             repr(docker_client.images.get(name=tag))
     elif pull_image:
         all_tags = resource_config.get('all_tags', False)
-        if not tag:
+        names = ([tag] if tag else []) + \
+            (resource_config.get('pull_images') or [])
+        if not names:
             return
-        repository = tag.split(':')[0]
-        try:
-            image_tag = tag.split(':')[1]
-        except IndexError:
-            image_tag = 'latest'
-        try:
-            docker_client.images.get(tag)
-        except ImageNotFound:
-            docker_client.images.pull(repository=repository,
-                                      tag=image_tag, all_tags=all_tags)
-            ctx.instance.runtime_properties['build_result'] = 'Image was pull'
+        concurrency = resource_config.get('pull_concurrency') or \
+            PULL_CONCURRENCY
+        results = pull_images(docker_client, names, ctx.logger,
+                              all_tags=all_tags,
+                              concurrency=int(concurrency))
+        ctx.instance.runtime_properties['pulled_images'] = results
+        if tag and not results[tag]['present']:
+            ctx.instance.runtime_properties['build_result'] = \
+                'Image was pull'
 
 
 @operation
@@ -808,9 +1174,10 @@ def build_image(ctx, docker_client, **kwargs):
 def remove_image(ctx, docker_client, **kwargs):
     resource_config = ctx.node.properties.get('resource_config', {})
     tag = resource_config.get('tag', "")
-    build_res = ctx.instance.runtime_properties.pop('build_result', "")
+    build_res = ctx.instance.runtime_properties.get('build_result', "")
+    delete_output(ctx, 'build_result')
     if tag:
-        if not build_res or 'errorDetail' in build_res:
+        if not build_res or build_failed(build_res):
             ctx.logger.info("build contained errors , nothing to do ")
             return
         ctx.logger.debug("Removing image with tag {0}".format(tag))
@@ -818,6 +1185,114 @@ def remove_image(ctx, docker_client, **kwargs):
         ctx.logger.info("Remove result {0}".format(remove_res))
 
 
+def get_distribution_target(ctx, target, use_sudo=True):
+    docker_machine = target.get('docker_machine', {})
+    if docker_machine:
+        docker_ip = docker_machine.get('docker_ip', "")
+        docker_user = docker_machine.get('docker_user', "")
+        docker_key = docker_machine.get('docker_key', "")
+        if not (docker_ip and docker_user and docker_key):
+            raise NonRecoverableError(
+                "docker_ip, docker_user and docker_key are required "
+                "for ssh targets")
+
+        @contextmanager
+        def connect():
+            with get_fabric_settings(ctx, docker_ip, docker_user,
+                                     docker_key) as conn:
+                with conn:
+                    yield conn
+        return SshTarget(docker_ip, connect, use_sudo)
+    client_config = target.get('client_config', {})
+    if client_config:
+        return ApiTarget(client_config)
+    raise NonRecoverableError(
+        "Distribution target {0} has neither docker_machine nor "
+        "client_config".format(target))
+
+
+@operation
+@handle_docker_exception
+@with_docker
+def distribute_image(ctx, docker_client, **kwargs):
+    resource_config = ctx.node.properties.get('resource_config', {})
+    images = resource_config.get('images') or []
+    if not images:
+        ctx.logger.info("No images to distribute")
+        return
+    if FABRIC_VER != 2 and any(target.get('docker_machine')
+                               for target in resource_config.get('targets',
+                                                                 [])):
+        raise NonRecoverableError(
+            "Distribution over ssh requires fabric 2")
+    use_sudo = resource_config.get('use_sudo', True)
+    targets = [get_distribution_target(ctx, target, use_sudo)
+               for target in resource_config.get('targets') or []]
+    concurrency = resource_config.get('concurrency') or \
+        DISTRIBUTION_CONCURRENCY
+    results = distribute_images(docker_client, images, targets, ctx.logger,
+                                compress=resource_config.get('compress',
+                                                             False),
+                                concurrency=int(concurrency))
+    ctx.instance.runtime_properties['distribution'] = results
+    failed = ["{0} on {1}".format(image, target)
+              for image, image_results in results.items()
+              for target, result in image_results.items()
+              if result['status'] == 'failed']
+    if failed:
+        raise NonRecoverableError("Failed to distribute {0}".format(
+            ', '.join(failed)))
+
+
+def run_in_warm_pool(ctx, docker_client, image_tag, container_args,
+                     warm_pool):
+    resource_config = ctx.node.properties.get('resource_config', {})
+    pool = WarmPool(
+        docker_client, image_tag, container_args, ctx.logger,
+        size=int(warm_pool.get('size') or POOL_SIZE),
+        idle_ttl=int(warm_pool.get('idle_ttl') or POOL_IDLE_TTL),
+        max_reuse=int(warm_pool.get('max_reuse') or POOL_MAX_REUSE),
+        pause_idle=warm_pool.get('pause_idle', True),
+        idle_command=warm_pool.get('idle_command') or POOL_IDLE_COMMAND)
+    command = job_command(docker_client, image_tag, container_args)
+    ctx.logger.info("Running {0} in a pooled container of {1}".format(
+        command, image_tag))
+    started = time.time()
+    with output_artifact(ctx, 'run_result', resource_config) as artifact:
+        follower = get_log_follower(ctx, artifact)
+        with pool.lease() as container_id:
+            ctx.logger.debug("Pooled container {0} ready in {1:.3f}s".format(
+                container_id, time.time() - started))
+            ctx.instance.runtime_properties['warm_container'] = container_id
+            exit_code = exec_command(docker_client, container_id, command,
+                                     follower.feed, follower.feed,
+                                     **exec_options(container_args))
+        follower.close()
+        ctx.logger.info('Container exit_code {0}'.format(exit_code))
+        ctx.instance.runtime_properties['exit_code'] = exit_code
+        log_skipped_output(ctx, follower)
+        store_output(ctx, 'run_result', follower.getvalue(), artifact)
+    # get the next jobs a container ready to use
+    pool.fill()
+
+
+def wait_until_ready(ctx, docker_client, container_id, readiness, started):
+    gate = ReadinessGate(
+        docker_client, container_id, ctx.logger,
+        health=readiness.get('health'),
+        port=readiness.get('port'),
+        log_pattern=readiness.get('log_pattern'),
+        timeout=float(readiness.get('timeout') or READINESS_TIMEOUT),
+        initial_delay=float(readiness.get('initial_delay') or
+                            READINESS_INITIAL_DELAY),
+        max_delay=float(readiness.get('max_delay') or READINESS_MAX_DELAY))
+    time_to_ready = gate.wait(started)
+    ctx.logger.info("Container {0} ready after {1:.3f}s".format(
+        container_id, time_to_ready))
+    ctx.instance.runtime_properties['time_to_ready'] = round(time_to_ready,
+                                                             3)
+
+
 @operation
 @handle_docker_exception
 @with_docker
@@ -847,10 +1322,33 @@ def create_container(ctx, docker_client, **kwargs):
         ctx.instance.runtime_properties['container_args'] = container_args
         ctx.logger.debug("container_args : {0}".format(container_args))
 
+        replicas = int(resource_config.get('replicas') or 1)
+        if replicas > 1:
+            concurrency = resource_config.get('replica_concurrency') or \
+                REPLICA_CONCURRENCY
+            ctx.logger.info("Creating {0} replicas of {1}".format(
+                replicas, image_tag))
+            replica_set = ReplicaSet(docker_client, image_tag,
+                                     container_args, ctx.logger)
+            ctx.instance.runtime_properties['replicas'] = \
+                replica_set.run(replicas, int(concurrency))
+            return
+
+        warm_pool = resource_config.get('warm_pool') or {}
+        if warm_pool.get('enabled') and \
+                not container_args.get("detach", False):
+            run_in_warm_pool(ctx, docker_client, image_tag, container_args,
+                             warm_pool)
+            return
+
         # docker create
         container = docker_client.containers.create(image=image_tag,
                                                     **container_args)
+        exit_waiter = None
+        if not container_args.get("detach", False):
+            exit_waiter = watch_container_exit(docker_client, container.id)
         # docker start
+        started = time.time()
         container.start()
 
         # the run method will handle the lifecycle create,
@@ -863,15 +1361,22 @@ def create_container(ctx, docker_client, **kwargs):
         if container_args.get("detach", False):
             ctx.logger.info("command is running in detach mode True")
             ctx.instance.runtime_properties['container'] = container.id
+            readiness = resource_config.get('readiness') or {}
+            if readiness:
+                wait_until_ready(ctx, docker_client, container.id,
+                                 readiness, started)
             container_info = docker_client.containers.get(container.id)
             ctx.instance.runtime_properties['container_info'] = \
                 repr(container_info)
             return
         ctx.logger.info("container was created : {0}".format(container))
         ctx.instance.runtime_properties['container'] = container.id
-        container_logs = follow_container_logs(ctx, docker_client, container)
-        ctx.logger.info("container logs : {0} ".format(container_logs))
-        ctx.instance.runtime_properties['run_result'] = container_logs
+        with output_artifact(ctx, 'run_result', resource_config) as artifact:
+            container_logs = follow_container_logs(ctx, docker_client,
+                                                   container, sink=artifact,
+                                                   exit_waiter=exit_waiter)
+        ctx.logger.debug("container logs : {0} ".format(container_logs))
+        store_output(ctx, 'run_result', container_logs, artifact)
 
 
 @operation
@@ -881,20 +1386,33 @@ def start_container(ctx, docker_client, **kwargs):
     resource_config = ctx.node.properties.get('resource_config', {})
     container_args = resource_config.get('container_args', {})
     container = ctx.instance.runtime_properties.get('container', "")
-    if not container:
+    warm_container = ctx.instance.runtime_properties.get('warm_container')
+    if not container and not warm_container:
         ctx.logger.info("container was not create successfully, nothing to do")
         return
     if not container_args.get("command", ""):
         ctx.logger.info("no command sent to container, nothing to do")
         return
+    if warm_container:
+        # the job container went back to the pool, run it again in one
+        ctx.logger.debug("Running the job again in a pooled container")
+        run_in_warm_pool(
+            ctx, docker_client, resource_config.get('image_tag'),
+            ctx.instance.runtime_properties.get('container_args') or {},
+            resource_config.get('warm_pool') or {})
+        return
     ctx.logger.debug(
         "Running this command on container : {0} ".format(
             container_args.get("command", "")))
     container_obj = docker_client.containers.get(container)
+    exit_waiter = watch_container_exit(docker_client, container_obj.id)
     container_obj.start()
-    container_logs = follow_container_logs(ctx, docker_client, container_obj)
-    ctx.logger.info("container logs : {0} ".format(container_logs))
-    ctx.instance.runtime_properties['run_result'] = container_logs
+    with output_artifact(ctx, 'run_result', resource_config) as artifact:
+        container_logs = follow_container_logs(ctx, docker_client,
+                                               container_obj, sink=artifact,
+                                               exit_waiter=exit_waiter)
+    ctx.logger.debug("container logs : {0} ".format(container_logs))
+    store_output(ctx, 'run_result', container_logs, artifact)
 
 
 def check_if_applicable_command(command):
@@ -960,20 +1478,8 @@ def find_host_script_path(docker_client, container_id,
             return
     else:
         # let's look for local files inside the container
-        containerObj = docker_client.containers.get(container_id)
-        bits, stats = containerObj.get_archive(script)
-        if stats.get('size', 0) > 0:
-            destination = tempfile.mkdtemp()
-            f = open(
-                os.path.join(destination, stats.get('name')), 'wb')
-            for chunk in bits:
-                f.write(chunk)
-            f.close()
-            file_obj = tarfile.open(f.name, "r")
-            file = file_obj.extractfile(stats.get('name'))
-            file_content = file.read()
-            file_obj.close()
-            os.remove(f.name)
+        file_content = read_file(docker_client, container_id, script)
+        if file_content:
             # return the file name and content so it would be handled
             # via put_archive though cotinaer API
             return script, file_content
@@ -1029,20 +1535,25 @@ def handle_container_timed_out(ctx, docker_client, container_id,
 
         # here we assume the command is OK , and we have arguments to it
 
-        script, _ = find_host_script_path(docker_client, container_id,
-                                          command, container_args)
-        if not script:
+        # a path on the docker host, or the path and content of the
+        # script inside the container
+        found = find_host_script_path(docker_client, container_id,
+                                      command, container_args)
+        if not found:
             return
+        script = found[0] if isinstance(found, tuple) else found
         replace_script = stop_command
 
         is_ansible_custom_case = 'ansible' in script_executor
         if is_ansible_custom_case:
-            _, replace_script = find_host_script_path(docker_client,
-                                                      container_id,
-                                                      stop_command,
-                                                      container_args)
-            if not replace_script:
+            found = find_host_script_path(docker_client, container_id,
+                                          stop_command, container_args)
+            if not found:
                 return
+            if isinstance(found, tuple):
+                stop_script, replace_script = found
+            else:
+                stop_script = found
 
             # check if we have volume mapping or not
             if volumes and volumes_mapping:
@@ -1052,11 +1563,11 @@ def handle_container_timed_out(ctx, docker_client, container_id,
                                              docker_key) as s:
                         with s:
                             replace_script = call_sudo(
-                                'cat {0}'.format(replace_script),
+                                'cat {0}'.format(stop_script),
                                 fab_ctx=s).stdout
                 else:
                     # check from local
-                    with open(replace_script, 'r') as f:
+                    with open(stop_script, 'r') as f:
                         replace_script = f.read()
 
         container_obj = docker_client.containers.get(container_id)
@@ -1077,26 +1588,28 @@ def handle_container_timed_out(ctx, docker_client, container_id,
         else:
             # if we are here we have the replace content and we need to replace
             # script content inside the container files
-            script_dir = os.path.dirname("/{0}".format(script))
-            pw_tarstream = io.BytesIO()
-            pw_tar = tarfile.TarFile(fileobj=pw_tarstream, mode='w')
-            file_data = replace_script
-            tarinfo = tarfile.TarInfo(name=script)
-            tarinfo.size = len(file_data)
-            tarinfo.mtime = time.time()
-            pw_tar.addfile(tarinfo, io.BytesIO(file_data))
-            pw_tar.close()
-            pw_tarstream.seek(0)
-            container_obj.put_archive(script_dir,
-                                      pw_tarstream)
+            script_path = "/{0}".format(script.lstrip('/'))
+            ctx.logger.debug("script changes:\n{0}".format(''.join(
+                diff_file(docker_client, container_id, script_path,
+                          replace_script))))
+            write_file(docker_client, container_id, script_path,
+                       replace_script, mode=0o755)
 
         # now we can restart the container , and it will
         # run with the overriden script that contain the
         # stop_command
+        was_running = container_obj.status == 'running'
+        exit_waiter = watch_container_exit(docker_client, container_obj.id)
         container_obj.restart()
+        if was_running:
+            # restart stops the container first, skip that exit
+            exit_waiter.wait(CONTAINER_EXIT_TIMEOUT)
+        exit_waiter = watch_container_exit(docker_client, container_obj.id,
+                                           check_exited=True)
         container_logs = follow_container_logs(ctx, docker_client,
-                                               container_obj)
-        ctx.logger.info("container logs : {0} ".format(container_logs))
+                                               container_obj,
+                                               exit_waiter=exit_waiter)
+        ctx.logger.debug("container logs : {0} ".format(container_logs))
     else:
         ctx.logger.info("""can't send this command {0} to container,
 since it is unreachable""".format(stop_command))
@@ -1107,21 +1620,80 @@ since it is unreachable""".format(stop_command))
 @handle_docker_exception
 @with_docker
 def stop_container(ctx, docker_client, stop_command, **kwargs):
-    container = ctx.instance.runtime_properties.get('container', "")
     resource_config = ctx.node.properties.get('resource_config', {})
     image_tag, container_args = get_from_resource_config(resource_config,
                                                          'image_tag',
                                                          'container_args')
+    replicas = ctx.instance.runtime_properties.get('replicas')
+    if replicas:
+        containers = [replica['id'] for replica in replicas]
+    elif ctx.instance.runtime_properties.get('warm_container'):
+        ctx.logger.info("job ran in a pooled container, nothing to stop")
+        return
+    else:
+        containers = [ctx.instance.runtime_properties.get('container', "")]
+    if replicas and not stop_command:
+        # nothing to run first, stop them all at once
+        teardown = Teardown(
+            docker_client, ctx.logger, remove=False,
+            concurrency=int(resource_config.get('replica_concurrency') or
+                            TEARDOWN_CONCURRENCY))
+        teardown.run(containers)
+        return
+    stop_mode = resource_config.get('stop_mode') or 'exec'
+    for container in containers:
+        stop_one_container(ctx, docker_client, container, image_tag,
+                           container_args, stop_command, stop_mode)
+
+
+def run_stop_command(ctx, docker_client, container, stop_command):
+    stdout = get_log_follower(ctx)
+    stderr = get_log_follower(ctx, prefix='stderr: ')
+    exit_code = run_command(docker_client, container, stop_command,
+                            stdout.feed, stderr.feed, ctx.logger,
+                            timeout=STOP_COMMAND_TIMEOUT)
+    stdout.close()
+    stderr.close()
+    if exit_code is None:
+        # stopping the container next ends an exec still running
+        ctx.logger.error("Stop command did not end within {0}s".format(
+            STOP_COMMAND_TIMEOUT))
+    elif exit_code:
+        ctx.logger.error("Stop command exit_code {0}".format(exit_code))
+    else:
+        ctx.logger.info("Stop command exit_code {0}".format(exit_code))
+    store_output(ctx, 'stop_result', {
+        'exit_code': exit_code,
+        'stdout': stdout.getvalue(),
+        'stderr': stderr.getvalue(),
+    })
+    return exit_code
+
+
+def stop_one_container(ctx, docker_client, container, image_tag,
+                       container_args, stop_command, stop_mode='exec'):
     if not stop_command:
         ctx.logger.info("no stop command, nothing to do")
         try:
             container_obj = docker_client.containers.get(container)
-            container_obj.stop()
-            container_obj.wait()
+            stop_and_wait(ctx, docker_client, container_obj)
         except NotFound:
             pass
         return
 
+    if stop_mode != 'restart':
+        if container:
+            ctx.logger.info(
+                "Stop Contianer {0} from tag {1} with command {2}".format(
+                    container, image_tag, stop_command))
+            run_stop_command(ctx, docker_client, container, stop_command)
+            container_obj = docker_client.containers.get(container)
+            stop_and_wait(ctx, docker_client, container_obj)
+        return
+
+    # legacy mode, the command is sent to the container stdin and the
+    # container script is replaced with it and restarted if it exited
+
     script_executor = stop_command.split(' ', 1)[0]
     if not check_if_applicable_command(script_executor):
         ctx.logger.info(
@@ -1134,46 +1706,39 @@ def stop_container(ctx, docker_client, stop_command, **kwargs):
                 container, image_tag, stop_command))
         # attach to container socket and send the stop_command
         container_obj = docker_client.containers.get(container)
-        socket = container_obj.attach_socket(
-            params={
-                'stdin': 1,
-                "stdout": 1,
-                'stream': 1,
-                "logs": 1
-            })
+        follower = get_log_follower(ctx, prefix='Stop command result ')
         try:
-            socket._sock.settimeout(20)
-            socket._sock.send(stop_command.encode('utf-8'))
-            buffer = ""
-            while True:
-                data = socket._sock.recv(4096)
-                if not data:
-                    break
-                buffer += data.decode('utf-8')
-            ctx.logger.info("Stop command result {0}".format(buffer))
-        except docker.errors.APIError as ae:
-            ctx.logger.error("APIError {0}".format(str(ae)))
-        except Exception as e:
-            message = e.message if hasattr(e, 'message') else e
-            # response = e.response if hasattr(e, 'response') else e
-            # explanation = e.explanation if hasattr(e, 'explanation') else e
-            # errno = e.errno if hasattr(e, 'errno') else e
-            ctx.logger.error("exception : {0}".format(message))
-            # if timeout happened that means the container exited,
-            # and if want to do something for the container,
-            # or handle any special case if we want that
-            if "timed out" in repr(message):
+            sock = container_obj.attach_socket(
+                params={
+                    'stdin': 1,
+                    "stdout": 1,
+                    "stderr": 1,
+                    'stream': 1,
+                    "logs": 1
+                })
+            config = container_obj.attrs.get('Config') or {}
+            demuxer = StreamDemuxer(sock, follower.feed,
+                                    tty=config.get('Tty', False))
+            try:
+                demuxer.send(stop_command.encode('utf-8'))
+                ended = demuxer.run(STOP_COMMAND_TIMEOUT)
+            finally:
+                demuxer.close()
+                follower.close()
+            if not ended:
+                # the container did not exit in time, replace its script
+                # with the stop_command and restart it
                 ctx.logger.debug('Expected case since it is stopped '
                                  'and we want a chance to execute '
                                  'extra command with override to old one')
-                # Special Handling for terraform -to call cleanup for example-
-                # we can switch the command with stop_command and restart
                 handle_container_timed_out(ctx, docker_client, container,
                                            container_args, stop_command)
+        except docker.errors.APIError as ae:
+            ctx.logger.error("APIError {0}".format(str(ae)))
+        except Exception as e:
+            ctx.logger.error("exception : {0}".format(e))
 
-        socket.close()
-        container_obj.stop()
-        container_obj.wait()
+        stop_and_wait(ctx, docker_client, container_obj)
 
 
 @operation
@@ -1183,11 +1748,33 @@ def remove_container(ctx, docker_client, **kwargs):
     container = ctx.instance.runtime_properties.get('container', "")
     resource_config = ctx.node.properties.get('resource_config', {})
     image_tag = resource_config.get('image_tag', "")
-    if container:
+    replicas = ctx.instance.runtime_properties.get('replicas')
+    if replicas:
+        # like a single container, anonymous volumes are kept
+        teardown = Teardown(
+            docker_client, ctx.logger, remove_volumes=False,
+            concurrency=int(resource_config.get('replica_concurrency') or
+                            TEARDOWN_CONCURRENCY))
+        teardown.run([replica['id'] for replica in replicas])
+        ctx.instance.runtime_properties.pop('replicas')
+        delete_output(ctx, 'run_result')
+        delete_output(ctx, 'stop_result')
+    elif container:
         ctx.logger.info(
             "remove Contianer {0} from tag {1}".format(container,
                                                        image_tag))
-        container_obj = docker_client.containers.get(container)
-        remove_res = container_obj.remove()
+        try:
+            container_obj = docker_client.containers.get(container)
+            remove_res = container_obj.remove()
+            ctx.logger.info("Remove result {0}".format(remove_res))
+        except NotFound:
+            # pruned or removed by hand, nothing left to do
+            ctx.logger.info("Container {0} was already removed".format(
+                container))
         ctx.instance.runtime_properties.pop('container')
-        ctx.logger.info("Remove result {0}".format(remove_res))
+        delete_output(ctx, 'run_result')
+        delete_output(ctx, 'stop_result')
+    elif ctx.instance.runtime_properties.get('warm_container'):
+        # the pooled container is kept for the next jobs
+        ctx.instance.runtime_properties.pop('warm_container')
+        delete_output(ctx, 'run_result')
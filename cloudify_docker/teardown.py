@@ -0,0 +1,206 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from docker.errors import APIError, NotFound
+
+from .events import watch_container_exit, wait_for_exit, container_exit_code
+from .constants import (CONTAINER_EXIT_TIMEOUT,
+                        TEARDOWN_GRACE_PERIOD,
+                        TEARDOWN_CONCURRENCY,
+                        TEARDOWN_POLL_INTERVAL)
+
+
+def select_containers(docker_client, labels=None, containers=None):
+    """
+    Ids of the containers matching all the labels, key or key=value,
+    and of the ones listed by name or id, the missing ones are skipped.
+    """
+    ids = []
+    if labels:
+        ids.extend(container['Id'] for container in
+                   docker_client.api.containers(all=True,
+                                                filters={'label': labels}))
+    for container in containers or []:
+        try:
+            ids.append(docker_client.api.inspect_container(container)['Id'])
+        except NotFound:
+            continue
+    selected = []
+    for container_id in ids:
+        if container_id not in selected:
+            selected.append(container_id)
+    return selected
+
+
+class Teardown(object):
+    """
+    Stops many containers at once: all of them get their stop signal,
+    the ones still running when the shared grace period ends are killed,
+    then they are removed along with their anonymous volumes.
+    """
+
+    def __init__(self, docker_client, logger,
+                 grace_period=TEARDOWN_GRACE_PERIOD,
+                 concurrency=TEARDOWN_CONCURRENCY, remove=True,
+                 remove_volumes=True):
+        self.docker_client = docker_client
+        self.logger = logger
+        self.grace_period = grace_period
+        self.concurrency = concurrency
+        self.remove = remove
+        self.remove_volumes = remove_volumes
+        self.results = {}
+        self._waiters = {}
+        self._signalled = {}
+
+    def _map(self, func, container_ids):
+        if not container_ids:
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(
+                self.concurrency, len(container_ids)))) as executor:
+            futures = dict((executor.submit(func, container_id),
+                            container_id) for container_id in container_ids)
+        for future, container_id in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                result = self.results[container_id]
+                result['state'] = 'failed'
+                result['error'] = str(e)
+                self.logger.error("Failed to tear down {0}: {1}".format(
+                    result['name'], e))
+
+    def _signal(self, container_id):
+        result = self.results[container_id]
+        try:
+            info = self.docker_client.api.inspect_container(container_id)
+        except NotFound:
+            result['state'] = 'not_found'
+            return
+        result['name'] = info.get('Name', '').lstrip('/') or container_id
+        state = info.get('State') or {}
+        if not state.get('Running'):
+            result['state'] = 'stopped'
+            result['stop_time'] = 0
+            return
+        if state.get('Paused'):
+            # a paused container does not get signals
+            self.docker_client.api.unpause(container_id)
+        signal = (info.get('Config') or {}).get('StopSignal') or 'SIGTERM'
+        waiter = watch_container_exit(self.docker_client, container_id)
+        self._signalled[container_id] = time.time()
+        try:
+            self.docker_client.api.kill(container_id, signal=signal)
+        except APIError:
+            # it may have exited since the inspect
+            if container_exit_code(self.docker_client, container_id) is None:
+                raise
+        self._waiters[container_id] = waiter
+
+    def _wait_stopped(self, waiter, deadline):
+        while True:
+            exit_code = wait_for_exit(self.docker_client, waiter,
+                                      timeout=max(0, deadline - time.time()))
+            if exit_code is not None or waiter.watcher or \
+                    time.time() >= deadline:
+                return exit_code
+            # no events, poll until the deadline
+            time.sleep(min(TEARDOWN_POLL_INTERVAL,
+                           max(0, deadline - time.time())))
+
+    def _stopped(self, container_id, exit_code, exited_at=None):
+        result = self.results[container_id]
+        result['state'] = 'stopped'
+        result['exit_code'] = exit_code
+        result['stop_time'] = round(
+            (exited_at or time.time()) - self._signalled[container_id], 3)
+
+    def _kill(self, container_id):
+        waiter = watch_container_exit(self.docker_client, container_id)
+        try:
+            self.docker_client.api.kill(container_id)
+        except APIError:
+            if container_exit_code(self.docker_client, container_id) is None:
+                raise
+        self.results[container_id]['killed'] = True
+        self._stopped(container_id, wait_for_exit(self.docker_client, waiter,
+                                                  CONTAINER_EXIT_TIMEOUT))
+
+    def _remove(self, container_id):
+        result = self.results[container_id]
+        started = time.time()
+        try:
+            self.docker_client.api.remove_container(
+                container_id, v=self.remove_volumes, force=True)
+        except NotFound:
+            # auto removed
+            pass
+        result['state'] = 'removed'
+        result['remove_time'] = round(time.time() - started, 3)
+
+    def run(self, container_ids):
+        """Tear down container_ids, returns the report of each of them."""
+        started = time.time()
+        for container_id in container_ids:
+            self.results[container_id] = {
+                'id': container_id,
+                'name': container_id,
+                'state': None,
+                'exit_code': None,
+                'killed': False,
+                'stop_time': None,
+                'remove_time': None,
+            }
+        self._map(self._signal, container_ids)
+        # the grace period is shared, it starts once all got the signal
+        deadline = time.time() + self.grace_period
+        stragglers = []
+        for container_id, waiter in self._waiters.items():
+            exit_code = self._wait_stopped(waiter, deadline)
+            if exit_code is None:
+                stragglers.append(container_id)
+            else:
+                exited_at = waiter.exited_at \
+                    if waiter.exit_code is not None else None
+                self._stopped(container_id, exit_code, exited_at)
+        if stragglers:
+            self.logger.info("Killing {0} containers still running after "
+                             "{1}s".format(len(stragglers),
+                                           self.grace_period))
+            self._map(self._kill, stragglers)
+        if self.remove:
+            self._map(self._remove, [
+                container_id for container_id in container_ids
+                if self.results[container_id]['state'] == 'stopped'])
+        containers = list(self.results.values())
+        report = {
+            'grace_period': self.grace_period,
+            'duration': round(time.time() - started, 3),
+            'containers': dict((result['name'], result)
+                               for result in containers),
+        }
+        for state in ('stopped', 'removed', 'failed', 'not_found'):
+            report[state] = len([result for result in containers
+                                 if result['state'] == state])
+        report['killed'] = len([result for result in containers
+                                if result['killed']])
+        self.logger.info(
+            "Tore down {0} containers in {1}s, {2} killed, {3} failed".format(
+                len(containers), report['duration'], report['killed'],
+                report['failed']))
+        return report
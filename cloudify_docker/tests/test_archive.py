@@ -0,0 +1,94 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import mock
+import tarfile
+import unittest
+
+from docker.errors import NotFound
+
+from cloudify.exceptions import NonRecoverableError
+
+from cloudify_docker.archive import (iter_tar_files,
+                                     read_file,
+                                     write_file,
+                                     diff_file)
+
+
+def make_tar(files):
+    stream = io.BytesIO()
+    with tarfile.open(fileobj=stream, mode='w') as archive:
+        directory = tarfile.TarInfo('dir')
+        directory.type = tarfile.DIRTYPE
+        archive.addfile(directory)
+        for name, data in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o755
+            archive.addfile(info, io.BytesIO(data))
+    return stream.getvalue()
+
+
+def chunked(data, size=100):
+    for index in range(0, len(data), size):
+        yield data[index:index + size]
+
+
+class TestArchive(unittest.TestCase):
+
+    def test_iter_tar_files(self):
+        data = make_tar([('run.sh', b'echo run\n'),
+                         ('dir/big', b'x' * 3000)])
+        self.assertEqual(list(iter_tar_files(chunked(data, 333))),
+                         [('run.sh', 0o755, b'echo run\n'),
+                          ('dir/big', 0o755, b'x' * 3000)])
+        with self.assertRaises(NonRecoverableError):
+            list(iter_tar_files(chunked(data), max_size=1000))
+
+    def test_read_file(self):
+        client = mock.Mock()
+        client.api.get_archive.return_value = (
+            chunked(make_tar([('run.sh', b'echo run\n')])),
+            {'name': 'run.sh', 'size': 9})
+        self.assertEqual(read_file(client, 'c1', '/app/run.sh'),
+                         b'echo run\n')
+        client.api.get_archive.side_effect = NotFound('missing')
+        self.assertIsNone(read_file(client, 'c1', '/app/run.sh'))
+
+    def test_read_file_too_large(self):
+        client = mock.Mock()
+        bits = mock.Mock()
+        client.api.get_archive.return_value = (bits, {'size': 2048})
+        with self.assertRaises(NonRecoverableError):
+            read_file(client, 'c1', '/app/run.sh', max_size=1024)
+        bits.close.assert_called_once_with()
+
+    def test_write_file(self):
+        client = mock.Mock()
+        write_file(client, 'c1', '/app/run.sh', u'echo stop\n', mode=0o755)
+        container_id, path, data = client.api.put_archive.call_args[0]
+        self.assertEqual((container_id, path), ('c1', '/app'))
+        self.assertEqual(list(iter_tar_files([data])),
+                         [('run.sh', 0o755, b'echo stop\n')])
+
+    def test_diff_file(self):
+        client = mock.Mock()
+        client.api.get_archive.return_value = (
+            chunked(make_tar([('run.sh', b'#!/bin/sh\necho run\n')])),
+            {'name': 'run.sh', 'size': 20})
+        self.assertEqual(diff_file(client, 'c1', '/app/run.sh',
+                                   '#!/bin/sh\necho stop\n')[2:],
+                         ['@@ -1,2 +1,2 @@\n', ' #!/bin/sh\n',
+                          '-echo run\n', '+echo stop\n'])
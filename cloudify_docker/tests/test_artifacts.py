@@ -0,0 +1,72 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import mock
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from cloudify.mocks import MockCloudifyContext
+
+from cloudify_docker.artifacts import (read_output,
+                                       store_output,
+                                       delete_output,
+                                       output_artifact)
+
+
+class TestArtifacts(unittest.TestCase):
+
+    def setUp(self):
+        super(TestArtifacts, self).setUp()
+        self.artifacts_dir = tempfile.mkdtemp()
+        patcher = mock.patch('cloudify_docker.artifacts.ARTIFACTS_DIR',
+                             self.artifacts_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.artifacts_dir, True)
+
+    def test_output_without_artifact(self):
+        ctx = MockCloudifyContext(deployment_id='dep', node_id='node')
+        with output_artifact(ctx, 'run_result', {}) as artifact:
+            self.assertIsNone(artifact)
+        store_output(ctx, 'run_result', 'output', artifact)
+        self.assertEqual(ctx.instance.runtime_properties['run_result'],
+                         'output')
+        self.assertEqual(read_output(ctx, 'run_result'), 'output')
+
+    def test_output_artifact_roundtrip(self):
+        ctx = MockCloudifyContext(deployment_id='dep', node_id='node')
+        output = 'x' * 10000 + 'the end'
+        with output_artifact(ctx, 'run_result',
+                             {'output_artifacts': True}) as artifact:
+            artifact.write(output[:5000])
+            artifact.write(output[5000:].encode('utf-8'))
+        store_output(ctx, 'run_result', output, artifact)
+
+        props = ctx.instance.runtime_properties
+        self.assertTrue(props['run_result'].endswith('the end'))
+        self.assertLess(len(props['run_result']), len(output))
+        info = props['run_result_artifact']
+        self.assertEqual(info['size'], len(output))
+        self.assertEqual(info['sha256'],
+                         hashlib.sha256(output.encode('utf-8')).hexdigest())
+        self.assertTrue(info['path'].startswith(self.artifacts_dir))
+        self.assertEqual(read_output(ctx, 'run_result'), output)
+
+        delete_output(ctx, 'run_result')
+        self.assertFalse(os.path.exists(info['path']))
+        self.assertNotIn('run_result', props)
+        self.assertNotIn('run_result_artifact', props)
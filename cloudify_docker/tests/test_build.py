@@ -0,0 +1,79 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import mock
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from cloudify_docker.build import BuildContext, INLINE_DOCKERFILE
+
+
+class TestBuildContext(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBuildContext, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.addCleanup(shutil.rmtree, self.cache_dir, True)
+        self.write('Dockerfile', 'FROM alpine\nCOPY app.py /\n')
+        self.write('app.py', 'print("hello")\n')
+        self.write('build.log', 'ignored\n')
+        self.write('.dockerignore', '# comment\n*.log\n')
+
+    def write(self, name, content):
+        with open(os.path.join(self.root, name), 'w') as f:
+            f.write(content)
+
+    def test_dockerignore(self):
+        context = BuildContext(self.root, cache_dir=self.cache_dir)
+        self.assertIn('app.py', context.files())
+        self.assertNotIn('build.log', context.files())
+        with tarfile.open(context.tarball()) as tar:
+            names = tar.getnames()
+        self.assertIn('app.py', names)
+        self.assertIn('Dockerfile', names)
+        self.assertNotIn('build.log', names)
+
+    def test_hash_follows_content(self):
+        first = BuildContext(self.root, cache_dir=self.cache_dir).hash
+        self.write('build.log', 'still ignored\n')
+        self.assertEqual(
+            BuildContext(self.root, cache_dir=self.cache_dir).hash, first)
+        self.write('app.py', 'print("bye")\n')
+        self.assertNotEqual(
+            BuildContext(self.root, cache_dir=self.cache_dir).hash, first)
+        self.assertNotEqual(
+            BuildContext(self.root, 'FROM alpine',
+                         cache_dir=self.cache_dir).hash, first)
+
+    def test_tarball_cached(self):
+        context = BuildContext(self.root, cache_dir=self.cache_dir)
+        path = context.tarball()
+        with mock.patch('cloudify_docker.build.tar') as mock_tar:
+            self.assertEqual(
+                BuildContext(self.root, cache_dir=self.cache_dir).tarball(),
+                path)
+            mock_tar.assert_not_called()
+
+    def test_inline_dockerfile(self):
+        context = BuildContext(self.root, 'FROM busybox',
+                               cache_dir=self.cache_dir)
+        self.assertEqual(context.dockerfile, INLINE_DOCKERFILE)
+        with tarfile.open(context.tarball()) as tar:
+            content = tar.extractfile(INLINE_DOCKERFILE).read()
+        self.assertEqual(content, b'FROM busybox')
@@ -0,0 +1,120 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import unittest
+
+from cloudify_docker.events import get_exit_watcher
+from cloudify_docker.client_cache import DockerClientCache
+from cloudify_docker.tests.test_events import FakeEvents
+
+
+class TestDockerClientCache(unittest.TestCase):
+
+    def test_client_reused_per_base_url(self):
+        cache = DockerClientCache()
+        mock_client = mock.MagicMock(side_effect=lambda **_: mock.Mock())
+        with mock.patch('docker.DockerClient', mock_client):
+            with cache.borrow('tcp://127.0.0.1:2375') as first:
+                pass
+            with cache.borrow('tcp://127.0.0.1:2375') as second:
+                pass
+            with cache.borrow('tcp://127.0.0.2:2375') as third:
+                pass
+        self.assertIs(first, second)
+        self.assertIsNot(first, third)
+        self.assertEqual(mock_client.call_count, 2)
+        self.assertEqual(len(cache), 2)
+
+    def test_unhealthy_client_replaced(self):
+        cache = DockerClientCache(health_check_interval=0)
+        mock_client = mock.MagicMock(side_effect=lambda **_: mock.Mock())
+        with mock.patch('docker.DockerClient', mock_client):
+            with cache.borrow('tcp://127.0.0.1:2375') as first:
+                pass
+            first.ping.side_effect = Exception('daemon is gone')
+            with cache.borrow('tcp://127.0.0.1:2375') as second:
+                pass
+        self.assertIsNot(first, second)
+        first.close.assert_called_once_with()
+
+    def test_unhealthy_borrowed_client_closed_on_release(self):
+        cache = DockerClientCache(health_check_interval=0)
+        mock_client = mock.MagicMock(side_effect=lambda **_: mock.Mock())
+        with mock.patch('docker.DockerClient', mock_client):
+            with cache.borrow('tcp://127.0.0.1:2375') as first:
+                first.ping.side_effect = Exception('daemon is gone')
+                with cache.borrow('tcp://127.0.0.1:2375') as second:
+                    pass
+                # still in use here
+                first.close.assert_not_called()
+        self.assertIsNot(first, second)
+        first.close.assert_called_once_with()
+        second.close.assert_not_called()
+        self.assertEqual(len(cache), 1)
+
+    def test_idle_clients_evicted(self):
+        cache = DockerClientCache(max_clients=1)
+        mock_client = mock.MagicMock(side_effect=lambda **_: mock.Mock())
+        with mock.patch('docker.DockerClient', mock_client):
+            with cache.borrow('tcp://127.0.0.1:2375') as first:
+                pass
+            with cache.borrow('tcp://127.0.0.2:2375', idle_timeout=0):
+                pass
+            with cache.borrow('tcp://127.0.0.3:2375', idle_timeout=0):
+                pass
+        first.close.assert_called_once_with()
+        self.assertEqual(len(cache), 1)
+
+    def test_pool_size_and_idle_timeout_per_client(self):
+        cache = DockerClientCache()
+        mock_client = mock.MagicMock(side_effect=lambda **_: mock.Mock())
+        with mock.patch('docker.DockerClient', mock_client):
+            with cache.borrow('tcp://127.0.0.1:2375',
+                              max_pool_size=2, idle_timeout=0) as small:
+                pass
+            with cache.borrow('tcp://127.0.0.1:2375',
+                              max_pool_size=20) as large:
+                pass
+        self.assertIsNot(small, large)
+        self.assertEqual(
+            [call[1]['max_pool_size'] for call in mock_client.call_args_list],
+            [2, 20])
+        # only the client borrowed with idle_timeout 0 went away
+        small.close.assert_called_once_with()
+        large.close.assert_not_called()
+        self.assertEqual(len(cache), 1)
+
+    def test_close(self):
+        cache = DockerClientCache()
+        with mock.patch('docker.DockerClient', mock.MagicMock()):
+            with cache.borrow('tcp://127.0.0.1:2375') as client:
+                pass
+        cache.close()
+        client.close.assert_called_once_with()
+        self.assertEqual(len(cache), 0)
+
+    def test_close_stops_exit_watcher(self):
+        cache = DockerClientCache()
+        client = mock.Mock()
+        client.events.return_value = FakeEvents()
+        with mock.patch('docker.DockerClient',
+                        mock.MagicMock(return_value=client)):
+            with cache.borrow('tcp://127.0.0.1:2375') as borrowed:
+                watcher = get_exit_watcher(borrowed)
+        cache.close()
+        watcher._thread.join(5)
+        self.assertFalse(watcher.alive)
+        self.assertIsNot(get_exit_watcher(client), watcher)
+        get_exit_watcher(client).close()
@@ -0,0 +1,123 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import unittest
+
+from docker.errors import APIError
+
+from cloudify_docker.disk import (plan_gc,
+                                  collect_garbage,
+                                  disk_usage_summary)
+
+
+def df_image(image_id, created, size=100, tags=None, labels=None,
+             parent=''):
+    return {'Id': image_id, 'Created': created, 'Size': size,
+            'SharedSize': 0, 'RepoTags': tags or ['<none>:<none>'],
+            'Labels': labels, 'ParentId': parent}
+
+
+def df_container(image_id, created, state='exited', size=10):
+    return {'Id': 'c-' + image_id, 'ImageID': image_id, 'Created': created,
+            'State': state, 'SizeRw': size}
+
+
+DF = {
+    'LayersSize': 600,
+    'Images': [
+        df_image('old', 1, tags=['old:1']),
+        df_image('recent', 2, tags=['recent:1']),
+        df_image('dangling', 3),
+        df_image('pinned', 0, tags=['base:1'], labels={'keep': 'yes'}),
+        df_image('running', 0, tags=['web:1']),
+        df_image('used-late', 0, tags=['job:1']),
+    ],
+    'Containers': [
+        df_container('running', 5, state='running'),
+        df_container('used-late', 9),
+    ],
+    'Volumes': [{'UsageData': {'Size': 50, 'RefCount': 0}}],
+    'BuildCache': [{'Size': 30, 'InUse': False, 'Shared': False},
+                   {'Size': 20, 'InUse': True}],
+}
+
+
+class TestDisk(unittest.TestCase):
+
+    def test_summary(self):
+        summary = disk_usage_summary(DF)
+        self.assertEqual(summary['images'],
+                         {'count': 6, 'active': 2, 'size': 600,
+                          'reclaimable': 400})
+        self.assertEqual(summary['containers']['reclaimable'], 10)
+        self.assertEqual(summary['volumes']['reclaimable'], 50)
+        self.assertEqual(summary['build_cache'],
+                         {'count': 2, 'active': 1, 'size': 50,
+                          'reclaimable': 30})
+
+    def test_lru_plan(self):
+        plan, size = plan_gc(DF, budget=350, pin_labels=['keep=yes'],
+                             prune_containers=True)
+        # dangling first, then by last use, the stopped container of
+        # used-late is pruned so its image counts as used at 9
+        self.assertEqual([image['id'] for image in plan],
+                         ['dangling', 'old', 'recent'])
+        self.assertEqual(size, 300)
+
+    def test_stopped_containers_kept(self):
+        plan, _ = plan_gc(DF, budget=0, prune_containers=False,
+                          prune_dangling=False)
+        self.assertEqual([image['id'] for image in plan],
+                         ['pinned', 'old', 'recent', 'dangling'])
+
+    def test_parents_kept(self):
+        df = {'LayersSize': 200, 'Images': [
+            df_image('parent', 1), df_image('child', 2, parent='parent')]}
+        plan, _ = plan_gc(df, budget=0)
+        self.assertEqual([image['id'] for image in plan], ['child'])
+
+    def test_dry_run(self):
+        client = mock.Mock()
+        client.api.df.return_value = DF
+        report = collect_garbage(client, mock.Mock(), budget=350,
+                                 pin_labels=['keep'], prune_containers=True,
+                                 dry_run=True)
+        client.api.remove_image.assert_not_called()
+        client.api.prune_containers.assert_not_called()
+        self.assertEqual(report['reclaimed'], 300 + 10 + 30)
+        self.assertEqual(report['containers'], 1)
+
+    def test_collect(self):
+        client = mock.Mock()
+        client.api.df.return_value = DF
+        client.api.prune_containers.return_value = {
+            'ContainersDeleted': ['c-used-late'], 'SpaceReclaimed': 10}
+        client.api.prune_builds.return_value = {'SpaceReclaimed': 30}
+        client.api.remove_image.side_effect = [None, APIError('conflict'),
+                                               None]
+        report = collect_garbage(client, mock.Mock(), budget=350,
+                                 pin_labels=['keep'], prune_containers=True)
+        self.assertEqual(client.api.remove_image.call_count, 3)
+        self.assertEqual(report['reclaimed'], 10 + 200 + 30)
+        self.assertEqual([image['removed'] for image in report['images']],
+                         [True, False, True])
+        self.assertEqual(len(report['errors']), 1)
+
+    def test_containers_kept_by_default(self):
+        client = mock.Mock()
+        client.api.df.return_value = DF
+        client.api.prune_builds.return_value = {'SpaceReclaimed': 0}
+        collect_garbage(client, mock.Mock(), budget=350)
+        client.api.prune_containers.assert_not_called()
@@ -0,0 +1,84 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import queue
+import unittest
+
+from cloudify_docker.events import (wait_for_exit,
+                                    get_exit_watcher,
+                                    watch_container_exit)
+
+
+class FakeEvents(object):
+
+    def __init__(self):
+        self.queue = queue.Queue()
+
+    def __iter__(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                return
+            yield event
+
+    def die(self, container_id, exit_code):
+        self.queue.put({'id': container_id,
+                        'status': 'die',
+                        'Actor': {'ID': container_id,
+                                  'Attributes': {'exitCode': exit_code}}})
+
+    def close(self):
+        self.queue.put(None)
+
+
+class TestEvents(unittest.TestCase):
+
+    def get_client(self):
+        events = FakeEvents()
+        client = mock.Mock()
+        client.events.return_value = events
+        return client, events
+
+    def test_one_subscription_wakes_many_waiters(self):
+        client, events = self.get_client()
+        first = watch_container_exit(client, 'container1')
+        second = watch_container_exit(client, 'container2')
+        events.die('container2', '3')
+        events.die('container1', '0')
+        self.assertEqual(wait_for_exit(client, first), 0)
+        self.assertEqual(wait_for_exit(client, second), 3)
+        client.events.assert_called_once()
+        client.containers.get.assert_not_called()
+        events.close()
+
+    def test_fallback_to_inspect_when_stream_ends(self):
+        client, events = self.get_client()
+        client.containers.get.return_value = mock.Mock(
+            status='exited', attrs={'State': {'ExitCode': 7}})
+        waiter = watch_container_exit(client, 'container1')
+        events.close()
+        self.assertEqual(wait_for_exit(client, waiter, timeout=5), 7)
+        client.containers.get.assert_called_once_with('container1')
+
+    def test_check_exited_container(self):
+        client, events = self.get_client()
+        client.containers.get.return_value = mock.Mock(
+            status='exited', attrs={'State': {'ExitCode': 1}})
+        waiter = watch_container_exit(client, 'container1',
+                                      check_exited=True)
+        self.assertTrue(waiter.is_set())
+        self.assertEqual(waiter.exit_code, 1)
+        self.assertIs(get_exit_watcher(client), waiter.watcher)
+        events.close()
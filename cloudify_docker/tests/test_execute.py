@@ -0,0 +1,111 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import unittest
+
+from cloudify_docker.execute import SIBLING_LABEL, run_command
+from cloudify_docker.tests.test_streams import frames, stream_socket
+
+
+def container_info(running):
+    return {
+        'Image': 'sha256:img',
+        'State': {'Running': running, 'Paused': False},
+        'Config': {'Env': ['A=1'], 'WorkingDir': '/work', 'User': ''},
+        'HostConfig': {'NetworkMode': 'bridge'},
+    }
+
+
+class TestExecute(unittest.TestCase):
+
+    def run_command(self, client, command='bash /work/stop.sh -f',
+                    timeout=None):
+        stdout, stderr = [], []
+        exit_code = run_command(client, 'c1', command,
+                                lambda chunk: stdout.append(bytes(chunk)),
+                                lambda chunk: stderr.append(bytes(chunk)),
+                                mock.Mock(), timeout=timeout)
+        return exit_code, stdout, stderr
+
+    def test_exec_in_running_container(self):
+        client = mock.Mock()
+        client.api.inspect_container.return_value = container_info(True)
+        client.api.exec_create.return_value = {'Id': 'e1'}
+        client.api.exec_start.return_value = stream_socket(
+            frames((1, b'out'), (2, b'err'), (1, b'more'), (2, b'')))
+        client.api.exec_inspect.return_value = {'ExitCode': 0}
+        exit_code, stdout, stderr = self.run_command(client)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(stdout, [b'out', b'more'])
+        self.assertEqual(stderr, [b'err'])
+        client.api.exec_create.assert_called_once_with(
+            'c1', ['sh', '-c', 'bash /work/stop.sh -f'], stdout=True,
+            stderr=True)
+        client.api.restart.assert_not_called()
+
+    def test_sibling_for_exited_container(self):
+        client = mock.Mock()
+        client.api.inspect_container.return_value = container_info(False)
+        client.api.create_container.return_value = {'Id': 's1'}
+        client.api.attach_socket.return_value = stream_socket(
+            frames((1, b'destroyed')))
+        client.api.wait.return_value = {'StatusCode': 3}
+        exit_code, stdout, stderr = self.run_command(client)
+        self.assertEqual(exit_code, 3)
+        self.assertEqual(stdout, [b'destroyed'])
+        client.api.exec_create.assert_not_called()
+        client.api.create_host_config.assert_called_once_with(
+            volumes_from=['c1'], network_mode='bridge')
+        kwargs = client.api.create_container.call_args[1]
+        self.assertEqual(kwargs['entrypoint'],
+                         ['sh', '-c', 'bash /work/stop.sh -f'])
+        self.assertEqual(kwargs['environment'], ['A=1'])
+        self.assertEqual(kwargs['labels'], {SIBLING_LABEL: 'c1'})
+        client.api.remove_container.assert_called_once_with('s1',
+                                                            force=True)
+
+    def test_command_list_runs_as_is(self):
+        client = mock.Mock()
+        client.api.inspect_container.return_value = container_info(True)
+        client.api.exec_create.return_value = {'Id': 'e1'}
+        client.api.exec_start.return_value = stream_socket(b'')
+        client.api.exec_inspect.return_value = {'ExitCode': 0}
+        self.run_command(client, ['/stop', '-f'])
+        self.assertEqual(client.api.exec_create.call_args[0][1],
+                         ['/stop', '-f'])
+
+    def test_exec_timed_out(self):
+        client = mock.Mock()
+        client.api.inspect_container.return_value = container_info(True)
+        client.api.exec_create.return_value = {'Id': 'e1'}
+        ours, theirs = stream_socket()
+        self.addCleanup(theirs.close)
+        client.api.exec_start.return_value = ours
+        exit_code, _, _ = self.run_command(client, 'sleep 60', timeout=0.1)
+        self.assertIsNone(exit_code)
+        client.api.exec_inspect.assert_not_called()
+
+    def test_sibling_killed_after_timeout(self):
+        client = mock.Mock()
+        client.api.inspect_container.return_value = container_info(False)
+        client.api.create_container.return_value = {'Id': 's1'}
+        ours, theirs = stream_socket()
+        self.addCleanup(theirs.close)
+        client.api.attach_socket.return_value = ours
+        exit_code, _, _ = self.run_command(client, 'sleep 60', timeout=0.1)
+        self.assertIsNone(exit_code)
+        client.api.wait.assert_not_called()
+        client.api.remove_container.assert_called_once_with('s1',
+                                                            force=True)
@@ -0,0 +1,257 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import time
+import zlib
+import shutil
+import tempfile
+import threading
+import unittest
+
+from docker.errors import ImageNotFound, APIError
+
+from cloudify.exceptions import NonRecoverableError
+
+from cloudify_docker.images import (StreamTee,
+                                    pull_image,
+                                    pull_images,
+                                    distribute_image,
+                                    parse_image_name)
+
+
+class FakeRegistryClient(object):
+    """
+    Stand-in for a docker daemon talking to a registry, images maps an
+    image name to its manifest digest in the registry.
+    """
+
+    def __init__(self, registry, local=None, registry_up=True, delay=0):
+        self.registry = registry
+        self.local = dict(local or {})
+        self.registry_up = registry_up
+        self.delay = delay
+        self.pulls = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+        self.images = mock.Mock()
+        self.images.get.side_effect = self._get
+        self.images.get_registry_data.side_effect = self._registry_data
+        self.api = mock.Mock(base_url='http+docker://fake/{0}'.format(
+            id(self)))
+        self.api.pull.side_effect = self._pull
+
+    def _get(self, name):
+        if name not in self.local:
+            raise ImageNotFound(name)
+        return mock.Mock(attrs={'RepoDigests': [
+            '{0}@{1}'.format(name.split(':')[0], self.local[name])]})
+
+    def _registry_data(self, name):
+        if not self.registry_up:
+            raise APIError('registry is down')
+        return mock.Mock(id=self.registry[name])
+
+    def _pull(self, repository, tag=None, **kwargs):
+        name = '{0}:{1}'.format(repository, tag)
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        self.pulls.append(name)
+        events = [
+            {'status': 'Pulling from {0}'.format(repository), 'id': tag},
+            {'status': 'Already exists', 'id': 'layer1'},
+            {'status': 'Downloading', 'id': 'layer2',
+             'progressDetail': {'current': 10, 'total': 20}},
+            {'status': 'Pull complete', 'id': 'layer2'},
+            {'status': 'Digest: {0}'.format(self.registry[name])},
+        ]
+        with self._lock:
+            self.running -= 1
+        self.local[name] = self.registry[name]
+        return iter(events)
+
+
+class FakeTarget(object):
+
+    def __init__(self, name, image_id=None, fail_after=None,
+                 fail_to_connect=False):
+        self.name = name
+        self._image_id = image_id
+        self.fail_after = fail_after
+        self.fail_to_connect = fail_to_connect
+        self.received = b''
+
+    def image_id(self, name):
+        return self._image_id
+
+    def load(self, chunks):
+        if self.fail_to_connect:
+            raise NonRecoverableError('connection refused')
+        for index, chunk in enumerate(chunks):
+            if self.fail_after is not None and index >= self.fail_after:
+                raise NonRecoverableError('disk full')
+            self.received += chunk
+
+
+def saved_image_client(chunks):
+    client = mock.Mock()
+    client.images.get.return_value = mock.Mock(id='sha256:img')
+    client.api.get_image.side_effect = lambda *a, **kw: iter(chunks)
+    return client
+
+
+class TestImages(unittest.TestCase):
+
+    def setUp(self):
+        super(TestImages, self).setUp()
+        self.locks_dir = tempfile.mkdtemp()
+        patcher = mock.patch('cloudify_docker.locks.LOCKS_DIR',
+                             self.locks_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.locks_dir, True)
+
+    def test_parse_image_name(self):
+        self.assertEqual(parse_image_name('localhost:5000/app'),
+                         ('localhost:5000/app', 'latest'))
+        self.assertEqual(parse_image_name('localhost:5000/app:1.0'),
+                         ('localhost:5000/app', '1.0'))
+
+    def test_pull_skipped_when_digest_matches(self):
+        client = FakeRegistryClient({'app:latest': 'sha256:aaa'},
+                                    {'app:latest': 'sha256:aaa'})
+        result = pull_image(client, 'app:latest', mock.Mock())
+        self.assertEqual(result['status'], 'up_to_date')
+        self.assertEqual(client.pulls, [])
+
+    def test_stale_tag_pulled(self):
+        client = FakeRegistryClient({'app:latest': 'sha256:bbb'},
+                                    {'app:latest': 'sha256:aaa'})
+        result = pull_image(client, 'app:latest', mock.Mock())
+        self.assertEqual(result['status'], 'pulled')
+        self.assertEqual(result['digest'], 'sha256:bbb')
+        self.assertEqual(result['layers'], 2)
+        self.assertEqual(result['existing_layers'], 1)
+        self.assertTrue(result['present'])
+        self.assertEqual(client.pulls, ['app:latest'])
+
+    def test_registry_down_uses_local_image(self):
+        client = FakeRegistryClient({'app:latest': 'sha256:bbb'},
+                                    {'app:latest': 'sha256:aaa'},
+                                    registry_up=False)
+        result = pull_image(client, 'app:latest', mock.Mock())
+        self.assertEqual(result['status'], 'up_to_date')
+        self.assertEqual(client.pulls, [])
+
+    def test_concurrent_pulls_limited(self):
+        registry = dict(('app{0}:1.0'.format(i), 'sha256:{0}'.format(i))
+                        for i in range(6))
+        client = FakeRegistryClient(registry, delay=0.05)
+        results = pull_images(client, sorted(registry), mock.Mock(),
+                              concurrency=2)
+        self.assertEqual(sorted(results), sorted(registry))
+        self.assertEqual(len(client.pulls), 6)
+        self.assertEqual(client.max_running, 2)
+
+    def test_pull_limit_follows_concurrency(self):
+        registry = dict(('app{0}:1.0'.format(i), 'sha256:{0}'.format(i))
+                        for i in range(6))
+        for concurrency in (2, 3):
+            client = FakeRegistryClient(registry, delay=0.05)
+            client.api.base_url = 'http+docker://fake/same-daemon'
+            pull_images(client, sorted(registry), mock.Mock(),
+                        concurrency=concurrency)
+            self.assertEqual(client.max_running, concurrency)
+
+    def test_pull_error(self):
+        client = FakeRegistryClient({})
+        client.api.pull.side_effect = None
+        client.api.pull.return_value = iter([{'error': 'manifest unknown'}])
+        self.assertRaises(NonRecoverableError, pull_images, client,
+                          ['missing:1.0'], mock.Mock())
+
+
+class TestDistribution(unittest.TestCase):
+
+    chunks = ['chunk{0}'.format(i).encode() for i in range(50)]
+
+    def test_tee_feeds_every_consumer(self):
+        tee = StreamTee(iter(self.chunks), 2, maxsize=2)
+        received = [[], []]
+        threads = [threading.Thread(
+            target=lambda i=i: received[i].extend(tee.consumer(i)))
+            for i in range(2)]
+        for thread in threads:
+            thread.start()
+        tee.run()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(received, [self.chunks, self.chunks])
+
+    def test_one_save_stream_per_batch(self):
+        client = saved_image_client(self.chunks)
+        targets = [FakeTarget('host{0}'.format(i)) for i in range(3)]
+        results = distribute_image(client, 'app:1.0', targets, mock.Mock(),
+                                   concurrency=3)
+        self.assertEqual(client.api.get_image.call_count, 1)
+        for target in targets:
+            self.assertEqual(results[target.name]['status'], 'loaded')
+            self.assertEqual(target.received, b''.join(self.chunks))
+
+    def test_target_with_image_skipped(self):
+        client = saved_image_client(self.chunks)
+        targets = [FakeTarget('host0', image_id='sha256:img'),
+                   FakeTarget('host1', image_id='sha256:old')]
+        results = distribute_image(client, 'app:1.0', targets, mock.Mock())
+        self.assertEqual(results['host0']['status'], 'skipped')
+        self.assertEqual(results['host1']['status'], 'loaded')
+        self.assertEqual(targets[0].received, b'')
+
+    def test_failed_target_does_not_block_others(self):
+        client = saved_image_client(self.chunks)
+        targets = [FakeTarget('host0', fail_after=1), FakeTarget('host1')]
+        results = distribute_image(client, 'app:1.0', targets, mock.Mock())
+        self.assertEqual(results['host0']['status'], 'failed')
+        self.assertEqual(results['host1']['status'], 'loaded')
+        self.assertEqual(targets[1].received, b''.join(self.chunks))
+
+    def test_target_failing_before_reading(self):
+        client = saved_image_client(self.chunks)
+        targets = [FakeTarget('host0', fail_to_connect=True),
+                   FakeTarget('host1')]
+        results = distribute_image(client, 'app:1.0', targets, mock.Mock())
+        self.assertEqual(results['host0'],
+                         {'status': 'failed', 'error': 'connection refused'})
+        self.assertEqual(results['host1']['status'], 'loaded')
+        self.assertEqual(targets[1].received, b''.join(self.chunks))
+
+    def test_targets_sharing_a_name(self):
+        client = saved_image_client(self.chunks)
+        targets = [FakeTarget('host0', fail_to_connect=True),
+                   FakeTarget('host0'), FakeTarget('host1')]
+        results = distribute_image(client, 'app:1.0', targets, mock.Mock())
+        self.assertEqual(results['host0#0']['status'], 'failed')
+        self.assertEqual(results['host0#1']['status'], 'loaded')
+        self.assertEqual(results['host1']['status'], 'loaded')
+
+    def test_compressed_stream(self):
+        client = saved_image_client(self.chunks)
+        target = FakeTarget('host0')
+        distribute_image(client, 'app:1.0', [target], mock.Mock(),
+                         compress=True)
+        self.assertEqual(zlib.decompress(target.received, 31),
+                         b''.join(self.chunks))
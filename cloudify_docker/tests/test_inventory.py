@@ -0,0 +1,187 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import time
+import unittest
+
+from docker.errors import NotFound
+
+from cloudify_docker.inventory import (IMAGES,
+                                       CONTAINERS,
+                                       Inventory,
+                                       list_inventory,
+                                       refresh_inventory)
+
+
+def api_image(number, tags=None):
+    return {
+        'Id': 'sha256:{0}'.format(str(number) * 64),
+        'RepoTags': tags if tags is not None else ['app:{0}'.format(number)],
+        'Size': number * 10,
+        'Created': 1000 + number,
+        'Labels': None,
+    }
+
+
+class TestInventory(unittest.TestCase):
+
+    def test_images_paginated_newest_first(self):
+        client = mock.Mock()
+        client.api.images.return_value = [api_image(i) for i in range(5)]
+        inventory = list_inventory(client, IMAGES, limit=2, offset=1,
+                                   filters={'dangling': False})
+        client.api.images.assert_called_once_with(
+            all=True, filters={'dangling': False})
+        self.assertEqual(inventory.total, 5)
+        self.assertEqual(sorted(item['created'] for item in
+                                inventory.items.values()), [1002, 1003])
+
+    def test_dangling_image_has_no_tags(self):
+        client = mock.Mock()
+        client.api.images.return_value = [
+            api_image(1, tags=['<none>:<none>'])]
+        inventory = list_inventory(client, IMAGES)
+        self.assertEqual(list(inventory.items.values())[0]['tags'], [])
+
+    def test_lookup(self):
+        client = mock.Mock()
+        client.api.images.return_value = [api_image(1), api_image(2)]
+        inventory = list_inventory(client, IMAGES)
+        self.assertEqual(inventory.get('app:2')['size'], 20)
+        self.assertIn('1111111111', inventory)
+        self.assertNotIn('app:3', inventory)
+        client.api.containers.return_value = [
+            {'Id': 'abc123', 'Names': ['/web'], 'State': 'exited',
+             'Created': 1}]
+        containers = list_inventory(client, CONTAINERS)
+        self.assertEqual(containers.get('web')['state'], 'exited')
+
+    def test_round_trip(self):
+        inventory = Inventory(IMAGES, {'sha256:1': {
+            'id': 'sha256:1', 'tags': ['a:1'], 'size': 1, 'created': 1}},
+            total=1)
+        restored = Inventory.from_dict(IMAGES, inventory.to_dict())
+        self.assertEqual(restored.get('a:1'), inventory.get('a:1'))
+        self.assertEqual(restored.total, 1)
+
+
+def image_event(action, ref):
+    return {'Type': 'image', 'Action': action, 'Actor': {'ID': ref}}
+
+
+def container_event(action, ref):
+    return {'Type': 'container', 'Action': action, 'Actor': {'ID': ref}}
+
+
+class TestRefreshInventory(unittest.TestCase):
+
+    def previous_images(self, age=10):
+        inventory = Inventory(IMAGES, dict(
+            (image['id'], image) for image in [
+                {'id': 'sha256:old', 'tags': ['app:1.0'], 'size': 1,
+                 'created': 1},
+                {'id': 'sha256:gone', 'tags': ['db:1.0'], 'size': 1,
+                 'created': 1},
+            ]), total=2)
+        inventory.last_event = int(time.time()) - age
+        return inventory
+
+    def test_images_deltas_applied(self):
+        client = mock.Mock()
+        client.events.return_value = iter([
+            image_event('pull', 'app:1.0'),
+            image_event('delete', 'sha256:gone'),
+        ])
+        client.api.inspect_image.return_value = {
+            'Id': 'sha256:new', 'RepoTags': ['app:1.0'], 'Size': 5,
+            'Created': '2020-04-08T23:43:17.123456789Z'}
+        inventory = refresh_inventory(client, self.previous_images(),
+                                      IMAGES)
+        client.api.images.assert_not_called()
+        self.assertEqual(sorted(inventory.items), ['sha256:new',
+                                                   'sha256:old'])
+        # the tag moved to the new image
+        self.assertEqual(inventory.get('app:1.0')['id'], 'sha256:new')
+        self.assertEqual(inventory.items['sha256:old']['tags'], [])
+        self.assertEqual(inventory.items['sha256:new']['created'],
+                         1586389397)
+        self.assertEqual(inventory.total, 2)
+        self.assertEqual(client.events.call_args[1]['filters'],
+                         {'type': 'image'})
+
+    def test_image_not_matching_filters_dropped(self):
+        client = mock.Mock()
+        client.events.return_value = iter([image_event('tag',
+                                                       'sha256:old')])
+        client.api.inspect_image.return_value = {
+            'Id': 'sha256:old', 'RepoTags': ['app:1.0'], 'Size': 1,
+            'Created': 1, 'Config': {'Labels': {'team': 'b'}}}
+        inventory = refresh_inventory(client, self.previous_images(),
+                                      IMAGES, filters={'label': 'team=a'})
+        self.assertNotIn('sha256:old', inventory.items)
+
+    def test_full_listing_when_gap_too_large(self):
+        client = mock.Mock()
+        client.api.images.return_value = []
+        inventory = refresh_inventory(client,
+                                      self.previous_images(age=100),
+                                      IMAGES, max_gap=50)
+        client.events.assert_not_called()
+        self.assertEqual(len(inventory), 0)
+        self.assertTrue(inventory.last_event >= time.time() - 5)
+
+    def test_full_listing_when_too_many_events(self):
+        client = mock.Mock()
+        client.events.return_value = iter(
+            [image_event('tag', 'sha256:old')] * 1000)
+        client.api.images.return_value = []
+        refresh_inventory(client, self.previous_images(), IMAGES)
+        client.api.images.assert_called_once()
+        client.api.inspect_image.assert_not_called()
+
+    def test_containers_deltas_applied(self):
+        previous = Inventory(CONTAINERS, {
+            'c1': {'id': 'c1', 'name': 'web', 'state': 'running',
+                   'created': 1},
+            'c2': {'id': 'c2', 'name': 'db', 'state': 'running',
+                   'created': 1},
+        }, total=2, last_event=int(time.time()) - 10)
+        client = mock.Mock()
+        client.events.return_value = iter([
+            container_event('die', 'c1'),
+            container_event('destroy', 'c2'),
+            container_event('create', 'c3'),
+            container_event('exec_start: ls', 'c1'),
+        ])
+        client.api.containers.return_value = [
+            {'Id': 'c1', 'Names': ['/web'], 'State': 'exited',
+             'Created': 1},
+            {'Id': 'c3', 'Names': ['/new'], 'State': 'created',
+             'Created': 2}]
+        inventory = refresh_inventory(client, previous, CONTAINERS,
+                                      filters={'label': 'app'})
+        client.api.containers.assert_called_once_with(
+            all=True, filters={'label': 'app', 'id': ['c1', 'c3']})
+        self.assertEqual(sorted(inventory.items), ['c1', 'c3'])
+        self.assertEqual(inventory.get('web')['state'], 'exited')
+
+    def test_deleted_image_not_found(self):
+        client = mock.Mock()
+        client.events.return_value = iter([image_event('untag',
+                                                       'sha256:old')])
+        client.api.inspect_image.side_effect = NotFound('gone')
+        inventory = refresh_inventory(client, self.previous_images(),
+                                      IMAGES)
+        self.assertNotIn('sha256:old', inventory.items)
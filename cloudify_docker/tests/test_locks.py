@@ -0,0 +1,104 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import mock
+import time
+import fcntl
+import shutil
+import tempfile
+import threading
+import unittest
+
+from cloudify_docker.locks import single_flight, _lock_file
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSingleFlight, self).setUp()
+        self.locks_dir = tempfile.mkdtemp()
+        patcher = mock.patch('cloudify_docker.locks.LOCKS_DIR',
+                             self.locks_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.locks_dir, True)
+
+    def test_only_one_caller_does_the_work(self):
+        work = []
+        results = []
+
+        def _call():
+            with single_flight('tcp://host:2375', 'pull:app') as flight:
+                if flight.result:
+                    results.append(flight.result)
+                    return
+                time.sleep(0.1)
+                work.append(1)
+                flight.publish({'digest': 'sha256:aaa'})
+                results.append({'digest': 'sha256:aaa'})
+
+        threads = [threading.Thread(target=_call) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(work), 1)
+        self.assertEqual(results, [{'digest': 'sha256:aaa'}] * 5)
+
+    def test_old_result_not_reused(self):
+        with single_flight('tcp://host:2375', 'pull:app') as flight:
+            flight.publish({'digest': 'sha256:aaa'})
+        with single_flight('tcp://host:2375', 'pull:app') as flight:
+            self.assertFalse(flight.waited)
+            self.assertIsNone(flight.result)
+
+    def test_keys_are_per_host(self):
+        with single_flight('tcp://host1:2375', 'build:app') as first:
+            with single_flight('tcp://host2:2375', 'build:app') as second:
+                self.assertFalse(first.waited)
+                self.assertFalse(second.waited)
+
+    def test_lock_files_removed(self):
+        with single_flight('tcp://host:2375', 'pull:app') as flight:
+            flight.publish({'digest': 'sha256:aaa'})
+        self.assertEqual([name for name in os.listdir(self.locks_dir)
+                          if name.endswith('.lock')], [])
+        result = flight.result_path
+        os.utime(result, (time.time() - 7200,) * 2)
+        with mock.patch('cloudify_docker.locks._last_sweep', [0]):
+            with single_flight('tcp://host:2375', 'pull:other',
+                               timeout=3600):
+                pass
+        self.assertEqual(os.listdir(self.locks_dir), [])
+
+    def test_lock_file_removed_by_holder(self):
+        # another process holds the lock, and removes the file when done
+        lock_path = os.path.join(self.locks_dir, 'name.lock')
+        holder = open(lock_path, 'a')
+        fcntl.flock(holder, fcntl.LOCK_EX)
+        locked = []
+        flight = mock.Mock()
+        waiter = threading.Thread(target=lambda: locked.append(_lock_file(
+            lock_path, 'key', 'url', time.time(), 10, flight)))
+        waiter.start()
+        time.sleep(0.2)
+        os.unlink(lock_path)
+        fcntl.flock(holder, fcntl.LOCK_UN)
+        holder.close()
+        waiter.join(5)
+        self.assertTrue(flight.waited)
+        self.assertTrue(os.path.samestat(os.fstat(locked[0].fileno()),
+                                         os.stat(lock_path)))
+        locked[0].close()
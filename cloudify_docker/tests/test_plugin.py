@@ -13,20 +13,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import mock
+import time
+import shutil
+import tempfile
 import unittest
+import threading
 
 from os import (path, mkdir)
 from uuid import uuid1
 
 from cloudify.state import current_ctx
+from cloudify.exceptions import NonRecoverableError
+from docker.errors import ImageNotFound, NotFound
 # from cloudify.test_utils import workflow_test
 from cloudify.mocks import MockCloudifyContext
 
+from cloudify_docker.build import BUILD_HASH_LABEL, build_hash
+from cloudify_docker.events import ExitWaiter
+from cloudify_docker.client_cache import close_docker_clients
+from cloudify_docker.tests.test_events import FakeEvents
+from cloudify_docker.tests.test_streams import frames, stream_socket
 from cloudify_docker.tasks import (build_image,
                                    list_images,
                                    remove_image,
+                                   start_container,
+                                   remove_container,
                                    list_containers,
                                    list_host_details,
+                                   follow_container_logs,
+                                   stop_and_wait,
                                    find_host_script_path,
                                    remove_container_files,
                                    prepare_container_files)
@@ -36,6 +51,14 @@ class TestPlugin(unittest.TestCase):
 
     def setUp(self):
         super(TestPlugin, self).setUp()
+        # every test mocks its own docker client
+        close_docker_clients()
+        self.locks_dir = tempfile.mkdtemp()
+        patcher = mock.patch('cloudify_docker.locks.LOCKS_DIR',
+                             self.locks_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.locks_dir, True)
 
     def get_client_conf_props(self):
         return {
@@ -57,19 +80,67 @@ class TestPlugin(unittest.TestCase):
         )
         return ctx
 
+    def test_follow_logs_reads_output_after_exit(self):
+        ctx = self.mock_ctx('test_follow_logs_reads_output_after_exit', {})
+        current_ctx.set(ctx=ctx)
+        ours, theirs = stream_socket()
+        chunk = frames((1, b'x' * 1024 * 1024))
+
+        def write():
+            # slower than a poll, the exit event came before the end
+            for _ in range(12):
+                theirs.sendall(chunk)
+                time.sleep(0.1)
+            theirs.sendall(frames((2, b'last error\n')))
+            theirs.close()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        self.addCleanup(writer.join)
+        client = mock.Mock()
+        client.api.attach_socket.return_value = ours
+        container = mock.Mock(id='c1', attrs={'Config': {}})
+        exit_waiter = ExitWaiter('c1')
+        exit_waiter.set(1)
+        sink = mock.Mock()
+        output = follow_container_logs(ctx, client, container, sink=sink,
+                                       exit_waiter=exit_waiter)
+        self.assertEqual(
+            sum(len(call[0][0]) for call in sink.write.call_args_list),
+            12 * 1024 * 1024 + len('last error\n'))
+        self.assertTrue(output.endswith('last error\n'))
+        self.assertEqual(ctx.instance.runtime_properties['exit_code'], 1)
+
+    def test_stop_exited_container(self):
+        ctx = self.mock_ctx('test_stop_exited_container', {})
+        current_ctx.set(ctx=ctx)
+        events = FakeEvents()
+        self.addCleanup(events.close)
+        client = mock.Mock()
+        client.events.return_value = events
+        container = mock.Mock(id='c1', status='exited',
+                              attrs={'State': {'ExitCode': 0}})
+        client.containers.get.return_value = container
+        started = time.time()
+        self.assertEqual(stop_and_wait(ctx, client, container), 0)
+        # no die event comes, it didn't wait for one
+        self.assertLess(time.time() - started, 1)
+        container.stop.assert_called_once_with()
+
     def test_list_images(self):
         ctx = self.mock_ctx('test_list_images', self.get_client_conf_props())
         current_ctx.set(ctx=ctx)
 
-        images = {
-            "Image1": {
-                "Created": 1586389397,
-                "Id": "sha256:ef5bbc24923e"
-            }
-        }
+        images = [{
+            "Created": 1586389397,
+            "Id": "sha256:ef5bbc24923e",
+            "RepoTags": ["app:1.0"],
+            "Size": 1024,
+            "Labels": {"a": "b"},
+        }]
 
         mock_images_list = mock.Mock()
-        mock_images_list.images.list.return_value = images
+        mock_images_list.api.images.return_value = images
         mock_client = mock.MagicMock(return_value=mock_images_list)
 
         with mock.patch('docker.DockerClient', mock_client):
@@ -77,8 +148,20 @@ class TestPlugin(unittest.TestCase):
                 'ctx': ctx
             }
             list_images(**kwargs)
-            self.assertEqual(ctx.instance.runtime_properties['images'],
-                             images)
+            mock_images_list.api.images.assert_called_with(
+                all=True, filters={})
+            self.assertEqual(ctx.instance.runtime_properties['images'], {
+                'items': {
+                    'sha256:ef5bbc24923e': {
+                        'id': 'sha256:ef5bbc24923e',
+                        'tags': ['app:1.0'],
+                        'size': 1024,
+                        'created': 1586389397,
+                    }
+                },
+                'total': 1,
+                'last_event': None,
+            })
 
     def test_list_host_details(self):
         ctx = self.mock_ctx('test_list_host_details',
@@ -107,19 +190,24 @@ class TestPlugin(unittest.TestCase):
                              details)
 
     def test_list_containers(self):
-        ctx = self.mock_ctx('test_list_containers',
-                            self.get_client_conf_props())
-        current_ctx.set(ctx=ctx)
-
-        containers = {
-            "Contianer1": {
-                "Created": 1586389397,
-                "Id": "sha256:e2231923e"
-            }
+        containers = [{
+            "Created": 1586389397,
+            "Id": "e2231923e",
+            "Names": ["/web"],
+            "Image": "app:1.0",
+            "State": "running",
+            "Status": "Up 2 hours",
+        }]
+        props = self.get_client_conf_props()
+        props['resource_config'] = {
+            'filters': {'status': 'running'},
+            'limit': 10,
         }
+        ctx = self.mock_ctx('test_list_containers', props)
+        current_ctx.set(ctx=ctx)
 
         mock_containers_list = mock.Mock()
-        mock_containers_list.containers.list.return_value = containers
+        mock_containers_list.api.containers.return_value = containers
         mock_client = mock.MagicMock(return_value=mock_containers_list)
 
         with mock.patch('docker.DockerClient', mock_client):
@@ -127,8 +215,13 @@ class TestPlugin(unittest.TestCase):
                 'ctx': ctx
             }
             list_containers(**kwargs)
-            self.assertEqual(ctx.instance.runtime_properties['contianers'],
-                             containers)
+            mock_containers_list.api.containers.assert_called_with(
+                all=True, filters={'status': 'running'}, limit=10)
+            inventory = ctx.instance.runtime_properties['contianers']
+            self.assertEqual(inventory['total'], None)
+            self.assertEqual(inventory['items']['e2231923e']['name'], 'web')
+            self.assertEqual(inventory['items']['e2231923e']['state'],
+                             'running')
 
     def test_prepare_container_files(self):
         docker_host = "127.0.0.1"
@@ -205,11 +298,9 @@ class TestPlugin(unittest.TestCase):
         build_result = [
             {"stream": "Step 1/1 : FROM amd64/centos:7"},
             {"stream": "\n"},
-            {"stream": " ---\u003e 5e35e350aded\n"}
+            {"stream": " ---\u003e 5e35e350aded\n"},
+            {"stream": "Successfully built 5e35e350aded\n"}
         ]
-        build_result_prop = ""
-        for chunk in build_result:
-            build_result_prop += "{0}\n".format(chunk)
 
         image_get = [{
             "Created": 1586512602,
@@ -236,8 +327,9 @@ class TestPlugin(unittest.TestCase):
         current_ctx.set(ctx=ctx)
 
         mock_images = mock.Mock()
-        mock_images.images.build.return_value = ("Id", iter(build_result))
-        mock_images.images.get.return_value = image_get
+        mock_images.api.build.return_value = iter(build_result)
+        mock_images.images.get.side_effect = [ImageNotFound('test:1.0'),
+                                              image_get]
         mock_client = mock.MagicMock(return_value=mock_images)
 
         with mock.patch('docker.DockerClient', mock_client):
@@ -245,13 +337,130 @@ class TestPlugin(unittest.TestCase):
                 'ctx': ctx
             }
             build_image(**kwargs)
+            build_summary = ctx.instance.runtime_properties['build_result']
+            self.assertEqual(build_summary['image_id'], '5e35e350aded')
+            self.assertIsNone(build_summary['error'])
+            self.assertEqual(len(build_summary['steps']), 1)
+            self.assertEqual(build_summary['steps'][0]['instruction'],
+                             'FROM amd64/centos:7')
+            self.assertEqual(build_summary['steps'][0]['cache'], 'miss')
+            self.assertEqual(
+                ctx.instance.runtime_properties['build_status'], 'built')
+            labels = mock_images.api.build.call_args[1]['labels']
             self.assertEqual(
-                ctx.instance.runtime_properties['build_result'],
-                build_result_prop)
+                labels[BUILD_HASH_LABEL],
+                ctx.instance.runtime_properties['build_hash'])
             self.assertEqual(
                 ctx.instance.runtime_properties['image'],
                 repr(image_get))
 
+    def test_build_image_skipped_when_unchanged(self):
+        node_props = self.get_client_conf_props()
+        node_props.update({
+            "resource_config": {
+                "image_content": "FROM amd64/centos:7",
+                "tag": "test:1.0"
+            }
+        })
+        ctx = self.mock_ctx('test_build_image_skipped_when_unchanged',
+                            node_props)
+        current_ctx.set(ctx=ctx)
+
+        existing_image = mock.Mock(
+            id='sha256:e9abf53b02b1',
+            labels={BUILD_HASH_LABEL: build_hash('FROM amd64/centos:7')})
+        mock_images = mock.Mock()
+        mock_images.images.get.return_value = existing_image
+        mock_client = mock.MagicMock(return_value=mock_images)
+
+        with mock.patch('docker.DockerClient', mock_client):
+            build_image(ctx=ctx)
+        mock_images.api.build.assert_not_called()
+        self.assertEqual(ctx.instance.runtime_properties['build_status'],
+                         'build_skipped')
+        self.assertEqual(
+            ctx.instance.runtime_properties['build_result']['image_id'],
+            'sha256:e9abf53b02b1')
+
+        # a changed Dockerfile is built again
+        existing_image.labels = {BUILD_HASH_LABEL: 'other'}
+        mock_images.api.build.return_value = iter([])
+        with mock.patch('docker.DockerClient', mock_client):
+            build_image(ctx=ctx)
+        mock_images.api.build.assert_called_once()
+
+    def test_build_image_options(self):
+        node_props = self.get_client_conf_props()
+        node_props.update({
+            "resource_config": {
+                "image_content": "FROM amd64/centos:7",
+                "tag": "test:1.0",
+                "cache_from": ["registry/test:cache"],
+                "buildargs": {"VERSION": "1"},
+                "target": "runtime",
+            }
+        })
+        ctx = self.mock_ctx('test_build_image_options', node_props)
+        current_ctx.set(ctx=ctx)
+
+        mock_images = mock.Mock()
+        mock_images.images.get.side_effect = [
+            ImageNotFound('test:1.0'),
+            ImageNotFound('registry/test:cache'),
+            mock.Mock()]
+        mock_images.api.build.return_value = iter([])
+        mock_client = mock.MagicMock(return_value=mock_images)
+
+        with mock.patch('docker.DockerClient', mock_client):
+            build_image(ctx=ctx)
+        mock_images.images.pull.assert_called_once_with('registry/test:cache')
+        build_kwargs = mock_images.api.build.call_args[1]
+        self.assertEqual(build_kwargs['cache_from'], ['registry/test:cache'])
+        self.assertEqual(build_kwargs['buildargs'], {"VERSION": "1"})
+        self.assertEqual(build_kwargs['target'], 'runtime')
+        self.assertTrue(build_kwargs['rm'])
+        self.assertNotIn('network_mode', build_kwargs)
+        self.assertEqual(
+            build_kwargs['labels'][BUILD_HASH_LABEL],
+            build_hash('FROM amd64/centos:7', None,
+                       {'buildargs': {"VERSION": "1"}, 'target': 'runtime'}))
+
+    def test_build_image_stops_on_first_error(self):
+        node_props = self.get_client_conf_props()
+        node_props.update({
+            "resource_config": {
+                "image_content": "FROM amd64/centos:7\\nRUN false",
+                "tag": "test:1.0"
+            }
+        })
+        build_result = iter([
+            {"stream": "Step 1/2 : FROM amd64/centos:7\n"},
+            {"stream": " ---> Using cache\n"},
+            {"stream": "Step 2/2 : RUN false\n"},
+            {"errorDetail": {"code": 1, "message": "returned 1"},
+             "error": "returned 1"},
+            {"stream": "never read\n"},
+        ])
+        ctx = self.mock_ctx('test_build_image_stops_on_first_error',
+                            node_props)
+        current_ctx.set(ctx=ctx)
+
+        mock_images = mock.Mock()
+        mock_images.images.get.side_effect = ImageNotFound('test:1.0')
+        mock_images.api.build.return_value = build_result
+        mock_client = mock.MagicMock(return_value=mock_images)
+
+        with mock.patch('docker.DockerClient', mock_client):
+            self.assertRaises(NonRecoverableError, build_image, ctx=ctx)
+        # the rest of the stream was not consumed
+        self.assertEqual(next(build_result), {"stream": "never read\n"})
+        build_summary = ctx.instance.runtime_properties['build_result']
+        self.assertEqual(build_summary['status'], 'failed')
+        self.assertEqual(build_summary['error'], 'returned 1')
+        self.assertEqual([step['cache'] for step in build_summary['steps']],
+                         ['hit', 'miss'])
+        mock_images.images.get.assert_called_once_with('test:1.0')
+
     def test_remove_image(self):
         node_props = self.get_client_conf_props()
         node_props.update({
@@ -288,6 +497,61 @@ class TestPlugin(unittest.TestCase):
             self.assertIsNone(
                 ctx.instance.runtime_properties.get('build_result', None))
 
+    def test_remove_container_already_removed(self):
+        ctx = self.mock_ctx('test_remove_container_already_removed',
+                            self.get_client_conf_props(),
+                            {'container': 'c1', 'run_result': 'done'})
+        current_ctx.set(ctx=ctx)
+        mock_containers = mock.Mock()
+        mock_containers.containers.get.side_effect = NotFound('pruned')
+        mock_client = mock.MagicMock(return_value=mock_containers)
+
+        with mock.patch('docker.DockerClient', mock_client):
+            remove_container(ctx=ctx)
+        self.assertNotIn('container', ctx.instance.runtime_properties)
+        self.assertNotIn('run_result', ctx.instance.runtime_properties)
+
+    def test_remove_replicas(self):
+        ctx = self.mock_ctx('test_remove_replicas',
+                            self.get_client_conf_props(),
+                            {'replicas': [{'id': 'r0', 'name': 'web-0'},
+                                          {'id': 'r1', 'name': 'web-1'}],
+                             'stop_result': {'exit_code': 0}})
+        current_ctx.set(ctx=ctx)
+        mock_containers = mock.Mock()
+        mock_containers.api.inspect_container.return_value = {
+            'Name': '/web', 'State': {'Running': False}}
+        mock_client = mock.MagicMock(return_value=mock_containers)
+
+        with mock.patch('docker.DockerClient', mock_client):
+            remove_container(ctx=ctx)
+        self.assertEqual(ctx.instance.runtime_properties, {})
+        self.assertEqual(
+            sorted(mock_containers.api.remove_container.call_args_list),
+            [mock.call('r0', v=False, force=True),
+             mock.call('r1', v=False, force=True)])
+
+    def test_start_pooled_job(self):
+        properties = self.get_client_conf_props()
+        properties['resource_config'] = {
+            'image_tag': 'ansible:1.0',
+            'container_args': {'command': 'site.yaml'},
+            'warm_pool': {'enabled': True, 'size': 2}}
+        ctx = self.mock_ctx('test_start_pooled_job', properties,
+                            {'warm_container': 'p1',
+                             'container_args': {'command': 'site.yaml',
+                                                'working_dir': '/work'}})
+        current_ctx.set(ctx=ctx)
+        mock_client = mock.MagicMock(return_value=mock.Mock())
+
+        with mock.patch('docker.DockerClient', mock_client):
+            with mock.patch('cloudify_docker.tasks.run_in_warm_pool') as run:
+                start_container(ctx=ctx)
+        run.assert_called_once_with(
+            ctx, mock.ANY, 'ansible:1.0',
+            {'command': 'site.yaml', 'working_dir': '/work'},
+            {'enabled': True, 'size': 2})
+
     def test_if_volume_mapping_in_script(self):
         containers = {
             "Contianer1": {
@@ -0,0 +1,176 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import time
+import shutil
+import tempfile
+import unittest
+
+from docker.errors import NotFound
+
+from cloudify_docker.pool import (POOL_LABEL,
+                                  WarmPool,
+                                  pool_key,
+                                  job_command)
+from cloudify_docker.execute import exec_command
+from cloudify_docker.tests.test_streams import frames, stream_socket
+
+
+class FakeDaemon(object):
+    """Stand-in for the docker daemon of the pooled containers."""
+
+    def __init__(self):
+        self.containers_state = {}
+        self.labels = {}
+        self.created = 0
+        self.containers = mock.Mock()
+        self.containers.create.side_effect = self._create
+        self.api = mock.Mock(base_url='http+docker://fake/{0}'.format(
+            id(self)))
+        self.api.containers.side_effect = self._list
+        self.api.remove_container.side_effect = self._remove
+        self.api.pause.side_effect = self._set_state('paused')
+        self.api.unpause.side_effect = self._set_state('running')
+
+    def _create(self, image, entrypoint, labels, **kwargs):
+        self.created += 1
+        container_id = 'c{0}'.format(self.created)
+        self.containers_state[container_id] = 'created'
+        self.labels[container_id] = labels
+        container = mock.Mock(id=container_id)
+        container.start.side_effect = self._set_state('running',
+                                                      container_id)
+        return container
+
+    def _set_state(self, state, container_id=None):
+        def _set(cid=None):
+            self.containers_state[container_id or cid] = state
+        return _set
+
+    def _list(self, all=False, filters=None):
+        key, value = filters['label'].split('=', 1)
+        return [{'Id': cid, 'State': state}
+                for cid, state in self.containers_state.items()
+                if self.labels[cid].get(key) == value]
+
+    def _remove(self, container_id, force=False):
+        if container_id not in self.containers_state:
+            raise NotFound(container_id)
+        self.containers_state.pop(container_id)
+
+
+class TestWarmPool(unittest.TestCase):
+
+    def setUp(self):
+        super(TestWarmPool, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        for name in ('cloudify_docker.locks.LOCKS_DIR',
+                     'cloudify_docker.pool.POOLS_DIR'):
+            patcher = mock.patch(name, self.tmp_dir)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+        self.daemon = FakeDaemon()
+
+    def pool(self, **kwargs):
+        return WarmPool(self.daemon, 'ansible:1.0',
+                        {'command': 'site.yaml', 'volumes': ['/work']},
+                        mock.Mock(), **kwargs)
+
+    def test_key_ignores_job_options(self):
+        self.assertEqual(
+            pool_key('app', {'command': 'a', 'environment': {'A': 1},
+                             'volumes': ['/v']}),
+            pool_key('app', {'command': 'b', 'volumes': ['/v']}))
+        self.assertNotEqual(pool_key('app', {'volumes': ['/v']}),
+                            pool_key('app', {'volumes': ['/w']}))
+
+    def test_container_reused(self):
+        pool = self.pool(size=1)
+        with pool.lease() as first:
+            self.assertEqual(self.daemon.containers_state[first], 'running')
+            self.assertEqual(self.daemon.labels[first][POOL_LABEL],
+                             pool.key)
+        self.assertEqual(self.daemon.containers_state[first], 'paused')
+        with self.pool(size=1).lease() as second:
+            self.assertEqual(second, first)
+            self.assertEqual(self.daemon.containers_state[first], 'running')
+        self.assertEqual(self.daemon.created, 1)
+
+    def test_fill(self):
+        pool = self.pool(size=3)
+        self.assertEqual(pool.fill(), 3)
+        self.assertEqual(pool.fill(), 0)
+        self.assertEqual(sorted(self.daemon.containers_state.values()),
+                         ['paused'] * 3)
+
+    def test_max_reuse(self):
+        pool = self.pool(max_reuse=2)
+        for _ in range(2):
+            with pool.lease() as container_id:
+                pass
+        self.assertNotIn(container_id, self.daemon.containers_state)
+        with pool.lease() as new_container_id:
+            self.assertNotEqual(new_container_id, container_id)
+
+    def test_idle_ttl(self):
+        pool = self.pool(idle_ttl=0)
+        with pool.lease() as container_id:
+            pass
+        time.sleep(0.01)
+        with pool.lease() as new_container_id:
+            pass
+        self.assertNotEqual(new_container_id, container_id)
+        self.assertNotIn(container_id, self.daemon.containers_state)
+
+    def test_failed_job_container_removed(self):
+        pool = self.pool()
+        try:
+            with pool.lease() as container_id:
+                raise RuntimeError('exec failed')
+        except RuntimeError:
+            pass
+        self.assertNotIn(container_id, self.daemon.containers_state)
+
+    def test_surplus_container_removed(self):
+        pool = self.pool(size=1)
+        with pool.lease() as first:
+            with pool.lease() as second:
+                self.assertNotEqual(first, second)
+        self.assertEqual(list(self.daemon.containers_state), [second])
+
+    def test_job_command_and_exec(self):
+        self.daemon.api.inspect_image.return_value = {
+            'Config': {'Entrypoint': ['ansible-playbook'], 'Cmd': ['-h']}}
+        self.assertEqual(job_command(self.daemon, 'ansible:1.0',
+                                     {'command': '-i hosts site.yaml'}),
+                         ['ansible-playbook', '-i', 'hosts', 'site.yaml'])
+        self.assertEqual(job_command(self.daemon, 'ansible:1.0',
+                                     {'entrypoint': ['sh', '-c']}),
+                         ['sh', '-c'])
+        self.daemon.api.exec_create.return_value = {'Id': 'e1'}
+        self.daemon.api.exec_start.return_value = stream_socket(
+            frames((1, b'ok\n'), (2, b'done\n')))
+        self.daemon.api.exec_inspect.return_value = {'ExitCode': 2}
+        output = []
+
+        def feed(chunk):
+            output.append(bytes(chunk))
+        self.assertEqual(exec_command(self.daemon, 'c1', ['ls'], feed, feed,
+                                      workdir='/work'),
+                         2)
+        self.assertEqual(output, [b'ok\n', b'done\n'])
+        self.daemon.api.exec_create.assert_called_once_with(
+            'c1', ['ls'], stdout=True, stderr=True, workdir='/work')
@@ -0,0 +1,131 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import socket
+import unittest
+
+from cloudify.exceptions import NonRecoverableError
+
+from cloudify_docker.events import ExitWaiter
+from cloudify_docker.readiness import (ReadinessGate,
+                                       backoff_delays,
+                                       port_addresses)
+from cloudify_docker.tests.test_streams import frames, stream_socket
+
+
+def container_info(health=None, port=None):
+    info = {
+        'State': {'Running': True},
+        'Config': {'Tty': False},
+        'NetworkSettings': {'IPAddress': '', 'Ports': {}, 'Networks': {}},
+    }
+    if health:
+        info['State']['Health'] = {'Status': health}
+    if port:
+        info['NetworkSettings']['Ports']['80/tcp'] = [
+            {'HostIp': '127.0.0.1', 'HostPort': str(port)}]
+    return info
+
+
+class Events(list):
+
+    def close(self):
+        pass
+
+
+class TestReadiness(unittest.TestCase):
+
+    def setUp(self):
+        super(TestReadiness, self).setUp()
+        patcher = mock.patch('cloudify_docker.readiness.watch_container_exit',
+                             lambda *args, **kwargs: ExitWaiter('c1'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = mock.Mock()
+        self.client.api.base_url = 'http+docker://localhost'
+
+    def gate(self, **kwargs):
+        kwargs.setdefault('timeout', 5)
+        kwargs.setdefault('initial_delay', 0.01)
+        kwargs.setdefault('max_delay', 0.05)
+        return ReadinessGate(self.client, 'c1', mock.Mock(), **kwargs)
+
+    def test_backoff_delays(self):
+        delays = backoff_delays(initial=1, maximum=4)
+        caps = [1, 2, 4, 4, 4]
+        for cap in caps:
+            self.assertTrue(0 <= next(delays) <= cap)
+
+    def test_port_addresses(self):
+        self.client.api.base_url = 'https://10.0.0.5:2376'
+        info = container_info()
+        info['NetworkSettings']['Ports']['80/tcp'] = [
+            {'HostIp': '0.0.0.0', 'HostPort': '8080'}]
+        info['NetworkSettings']['Networks'] = {
+            'bridge': {'IPAddress': '172.17.0.2'}}
+        self.assertEqual(port_addresses(self.client, info, 80),
+                         [('10.0.0.5', 8080), ('172.17.0.2', 80)])
+
+    def test_no_healthcheck_skipped(self):
+        self.client.api.inspect_container.return_value = container_info()
+        self.assertGreaterEqual(self.gate().wait(), 0)
+        self.client.api.events.assert_not_called()
+        self.client.api.inspect_container.return_value = container_info()
+        with self.assertRaises(NonRecoverableError):
+            self.gate(health=True).wait()
+
+    def test_healthy_event(self):
+        self.client.api.inspect_container.return_value = \
+            container_info('starting')
+        self.client.api.events.return_value = Events([
+            {'Action': 'health_status: unhealthy'},
+            {'Action': 'health_status: healthy'}])
+        self.gate().wait()
+        filters = self.client.api.events.call_args[1]['filters']
+        self.assertEqual(filters['container'], 'c1')
+
+    def test_died_before_ready(self):
+        self.client.api.inspect_container.return_value = \
+            container_info('starting')
+        self.client.api.events.return_value = Events([
+            {'Action': 'die', 'Actor': {'Attributes': {'exitCode': '1'}}}])
+        with self.assertRaisesRegex(NonRecoverableError, 'exited with 1'):
+            self.gate().wait()
+
+    def test_log_pattern(self):
+        self.client.api.inspect_container.return_value = container_info()
+        self.client.api.attach_socket.return_value = stream_socket(
+            frames((1, b'starting\nlisten'), (2, b'ing on 80\nmore\n')))
+        self.gate(health=False, log_pattern=r'listening on \d+').wait()
+
+    def test_port(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        self.client.api.inspect_container.return_value = container_info(
+            port=server.getsockname()[1])
+        self.gate(health=False, port=80).wait()
+
+    def test_port_deadline(self):
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        port = closed.getsockname()[1]
+        closed.close()
+        self.client.api.inspect_container.return_value = container_info(
+            port=port)
+        with self.assertRaisesRegex(NonRecoverableError, 'port 80'):
+            self.gate(health=False, port=80, timeout=0.2).wait()
+        self.assertGreater(self.client.api.inspect_container.call_count, 2)
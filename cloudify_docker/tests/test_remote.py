@@ -0,0 +1,194 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import mock
+import time
+import unittest
+import subprocess
+
+from cloudify.exceptions import NonRecoverableError
+
+from cloudify_docker.remote import (RemoteScript,
+                                    run_script,
+                                    inline_script,
+                                    parse_probe,
+                                    probe_script,
+                                    install_reason)
+
+
+class LocalChannel(object):
+    """Runs the command of a paramiko channel in a local shell."""
+
+    def __init__(self):
+        self.process = None
+        self.commands = []
+
+    def set_combine_stderr(self, combine):
+        self.combine = combine
+
+    def exec_command(self, command):
+        self.commands.append(command)
+        self.process = subprocess.Popen(
+            command, shell=True, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+
+    def shutdown_write(self):
+        self.process.stdin.close()
+
+    def recv(self, size):
+        return os.read(self.process.stdout.fileno(), size)
+
+    def recv_exit_status(self):
+        return self.process.wait()
+
+    def close(self):
+        self.process.stdout.close()
+
+
+class TestRemoteScript(unittest.TestCase):
+
+    def setUp(self):
+        super(TestRemoteScript, self).setUp()
+        self.channels = []
+
+    def open_channel(self):
+        self.channels.append(LocalChannel())
+        return self.channels[-1]
+
+    def test_steps_in_one_channel(self):
+        logger = mock.Mock()
+        script = RemoteScript(logger, use_sudo=False)
+        script.parallel('download', ['sleep 0.3; echo one',
+                                     'sleep 0.3; echo two'])
+        script.step('install', 'echo installing; echo warning >&2')
+        started = time.time()
+        results = script.run(self.open_channel)
+        self.assertLess(time.time() - started, 0.55)
+        self.assertEqual(len(self.channels), 1)
+        self.assertEqual(self.channels[0].commands, ['sh -s'])
+        self.assertEqual([(result['name'], result['exit_code'])
+                          for result in results],
+                         [('download', 0), ('install', 0)])
+        self.assertEqual(sorted(results[0]['output'].split('\n')),
+                         ['one', 'two'])
+        self.assertEqual(results[1]['output'], 'installing\nwarning')
+        logger.error.assert_not_called()
+
+    def test_failed_step(self):
+        logger = mock.Mock()
+        script = RemoteScript(logger, use_sudo=False)
+        script.step('first', 'echo fine')
+        script.step('second', 'echo broken; exit 3')
+        script.step('third', 'echo never')
+        with self.assertRaisesRegex(NonRecoverableError,
+                                    'failed with 3 at step second'):
+            script.run(self.open_channel)
+        self.assertFalse(any('never' in str(call) for call in
+                             logger.debug.call_args_list))
+
+    def test_continue_on_error(self):
+        logger = mock.Mock()
+        script = RemoteScript(logger, use_sudo=False, stop_on_error=False)
+        script.parallel('download', ['exit 1', 'true'])
+        script.step('second', 'echo still')
+        results = script.run(self.open_channel)
+        self.assertEqual([result['exit_code'] for result in results],
+                         [1, 0])
+        self.assertIn('at step download',
+                      logger.error.call_args_list[-1][0][0])
+
+    def test_step_reading_stdin(self):
+        script = RemoteScript(mock.Mock(), use_sudo=False)
+        script.step('prompt', 'cat > /dev/null')
+        script.step('after', 'echo after')
+        # bash reads its script a line at a time, unlike dash
+        with mock.patch.object(RemoteScript, 'command', 'bash -s'):
+            results = script.run(self.open_channel)
+        self.assertEqual([(result['name'], result['exit_code'])
+                          for result in results],
+                         [('prompt', 0), ('after', 0)])
+        self.assertEqual(results[1]['output'], 'after')
+
+    def test_script_ended_early(self):
+        script = RemoteScript(mock.Mock(), use_sudo=False,
+                              stop_on_error=False)
+        script.marker = '__step_test'
+        script.step('first', 'true')
+        script.step('second', 'true')
+        command = "cat > /dev/null; echo '__step_test start 0'"
+        with mock.patch.object(RemoteScript, 'command', command):
+            with self.assertRaisesRegex(NonRecoverableError,
+                                        'with 0 after 1 of 2 steps'):
+                script.run(self.open_channel)
+
+    def test_sudo_command(self):
+        self.assertEqual(RemoteScript(mock.Mock()).command, 'sudo -n sh -s')
+
+
+PROBE_OUTPUT = """docker_version Docker version 24.0.7, build afdd53b
+daemon active
+groups centos wheel docker
+os_release NAME="CentOS Stream"
+os_release ID="centos"
+os_release VERSION_ID="9"
+"""
+
+
+class TestProbe(unittest.TestCase):
+
+    def test_probe_script(self):
+        output = run_script(LocalChannel, 'sh -s', probe_script('root'))
+        probe = parse_probe(output)
+        self.assertIn('root', probe['groups'])
+        self.assertIn(probe['daemon'], ['active', 'inactive'])
+
+    def test_inline_probe_script(self):
+        command = inline_script(probe_script('root'))
+        self.assertFalse(set('$"`\\\n') & set(command))
+        output = subprocess.check_output(command, shell=True)
+        self.assertIn('root', parse_probe(output.decode())['groups'])
+
+    def test_parse_probe(self):
+        self.assertEqual(parse_probe(PROBE_OUTPUT), {
+            'docker_version': '24.0.7',
+            'daemon': 'active',
+            'groups': ['centos', 'wheel', 'docker'],
+            'os_release': {'NAME': 'CentOS Stream',
+                           'ID': 'centos',
+                           'VERSION_ID': '9'}})
+        self.assertEqual(parse_probe('docker_version \ndaemon inactive\n'),
+                         {'docker_version': '',
+                          'daemon': 'inactive',
+                          'groups': [],
+                          'os_release': {}})
+
+    def test_install_reason(self):
+        probe = parse_probe(PROBE_OUTPUT)
+        self.assertIsNone(install_reason(probe, 'centos'))
+        self.assertIsNone(install_reason(probe, 'centos', '24.0'))
+        self.assertIsNone(install_reason(probe, 'centos', '24.0.7'))
+        self.assertIn('instead of 24.0.1',
+                      install_reason(probe, 'centos', '24.0.1'))
+        self.assertIn('instead of 2', install_reason(probe, 'centos', '2'))
+        probe['groups'] = ['centos']
+        self.assertIn('not in the docker group',
+                      install_reason(probe, 'centos'))
+        probe['daemon'] = 'inactive'
+        self.assertIn('not running', install_reason(probe, 'centos'))
+        self.assertIn('not installed', install_reason(
+            parse_probe('docker_version \n'), 'centos'))
@@ -0,0 +1,107 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import time
+import threading
+import unittest
+
+from docker.errors import APIError
+
+from cloudify.exceptions import NonRecoverableError
+
+from cloudify_docker.events import close_exit_watchers
+from cloudify_docker.replicas import ReplicaSet
+
+
+class FakeContainersClient(object):
+
+    def __init__(self, fail_names=(), delay=0):
+        self.fail_names = fail_names
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+        self.containers = mock.Mock()
+        self.containers.create.side_effect = self._create
+        self.containers.get.return_value = mock.Mock(status='running')
+        self.events = mock.Mock(side_effect=APIError('no events here'))
+        self.api = mock.Mock()
+
+    def _start(self, name):
+        with self._lock:
+            self.calls.append(('start', name))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self._lock:
+            self.running -= 1
+        if name in self.fail_names:
+            raise APIError('port is already allocated')
+
+    def _wait(self, name):
+        with self._lock:
+            self.calls.append(('wait', name))
+        return {'StatusCode': 3}
+
+    def _create(self, image, name=None, **kwargs):
+        container = mock.Mock(id='id-{0}'.format(name), status='running')
+        container.name = name
+        container.start.side_effect = lambda: self._start(name)
+        container.wait.side_effect = lambda: self._wait(name)
+        return container
+
+
+class TestReplicas(unittest.TestCase):
+
+    def setUp(self):
+        close_exit_watchers()
+
+    def test_detached_replicas(self):
+        client = FakeContainersClient(delay=0.05)
+        replicas = ReplicaSet(client, 'app:1.0',
+                              {'name': 'web', 'detach': True},
+                              mock.Mock()).run(5, concurrency=2)
+        self.assertEqual([replica['name'] for replica in replicas],
+                         ['web-{0}'.format(i) for i in range(5)])
+        self.assertEqual(replicas[0], {'id': 'id-web-0', 'name': 'web-0',
+                                       'state': 'running',
+                                       'exit_code': None})
+        self.assertEqual(client.max_running, 2)
+
+    def test_exit_codes(self):
+        client = FakeContainersClient()
+        replicas = ReplicaSet(client, 'app:1.0', {'name': 'job'},
+                              mock.Mock()).run(2)
+        self.assertEqual([(replica['state'], replica['exit_code'])
+                          for replica in replicas],
+                         [('exited', 3), ('exited', 3)])
+
+    def test_all_started_before_waiting(self):
+        client = FakeContainersClient()
+        ReplicaSet(client, 'app:1.0', {'name': 'job'},
+                   mock.Mock()).run(4, concurrency=2)
+        self.assertEqual([call for call, _ in client.calls],
+                         ['start'] * 4 + ['wait'] * 4)
+
+    def test_rollback_on_failure(self):
+        client = FakeContainersClient(fail_names=('web-1',))
+        replica_set = ReplicaSet(client, 'app:1.0',
+                                 {'name': 'web', 'detach': True},
+                                 mock.Mock())
+        self.assertRaises(NonRecoverableError, replica_set.run, 3)
+        removed = sorted(call[0][0] for call in
+                         client.api.remove_container.call_args_list)
+        self.assertEqual(removed, ['id-web-0', 'id-web-1', 'id-web-2'])
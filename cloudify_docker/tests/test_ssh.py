@@ -0,0 +1,153 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import os
+import mock
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+import paramiko
+
+from cloudify.exceptions import NonRecoverableError
+
+from cloudify_docker.ssh import (SshConnectionPool,
+                                 load_private_key,
+                                 sftp_put)
+
+
+def private_key():
+    content = io.StringIO()
+    paramiko.RSAKey.generate(1024).write_private_key(content)
+    return content.getvalue()
+
+
+class FakeConnection(object):
+
+    def __init__(self, host, user, connect_kwargs, config):
+        self.host = host
+        self.user = user
+        self.connect_kwargs = connect_kwargs
+        self.is_connected = False
+        self.transport = mock.Mock()
+        self.closed = False
+
+    def open(self):
+        self.is_connected = True
+
+    def close(self):
+        self.is_connected = False
+        self.closed = True
+
+
+class TestSshConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        super(TestSshConnectionPool, self).setUp()
+        patcher = mock.patch('cloudify_docker.ssh.PooledConnection',
+                             FakeConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.key = private_key()
+
+    def test_reuse_by_host_user_and_key(self):
+        pool = SshConnectionPool(keepalive=15)
+        with pool.borrow('10.0.0.1', 'centos', self.key) as first:
+            pass
+        with pool.borrow('10.0.0.1', 'centos', self.key) as second:
+            self.assertIs(first, second)
+        self.assertIsInstance(first.connect_kwargs['pkey'],
+                              paramiko.RSAKey)
+        first.transport.set_keepalive.assert_called_once_with(15)
+        with pool.borrow('10.0.0.1', 'ubuntu', self.key) as other_user:
+            self.assertIsNot(other_user, first)
+        with pool.borrow('10.0.0.1', 'centos', private_key()) as other_key:
+            self.assertIsNot(other_key, first)
+        self.assertEqual(len(pool), 3)
+        pool.close()
+        self.assertTrue(first.closed)
+        self.assertEqual(len(pool), 0)
+
+    def test_key_file_path(self):
+        key_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, key_dir)
+        key_path = os.path.join(key_dir, 'key.pem')
+        with open(key_path, 'w') as f:
+            f.write(self.key)
+        with SshConnectionPool().borrow('h', 'u', key_path) as connection:
+            self.assertEqual(connection.connect_kwargs,
+                             {'key_filename': key_path})
+
+    def test_drops_broken_and_idle(self):
+        pool = SshConnectionPool(idle_timeout=0.05)
+        with pool.borrow('h', 'u', self.key) as first:
+            first.is_connected = False
+        self.assertTrue(first.closed)
+        self.assertEqual(len(pool), 0)
+        with pool.borrow('h', 'u', self.key) as second:
+            pass
+        time.sleep(0.1)
+        with pool.borrow('h', 'u', self.key) as third:
+            self.assertIsNot(third, second)
+        self.assertTrue(second.closed)
+
+    def test_per_host_limit(self):
+        pool = SshConnectionPool(max_per_host=1)
+        waiting = []
+
+        def other():
+            with pool.borrow('h', 'u', self.key):
+                waiting.append(time.time())
+
+        with pool.borrow('h', 'u', self.key):
+            thread = threading.Thread(target=other)
+            thread.start()
+            time.sleep(0.1)
+            released = time.time()
+            self.assertEqual(waiting, [])
+        thread.join(5)
+        self.assertGreaterEqual(waiting[0], released)
+
+    def test_invalid_key(self):
+        with self.assertRaises(NonRecoverableError):
+            load_private_key('not a key')
+
+
+class TestSftpPut(unittest.TestCase):
+
+    def test_directory(self):
+        source = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source)
+        os.makedirs(os.path.join(source, 'roles', 'web'))
+        os.makedirs(os.path.join(source, '.git'))
+        for name in ['site.yaml', 'roles/web/main.yaml', '.git/HEAD']:
+            with open(os.path.join(source, name), 'w') as f:
+                f.write(name)
+        sftp = mock.Mock()
+        sftp.stat.side_effect = IOError('missing')
+        connection = mock.Mock()
+        connection.sftp.return_value = sftp
+        sftp_put(connection, source, '/tmp')
+        name = os.path.basename(source)
+        self.assertEqual(
+            sorted(call[0][0] for call in sftp.mkdir.call_args_list),
+            ['/tmp/{0}'.format(name), '/tmp/{0}/roles'.format(name),
+             '/tmp/{0}/roles/web'.format(name)])
+        self.assertEqual(
+            sorted(call[0][1] for call in sftp.put.call_args_list),
+            ['/tmp/{0}/roles/web/main.yaml'.format(name),
+             '/tmp/{0}/site.yaml'.format(name)])
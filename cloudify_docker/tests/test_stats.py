@@ -0,0 +1,120 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import time
+import random
+import unittest
+
+from cloudify.exceptions import NonRecoverableError
+
+from cloudify_docker.stats import (OnlineStats,
+                                   P2Quantile,
+                                   host_summary,
+                                   parse_timestamp,
+                                   sample_containers)
+
+
+def stats_sample(second, cpu, system, memory, rx):
+    return {
+        'read': '2020-04-08T10:00:{0:02d}.500000000Z'.format(second),
+        'cpu_stats': {'cpu_usage': {'total_usage': cpu},
+                      'system_cpu_usage': system,
+                      'online_cpus': 2},
+        'precpu_stats': {'cpu_usage': {'total_usage': cpu - 50},
+                         'system_cpu_usage': system - 100} if second else {},
+        'memory_stats': {'usage': memory, 'limit': 1000,
+                         'stats': {'inactive_file': 100}},
+        'networks': {'eth0': {'rx_bytes': rx, 'tx_bytes': 0}},
+        'blkio_stats': {'io_service_bytes_recursive': [
+            {'op': 'Read', 'value': 10 * second},
+            {'op': 'Write', 'value': 0}]},
+    }
+
+
+class TestStats(unittest.TestCase):
+
+    def test_p2_quantile(self):
+        values = list(range(1, 10001))
+        random.Random(1).shuffle(values)
+        quantile = P2Quantile(0.95)
+        for value in values:
+            quantile.add(value)
+        self.assertAlmostEqual(quantile.value, 9500, delta=100)
+
+    def test_few_samples(self):
+        stats = OnlineStats()
+        self.assertIsNone(stats.summary())
+        for value in (3, 1, 2):
+            stats.add(value)
+        self.assertEqual(stats.summary(),
+                         {'min': 1, 'avg': 2, 'p95': 3, 'max': 3})
+
+    def test_parse_timestamp(self):
+        self.assertEqual(parse_timestamp('1970-01-01T00:00:10.25Z'), 10.25)
+        self.assertIsNone(parse_timestamp('0001-01-01T00:00:00Z'))
+
+    def test_sample_containers(self):
+        samples = [stats_sample(i, 1000 + 100 * i, 10000 + 200 * i,
+                                300 + i * 100, 1000 * i)
+                   for i in range(4)]
+        client = mock.Mock()
+        client.api.stats.side_effect = lambda *a, **kw: iter(samples)
+        usage = sample_containers(client, {'web': 'c1', 'db': 'c2'},
+                                  window=0)
+        # the window is over after the first sample
+        self.assertEqual(usage['web']['samples'], 1)
+        usage = sample_containers(client, {'web': 'c1'}, window=60)
+        web = usage['web']
+        self.assertEqual(web['samples'], 4)
+        self.assertEqual(web['cpu_percent'],
+                         {'min': 100, 'avg': 100, 'p95': 100, 'max': 100})
+        self.assertEqual(web['memory_usage']['min'], 200)
+        self.assertEqual(web['memory_usage']['max'], 500)
+        self.assertEqual(web['memory_percent']['max'], 50)
+        self.assertEqual(web['network_rx_rate']['avg'], 1000)
+        self.assertEqual(web['block_read_rate']['avg'], 10)
+        summary = host_summary(usage, {'NCPU': 2, 'MemTotal': 1000})
+        self.assertEqual(summary['cpus'], 2)
+        self.assertEqual(summary['cpu_percent'], 100)
+
+    def test_sampling_error(self):
+        client = mock.Mock()
+        client.api.stats.side_effect = Exception('no such container')
+        usage = sample_containers(client, {'web': 'c1'}, window=1)
+        self.assertEqual(usage['web'], {'error': 'no such container'})
+        self.assertEqual(host_summary(usage)['memory_usage'], 0)
+
+    def test_containers_share_one_window(self):
+
+        def stats(*args, **kwargs):
+            while True:
+                time.sleep(0.05)
+                yield stats_sample(0, 1000, 10000, 300, 0)
+
+        client = mock.Mock()
+        client.api.stats.side_effect = stats
+        containers = dict(('c{0}'.format(i), 'c{0}'.format(i))
+                          for i in range(40))
+        started = time.time()
+        usage = sample_containers(client, containers, window=0.3)
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(len(usage), 40)
+        self.assertTrue(all(container['samples'] >= 5
+                            for container in usage.values()))
+
+    def test_too_many_containers(self):
+        containers = dict((str(i), str(i)) for i in range(65))
+        with self.assertRaises(NonRecoverableError):
+            sample_containers(mock.Mock(), containers)
@@ -0,0 +1,139 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import socket
+import struct
+import time
+import unittest
+
+from cloudify_docker.streams import (OutputBuffer,
+                                     LineBatcher,
+                                     LogFollower,
+                                     StreamDemuxer,
+                                     demux_socket)
+
+
+def frames(*chunks):
+    return b''.join(struct.pack('>BxxxL', stream, len(data)) + data
+                    for stream, data in chunks)
+
+
+def stream_socket(data=None):
+    ours, theirs = socket.socketpair()
+    if data is None:
+        return ours, theirs
+    theirs.sendall(data)
+    theirs.close()
+    return ours
+
+
+class TestStreams(unittest.TestCase):
+
+    def test_output_buffer_keeps_head_and_tail(self):
+        buf = OutputBuffer(head_size=4, tail_size=6)
+        for chunk in [b'abc', b'defgh', b'ijklm', b'nop']:
+            buf.write(chunk)
+        self.assertEqual(buf.total, 16)
+        self.assertEqual(buf.skipped, 6)
+        self.assertEqual(buf.tail(), b'klmnop')
+        self.assertEqual(buf.getvalue(),
+                         b'abcd\n... [6 bytes skipped] ...\nklmnop')
+
+    def test_output_buffer_small_output(self):
+        buf = OutputBuffer(head_size=4, tail_size=6)
+        buf.write(b'abcdef')
+        self.assertEqual(buf.skipped, 0)
+        self.assertEqual(buf.getvalue(), b'abcdef')
+
+    def test_line_batcher_splits_multibyte_chunks(self):
+        log = mock.Mock()
+        batcher = LineBatcher(log, interval=60, max_lines=2)
+        data = u'first\nsecond é\nthird\nlast'.encode('utf-8')
+        # split in the middle of the two bytes char
+        index = data.index(b'\xc3') + 1
+        batcher.feed(data[:index])
+        batcher.feed(data[index:])
+        log.assert_not_called()
+        batcher.flush(final=True)
+        log.assert_called_once_with(
+            u'first\nsecond é\n... [2 lines not shown]')
+
+    def test_line_batcher_flushes_when_quiet(self):
+        log = mock.Mock()
+        batcher = LineBatcher(log, interval=0.05)
+        batcher.feed(b'first\n')
+        batcher.feed(b'second\npartial')
+        batcher.tick()
+        log.assert_not_called()
+        time.sleep(0.1)
+        batcher.tick()
+        log.assert_called_once_with('first\nsecond')
+
+    def test_log_follower(self):
+        log = mock.Mock()
+        follower = LogFollower(log, head_size=10, tail_size=10)
+        for chunk in [b'line 1\n', b'', b'line 2\n']:
+            follower.feed(chunk)
+        follower.close()
+        self.assertEqual(follower.getvalue(), 'line 1\nline 2\n')
+        log.assert_called_once_with('line 1\nline 2')
+
+
+class TestStreamDemuxer(unittest.TestCase):
+
+    def test_routes_frames(self):
+        stdout, stderr = [], []
+        data = frames((1, b'out 1\n'), (2, b'err 1\n'), (1, b''),
+                      (1, b'a frame larger than the buffer\n'),
+                      (2, b'err 2\n'))
+        demuxer = StreamDemuxer(stream_socket(data),
+                                lambda chunk: stdout.append(bytes(chunk)),
+                                lambda chunk: stderr.append(bytes(chunk)),
+                                buffer_size=16)
+        self.assertTrue(demuxer.run(5))
+        demuxer.close()
+        self.assertEqual(b''.join(stdout),
+                         b'out 1\na frame larger than the buffer\n')
+        self.assertEqual(b''.join(stderr), b'err 1\nerr 2\n')
+
+    def test_stderr_to_stdout(self):
+        output = []
+        self.assertTrue(demux_socket(
+            stream_socket(frames((1, b'out\n'), (2, b'err\n'))),
+            lambda chunk: output.append(bytes(chunk)), timeout=5))
+        self.assertEqual(output, [b'out\n', b'err\n'])
+
+    def test_tty_is_raw(self):
+        output = []
+        data = b'\x01\x00\x00\x00 raw output'
+        self.assertTrue(demux_socket(
+            stream_socket(data), lambda chunk: output.append(bytes(chunk)),
+            tty=True, timeout=5))
+        self.assertEqual(b''.join(output), data)
+
+    def test_deadline(self):
+        output = []
+        ours, theirs = stream_socket()
+        demuxer = StreamDemuxer(ours,
+                                lambda chunk: output.append(bytes(chunk)))
+        # half a header, then nothing
+        theirs.sendall(frames((1, b'late'))[:5])
+        self.assertFalse(demuxer.run(0.05))
+        self.assertEqual(output, [])
+        theirs.sendall(frames((1, b'late'))[5:])
+        theirs.close()
+        self.assertTrue(demuxer.run(5))
+        demuxer.close()
+        self.assertEqual(output, [b'late'])
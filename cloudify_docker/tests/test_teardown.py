@@ -0,0 +1,133 @@
+########
+# Copyright (c) 2014-2020 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import unittest
+
+from docker.errors import NotFound
+
+from cloudify_docker.events import ExitWaiter
+from cloudify_docker.teardown import Teardown, select_containers
+
+
+class FakeDaemon(object):
+    """Containers that exit on SIGTERM unless stubborn, on SIGKILL always."""
+
+    def __init__(self):
+        self.api = mock.Mock()
+        self.api.inspect_container.side_effect = self.inspect
+        self.api.kill.side_effect = self.kill
+        self.api.remove_container.side_effect = self.remove
+        self.containers = mock.Mock()
+        self.containers.get.side_effect = self.get
+        self.state = {}
+        self.waiters = {}
+
+    def add(self, container_id, running=True, stubborn=False,
+            stop_signal=None):
+        self.state[container_id] = {'running': running,
+                                    'stubborn': stubborn,
+                                    'exit_code': 0,
+                                    'stop_signal': stop_signal}
+
+    def inspect(self, container_id):
+        if container_id not in self.state:
+            raise NotFound('no such container')
+        state = self.state[container_id]
+        return {'Id': container_id,
+                'Name': '/' + container_id,
+                'State': {'Running': state['running'], 'Paused': False},
+                'Config': {'StopSignal': state['stop_signal']}}
+
+    def get(self, container_id):
+        state = self.state[container_id]
+        container = mock.Mock()
+        container.status = 'running' if state['running'] else 'exited'
+        container.attrs = {'State': {'ExitCode': state['exit_code']}}
+        return container
+
+    def watch(self, docker_client, container_id, check_exited=False):
+        waiter = ExitWaiter(container_id)
+        waiter.watcher = mock.Mock()
+        self.waiters.setdefault(container_id, []).append(waiter)
+        return waiter
+
+    def kill(self, container_id, signal=None):
+        state = self.state[container_id]
+        if signal and state['stubborn']:
+            return
+        state['running'] = False
+        state['exit_code'] = 137 if not signal else 0
+        for waiter in self.waiters.pop(container_id, []):
+            waiter.set(state['exit_code'])
+
+    def remove(self, container_id, v=False, force=False):
+        if not self.state.pop(container_id, None):
+            raise NotFound('no such container')
+
+
+class TestTeardown(unittest.TestCase):
+
+    def setUp(self):
+        super(TestTeardown, self).setUp()
+        self.daemon = FakeDaemon()
+        patcher = mock.patch('cloudify_docker.teardown.watch_container_exit',
+                             self.daemon.watch)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_select_containers(self):
+        self.daemon.add('c1')
+        self.daemon.add('c2')
+        self.daemon.api.containers.return_value = [{'Id': 'c1'}]
+        self.assertEqual(
+            select_containers(self.daemon, labels=['app=web'],
+                              containers=['c2', 'c1', 'missing']),
+            ['c1', 'c2'])
+        self.daemon.api.containers.assert_called_once_with(
+            all=True, filters={'label': ['app=web']})
+
+    def test_teardown(self):
+        self.daemon.add('graceful', stop_signal='SIGINT')
+        self.daemon.add('stubborn', stubborn=True)
+        self.daemon.add('exited', running=False)
+        report = Teardown(self.daemon, mock.Mock(), grace_period=0.1).run(
+            ['graceful', 'stubborn', 'exited', 'missing'])
+        containers = report['containers']
+        self.assertEqual(containers['graceful']['state'], 'removed')
+        self.assertFalse(containers['graceful']['killed'])
+        self.assertEqual(containers['graceful']['exit_code'], 0)
+        self.assertTrue(containers['stubborn']['killed'])
+        self.assertEqual(containers['stubborn']['exit_code'], 137)
+        self.assertGreaterEqual(containers['stubborn']['stop_time'], 0.1)
+        self.assertEqual(containers['exited']['stop_time'], 0)
+        self.assertEqual(containers['missing']['state'], 'not_found')
+        self.assertEqual((report['removed'], report['killed'],
+                          report['failed'], report['not_found']),
+                         (3, 1, 0, 1))
+        self.assertEqual(self.daemon.state, {})
+        self.daemon.api.kill.assert_any_call('graceful', signal='SIGINT')
+        self.daemon.api.remove_container.assert_any_call(
+            'stubborn', v=True, force=True)
+
+    def test_grace_period_is_shared(self):
+        names = ['c{0}'.format(index) for index in range(8)]
+        for name in names:
+            self.daemon.add(name, stubborn=True)
+        report = Teardown(self.daemon, mock.Mock(), grace_period=0.2,
+                          concurrency=2, remove=False).run(names)
+        self.assertEqual(report['killed'], 8)
+        self.assertEqual(report['stopped'], 8)
+        self.assertLess(report['duration'], 1)
+        self.assertEqual(len(self.daemon.state), 8)